@@ -3,6 +3,7 @@ import numpy as np
 from itertools import chain
 import shutil
 import h5py
+import nose
 
 def setup() :
     global snap,subfind
@@ -173,4 +174,57 @@ def test_hdf_ordering():
     # number
     assert snap._family_slice[pynbody.family.gas] == slice(0, 2076907, None)
     assert snap._family_slice[pynbody.family.dm] == slice(2076907, 4174059, None)
-    assert snap._family_slice[pynbody.family.star] == slice(4174059, 4194304, None)
\ No newline at end of file
+    assert snap._family_slice[pynbody.family.star] == slice(4174059, 4194304, None)
+
+
+def test_multifile_parallel_read():
+    gadgethdf = pynbody.snapshot.gadgethdf
+    if not gadgethdf.multiprocess_available:
+        raise nose.SkipTest("posix_ipc is required to read files in parallel")
+
+    # read each file of the snapshot in a pool of worker processes, and
+    # compare with reading them one after another
+    multiprocess_num = gadgethdf.multiprocess_num
+    try:
+        gadgethdf.multiprocess_num = 1
+        serial = pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/subhalos_103/subhalo_103')
+        gadgethdf.multiprocess_num = 2
+        s = pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/subhalos_103/subhalo_103')
+    finally:
+        gadgethdf.multiprocess_num = multiprocess_num
+
+    assert not serial._parallel_read
+    assert s._parallel_read
+    assert gadgethdf.GadgetHDFSnap.reader_pool is not None
+    assert np.all(s['pos'] == serial['pos'])
+    assert np.all(s['iord'] == serial['iord'])
+    assert np.all(s.gas['rho'] == serial.gas['rho'])
+    assert np.all(s.dm['mass'] == serial.dm['mass'])
+
+
+def test_region_loading():
+    region = pynbody.filt.Sphere(1.0, snap['pos'][0])
+    s = pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/snapshot_103/snap_103.hdf5', region=region)
+    ref = snap[region]
+    assert len(s) == len(ref)
+    assert len(s.gas) == len(ref.gas)
+    assert np.all(s['iord'] == ref['iord'])
+    assert np.all(s['pos'] == ref['pos'])
+    assert np.all(s.star['mass'] == ref.star['mass'])
+
+    # second load should use the stored spatial index
+    s2 = pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/snapshot_103/snap_103.hdf5', region=region)
+    assert np.all(s2['iord'] == ref['iord'])
+
+    # the region is evaluated on positions alone while loading
+    with np.testing.assert_raises(ValueError):
+        pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/snapshot_103/snap_103.hdf5',
+                     region=region & pynbody.filt.BandPass('temp', 0, 1.e4))
+
+    # a region containing no particles still gives arrays of the right type
+    empty = pynbody.load('testdata/Test_NOSN_NOZCOOL_L010N0128/data/snapshot_103/snap_103.hdf5',
+                         region=pynbody.filt.BandPass('x', 1.0, 0.0))
+    assert len(empty) == 0
+    assert empty['pos'].shape == (0, 3)
+    assert empty['pos'].dtype == snap['pos'].dtype
+    assert empty['pos'].units == snap['pos'].units
@@ -0,0 +1,90 @@
+import pynbody
+import numpy as np
+import numpy.testing as npt
+import os
+
+
+def _make_grp(n_particles):
+    np.random.seed(1)
+    grp = np.random.randint(-1, 50, size=n_particles).astype(np.int32)
+    grp[(grp == 7) | (grp == 30)] = 3  # halos with no particles
+    return grp
+
+
+def test_grp_catalogue_lookup():
+    f = pynbody.new(dm=10000)
+    f['grp'] = _make_grp(len(f))
+    h = pynbody.halo.GrpCatalogue(f)
+
+    for i in range(1, 50):
+        if i in (7, 30):
+            npt.assert_raises(ValueError, lambda: h[i])
+        else:
+            npt.assert_equal(h[i].get_index_list(f), np.where(f['grp'] == i)[0])
+
+    # after the first few lookups, the catalogue switches to a sorted index
+    assert h._sorted is not None
+    npt.assert_raises(ValueError, lambda: h[50])
+
+
+def test_grp_catalogue_persistent_index():
+    f = pynbody.new(dm=10000)
+    f['pos'] = np.random.uniform(size=(len(f), 3))
+    f['grp'] = _make_grp(len(f))
+    f.write(fmt=pynbody.tipsy.TipsySnap, filename="testdata/test_grp.tipsy")
+
+    index_filename = "testdata/test_grp.tipsy.grp.index.npz"
+    f = pynbody.load("testdata/test_grp.tipsy")
+    h = pynbody.halo.GrpCatalogue(f)
+    h._persistent_index = True
+    try:
+        h.precalculate()
+        assert os.path.exists(index_filename)
+
+        f = pynbody.load("testdata/test_grp.tipsy")
+        h = pynbody.halo.GrpCatalogue(f)
+        h._persistent_index = True
+        assert h._load_index(index_filename, pynbody.halo._array_checksum(f['grp']))
+        npt.assert_equal(h[12].get_index_list(f), np.where(f['grp'] == 12)[0])
+
+        # a changed group array must invalidate the stored index
+        f['grp'][:10] = 12
+        assert not h._load_index(index_filename, pynbody.halo._array_checksum(f['grp']))
+    finally:
+        for ext in "", ".grp", ".grp.pynbody-meta", ".grp.index.npz":
+            if os.path.exists("testdata/test_grp.tipsy" + ext):
+                os.remove("testdata/test_grp.tipsy" + ext)
+
+
+def test_grp_catalogue_compute_properties():
+    f = pynbody.new(dm=20000)
+    np.random.seed(2)
+    f['grp'] = _make_grp(len(f))
+    f['pos'] = np.random.normal(scale=0.1, size=(len(f), 3)) + f['grp'][:, np.newaxis]
+    f['vel'] = np.random.normal(size=(len(f), 3))
+    f['mass'] = np.random.uniform(size=len(f))
+    f['pos'].units = 'Mpc'
+    f['mass'].units = '1e10 Msol'
+    f['vel'].units = 'km s^-1'
+    h = pynbody.halo.GrpCatalogue(f, ignore=10)
+
+    props = h.compute_properties(['n_particles', 'mass', 'com', 'com_vel', 'vel_disp', 'r_vir'])
+
+    assert 7 not in props['halo_id'] and 10 not in props['halo_id']
+    assert props['mass'].units == f['mass'].units
+
+    for j, i in enumerate(props['halo_id']):
+        halo = f[np.where(f['grp'] == i)]
+        assert props['n_particles'][j] == len(halo)
+        npt.assert_allclose(props['mass'][j], halo['mass'].sum(), rtol=1e-10)
+        com = pynbody.analysis.halo.center_of_mass(halo)
+        npt.assert_allclose(props['com'][j], com, rtol=1e-10)
+        com_vel = pynbody.analysis.halo.center_of_mass_velocity(halo)
+        npt.assert_allclose(props['com_vel'][j], com_vel, rtol=1e-10)
+        vel_disp = np.sqrt(np.average(((halo['vel'] - com_vel) ** 2).sum(axis=1), weights=halo['mass']))
+        npt.assert_allclose(props['vel_disp'][j], vel_disp, rtol=1e-10)
+
+    for j in 0, 5, 20:
+        halo = f[np.where(f['grp'] == props['halo_id'][j])]
+        r_vir = pynbody.analysis.halo.virial_radius(halo, cen=props['com'][j], r_max=1.0)
+        npt.assert_allclose(props['r_vir'][j], r_vir, rtol=1e-2)
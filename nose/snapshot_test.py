@@ -119,6 +119,63 @@ def test_derived_array():
     assert 'r' in f.keys()
 
 
+def test_derive_arrays():
+    g = pynbody.new(dm=1000, star=500, gas=500, order='gas,dm,star')
+    g['pos'] = f['pos']
+    g['vel'] = f['vel']
+    g['phi'] = f['mass']
+    g['pos'].units = 'kpc'
+    g['vel'].units = 'km s^-1'
+    g['phi'].units = 'km^2 s^-2'
+
+    names = ['vr', 'vt', 'jz', 'te', 'alt']
+    g.derive_arrays(names, chunk_size=300)
+    for name in names:
+        assert g[name].derived
+        expected = g[name].copy()
+        del g[name]
+        assert np.allclose(g[name], expected, rtol=1e-12, atol=0)
+        assert g[name].units == expected.units
+
+    # intermediates are not stored, but dependencies are still tracked
+    g = pynbody.new(dm=1000, star=500, gas=500, order='gas,dm,star')
+    g['pos'] = f['pos']
+    g['vel'] = f['vel']
+    g[::3].derive_arrays(['vr', 'jz'], chunk_size=300)
+    assert 'vr' in g.keys() and 'jz' in g.keys()
+    assert 'r' not in g.keys() and 'j' not in g.keys()
+    g['pos'] += (2, 0, 0)
+    assert 'vr' not in g.keys() and 'jz' not in g.keys()
+
+    g.star.derive_arrays(['vr', 'rxy', 'mass'], chunk_size=300)
+    assert set(g.family_keys()) == set(['vr', 'rxy'])
+    assert np.allclose(g.star['vr'], (g.star['pos'] * g.star['vel']).sum(axis=1) / g.star['r'])
+
+
+def test_derive_in_blocks():
+    block_size = pynbody.config['derive-block-size']
+    try:
+        derived = {}
+        for pynbody.config['derive-block-size'] in 0, 128:
+            g = pynbody.new(dm=1000, star=500, gas=500, order='gas,dm,star')
+            g['pos'] = f['pos']
+            g['vel'] = f['vel']
+            derived[pynbody.config['derive-block-size']] = g
+            g['vt'], g.gas['j'], g[[4, 600, 1999]]['vphi']
+    finally:
+        pynbody.config['derive-block-size'] = block_size
+
+    at_once, in_blocks = derived[0], derived[128]
+    # intermediates are only kept when calculating all particles at once
+    assert 'vr' in at_once.keys() and 'vr' not in in_blocks.keys()
+    assert np.allclose(in_blocks['vt'], at_once['vt'], rtol=1e-12, atol=0)
+    assert np.allclose(in_blocks.gas['j'], at_once.gas['j'], rtol=1e-12, atol=0)
+    assert np.allclose(in_blocks['vphi'], at_once['vphi'], rtol=1e-12, atol=0)
+    assert in_blocks['vt'].derived
+    in_blocks['vel'] *= 2
+    assert 'vt' not in in_blocks.keys() and 'j' not in in_blocks.family_keys()
+
+
 def test_unit_inheritance():
     f['pos'].units = 'km'
     f['vel'].units = 'km s^-1'
@@ -236,6 +293,20 @@ def test_subsnap_by_boolean_mask():
     print((f['x'] > 0).shape, len(f))
     assert (f['x'][f['x'] > 0] == f[f['x'] > 0]['x']).all()
 
+def test_indexed_subsnap_families():
+    # families laid out as gas 0-499, dm 500-1499, star 1500-1999
+    index = np.array([3, 10, 499, 1500, 1501, 1999])
+    sub = f[index]
+    assert sub._family_slice == {pynbody.family.gas: slice(0, 3),
+                                 pynbody.family.star: slice(3, 6)}
+    assert len(sub.dm) == 0
+    assert (sub.gas.get_index_list(f) == [3, 10, 499]).all()
+    assert (sub.s['mass'] == f['mass'][[1500, 1501, 1999]]).all()
+
+    with np.testing.assert_raises(ValueError):
+        f[[600, 3]]
+
+
 def test_issue_206() :
     assert len(f.s[[1,4,29]].s)==3
 
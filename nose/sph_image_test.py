@@ -3,6 +3,7 @@ import numpy as np
 import numpy.testing as npt
 import pylab as p
 import pickle
+import os
 
 
 def setup():
@@ -31,7 +32,7 @@ def test_images():
     im2d = pynbody.plot.sph.image(
         f.gas, width=20.0, units="m_p cm^-2", noplot=True, approximate_fast=False)
 
-    im_grid = pynbody.sph.to_3d_grid(f.gas,nx=200,x2=20.0)[::50]
+    im_grid = pynbody.sph.to_3d_grid(f.gas,nx=200,x2=20.0,conserve_mass=False)[::50]
 
     """
     np.save("test_im_2d.npy",im2d)
@@ -68,6 +69,24 @@ def test_approximate_images():
     assert abs(np.log10(im3d/compare3d)).mean()<0.03
 
 
+def test_fft_images():
+    global f
+    # FFT rendering approximates each particle's smoothing length by that
+    # of its band, but conserves the total where kernels are resolved
+    resolved = f.gas[f.gas['smooth'] > 0.3]
+    kernel = pynbody.sph.Kernel2D()
+    im = pynbody.sph.render_image(resolved, nx=200, x2=10.0, kernel=kernel, approximate_fast='fft')
+    im_exact = pynbody.sph.render_image(resolved, nx=200, x2=10.0, kernel=kernel, approximate_fast=False)
+    assert im.units == im_exact.units
+    npt.assert_allclose(im.sum(), im_exact.sum(), rtol=1e-3)
+    assert np.median(abs(im / im_exact - 1)) < 0.03
+
+    im2d = pynbody.plot.sph.image(
+        f.gas, width=20.0, units="m_p cm^-2", noplot=True, approximate_fast='fft')
+    compare2d = np.load("test_im_2d.npy")
+    assert abs(np.log10(im2d/compare2d)).mean()<0.03
+
+
 def test_denoise_projected_image_throws():
     global f
     # this should be fine:
@@ -75,4 +94,123 @@ def test_denoise_projected_image_throws():
 
     with npt.assert_raises(ValueError):
         # this should not:
-        pynbody.plot.sph.image(f.gas, width=20.0, units="m_p cm^-2", noplot=True, approximate_fast=True, denoise=True)
\ No newline at end of file
+        pynbody.plot.sph.image(f.gas, width=20.0, units="m_p cm^-2", noplot=True, approximate_fast=True, denoise=True)
+
+def test_threaded_image_reproducible():
+    global f
+    # rendering in bands on several threads must give exactly the same
+    # image as rendering on one thread
+    for kernel in pynbody.sph.Kernel(), pynbody.sph.Kernel2D():
+        im_serial = pynbody.sph.render_image(f.gas, nx=300, x2=10.0, kernel=kernel,
+                                             approximate_fast=False, threaded=False)
+        for n_threads in 2, 5:
+            im_threaded = pynbody.sph.render_image(f.gas, nx=300, x2=10.0, kernel=kernel,
+                                                   approximate_fast=False, threaded=n_threads)
+            npt.assert_equal(im_threaded, im_serial)
+
+
+def test_culled_image_unchanged():
+    global f
+    # gathering only the particles that can reach the image must not change
+    # the result
+    select_in_view = pynbody.sph._select_in_view
+
+    def check(snap, **kwargs):
+        im_culled = pynbody.sph.render_image(snap, nx=200, threaded=False, **kwargs)
+        try:
+            pynbody.sph._select_in_view = lambda *args, **kwargs: None
+            im_all = pynbody.sph.render_image(snap, nx=200, threaded=False, **kwargs)
+        finally:
+            pynbody.sph._select_in_view = select_in_view
+        npt.assert_equal(im_culled, im_all)
+        return im_all
+
+    for kwargs in dict(x2=1.0), dict(x2=1.0, kernel=pynbody.sph.Kernel2D()), dict(x2=100.0, xy_units='pc'):
+        check(f.gas, **kwargs)
+
+    # with a periodic tree, candidates are found around the centre of the
+    # view, which may lie outside the particles' coordinate range
+    np.random.seed(1)
+    box = pynbody.new(gas=20000)
+    box['pos'] = np.random.uniform(-0.5, 0.5, size=(len(box), 3))
+    box['pos'].units = 'kpc'
+    box['smooth'] = np.random.uniform(0.03, 0.05, size=len(box))
+    box['smooth'].units = 'kpc'
+    box['mass'] = np.ones(len(box))
+    box['mass'].units = 'Msol'
+    box['rho'] = np.ones(len(box))
+    box['rho'].units = 'Msol kpc^-3'
+    box.properties['boxsize'] = pynbody.units.Unit('1 kpc')
+    pynbody.sph.build_tree(box.gas)
+    for x_centre in 0.7, 1.5:
+        im = check(box.gas, x1=x_centre - 0.1, x2=x_centre + 0.1, y1=-0.1, y2=0.1)
+        assert im.min() > 0
+
+
+def test_image_pyramid():
+    global f
+    pyramid = pynbody.sph.ImagePyramid(f.gas, tile_size=64)
+    im = pyramid.render_image(nx=200, x2=10.0)
+    im_direct = pynbody.sph.render_image(f.gas, nx=200, x2=10.0, approximate_fast=False)
+    assert im.units == im_direct.units
+    # pixels may only differ where rounding moves a small particle's contribution
+    assert (abs(im / im_direct - 1) < 1.e-5).mean() > 0.999
+
+    # panning renders only the tiles not yet seen, and a view that has
+    # been seen before is assembled entirely from the cache
+    n_rendered = pyramid.n_tiles_rendered
+    pyramid.render_image(nx=200, x1=0.0, x2=20.0, y1=-10.0, y2=10.0)
+    assert n_rendered < pyramid.n_tiles_rendered < 2 * n_rendered
+    assert pyramid.n_pixels_rendered == pyramid.n_tiles_rendered * 64 ** 2
+    n_rendered = pyramid.n_tiles_rendered
+    npt.assert_equal(pyramid.render_image(nx=200, x2=10.0), im)
+    assert pyramid.n_tiles_rendered == n_rendered
+
+    # after a diagonal pan the missing tiles form an L-shape, and the corner
+    # they surround must not be rendered again
+    pyramid.render_image(nx=200, x1=-15.0, x2=5.0, y1=-5.0, y2=15.0)
+    assert pyramid.n_tiles_rendered - n_rendered == 7
+    assert pyramid.n_pixels_rendered == pyramid.n_tiles_rendered * 64 ** 2
+
+    small = pynbody.sph.ImagePyramid(f.gas, tile_size=64, max_megabytes=0.05)
+    small.render_image(nx=200, x2=10.0)
+    assert 0 < small.nbytes <= 0.05 * 2 ** 20
+
+
+def test_grid_in_slabs():
+    global f
+    grid = pynbody.sph.to_3d_grid(f.gas, nx=40, ny=30, nz=20, x2=10.0, approximate_fast=False, threaded=False)
+
+    # threads each fill their own slab of the grid, giving an identical result
+    npt.assert_equal(pynbody.sph.to_3d_grid(f.gas, nx=40, ny=30, nz=20, x2=10.0,
+                                            approximate_fast=False, threaded=3), grid)
+
+    # as does writing the grid to disk a few planes at a time
+    grid_file = pynbody.sph.to_3d_grid(f.gas, nx=40, ny=30, nz=20, x2=10.0, threaded=2,
+                                       filename="testdata/test_grid.npy", slab_megabytes=0.01)
+    try:
+        assert grid_file.units == grid.units
+        npt.assert_equal(grid_file, grid)
+        npt.assert_equal(np.load("testdata/test_grid.npy"), grid)
+    finally:
+        del grid_file
+        os.remove("testdata/test_grid.npy")
+
+
+def test_grid_conserves_mass():
+    # particles with smoothing lengths from well below to above the cell
+    # size, all of whose kernels lie inside the grid
+    np.random.seed(1)
+    box = pynbody.new(gas=2000)
+    box['pos'] = np.random.uniform(-0.75, 0.75, size=(len(box), 3))
+    box['pos'].units = 'kpc'
+    box['smooth'] = 10 ** np.random.uniform(-2.5, -1.0, size=len(box))
+    box['smooth'].units = 'kpc'
+    box['mass'] = np.random.uniform(1.0, 2.0, size=len(box))
+    box['mass'].units = 'Msol'
+    box['rho'] = np.random.uniform(1.0, 2.0, size=len(box))
+    box['rho'].units = 'Msol kpc^-3'
+
+    for threaded in False, 2:
+        grid = pynbody.sph.to_3d_grid(box.gas, nx=20, x2=1.0, approximate_fast=False, threaded=threaded)
+        npt.assert_allclose(float(grid.sum()) * 0.1 ** 3, float(box['mass'].sum()), rtol=1e-5)
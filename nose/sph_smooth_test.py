@@ -106,6 +106,229 @@ def test_periodic_smoothing():
     npt.assert_allclose(f.dm['rho'][::100],
                          np.load('test_rho_periodic.npy'),rtol=1e-5)
 
+def test_persistent_tree():
+    import os
+    f = pynbody.load("testdata/g15784.lr.01024")
+    del f.properties['boxsize']
+    cache_filename = pynbody.sph._tree_cache_filename(f.dm)
+    if os.path.exists(cache_filename):
+        os.remove(cache_filename)
+
+    pynbody.sph._persistent_tree = True
+    try:
+        rho = f.dm['rho']
+        assert os.path.exists(cache_filename)
+
+        # new session - tree should be restored from disk and give identical
+        # results
+        f = pynbody.load("testdata/g15784.lr.01024")
+        del f.properties['boxsize']
+        npt.assert_equal(f.dm['rho'], rho)
+
+        # moving particles must invalidate the stored tree
+        f = pynbody.load("testdata/g15784.lr.01024")
+        del f.properties['boxsize']
+        f.dm['pos']*=2
+        assert pynbody.sph._load_tree_data(cache_filename, len(f.dm),
+                                           pynbody.sph._pos_checksum(f.dm['pos']),
+                                           pynbody.config['sph']['tree-leafsize']) is None
+    finally:
+        pynbody.sph._persistent_tree = False
+        os.remove(cache_filename)
+
+def test_kdtree_query():
+    np.random.seed(1)
+    pos = np.random.uniform(size=(2000,3))
+    points = np.random.uniform(size=(50,3))
+    # periodic trees must also handle particles offset from the origin and
+    # query positions outside both the particle range and the box
+    outside_points = np.random.uniform(-3.0, 3.0, size=(50,3))
+    for boxsize, pos, points in [(None, pos, points), (1.0, pos, points),
+                                 (1.0, pos-0.5, points), (1.0, pos-0.5, outside_points)]:
+        tree = pynbody.sph.kdtree.KDTree(pos, np.ones(len(pos)), boxsize=boxsize)
+
+        offset = points[:,np.newaxis,:]-pos[np.newaxis,:,:]
+        if boxsize:
+            offset = (offset+0.5)%1.0-0.5
+        brute_distance = np.sqrt((offset**2).sum(axis=2))
+
+        indices, distances = tree.query(points, 10)
+        npt.assert_equal(indices, np.argsort(brute_distance,axis=1)[:,:10])
+        npt.assert_allclose(distances, np.sort(brute_distance,axis=1)[:,:10], rtol=1e-5)
+
+        offsets, indices, distances = tree.query_ball(points, 0.1)
+        for i in range(len(points)):
+            npt.assert_equal(np.sort(indices[offsets[i]:offsets[i+1]]),
+                             np.where(brute_distance[i]<=0.1)[0])
+        npt.assert_allclose(distances, brute_distance[np.repeat(np.arange(len(points)),np.diff(offsets)),indices], rtol=1e-5)
+
+def test_kdtree_invalid_tree_data():
+    np.random.seed(1)
+    pos = np.random.uniform(size=(2000,3))
+    mass = np.ones(len(pos))
+    points = np.random.uniform(size=(50,3))
+    tree = pynbody.sph.kdtree.KDTree(pos, mass)
+    order, nodes = tree.get_tree_data()
+    expected = tree.query(points, 10)
+
+    # a particle order which is not a permutation of the particles (as from
+    # a corrupted cache) must be ignored and the tree rebuilt
+    out_of_range = np.frombuffer(order, dtype=np.int32).copy()
+    out_of_range[0] = len(pos) + 100
+    repeated = np.frombuffer(order, dtype=np.int32).copy()
+    repeated[1] = repeated[0]
+    for bad_order in out_of_range, repeated:
+        restored = pynbody.sph.kdtree.KDTree(pos, mass, tree_data=(bad_order.tostring(), nodes))
+        npt.assert_equal(restored.query(points, 10), expected)
+
+def test_subsnap_tree_from_parent():
+    np.random.seed(1)
+    f = pynbody.new(dm=5000, gas=5000)
+    f['pos'] = np.random.normal(size=(len(f),3))
+    f['mass'] = np.random.uniform(size=len(f))
+    pynbody.sph.build_tree(f.gas)
+
+    h = f[pynbody.filt.Sphere(1.0)]
+    pynbody.sph.build_tree(h.gas)
+    fresh_tree = pynbody.sph.kdtree.KDTree(np.asanyarray(h.gas['pos']),
+                                           np.asanyarray(h.gas['mass']),
+                                           leafsize=pynbody.config['sph']['tree-leafsize'])
+
+    points = np.random.normal(size=(100,3))
+    npt.assert_equal(h.gas.kdtree.query(points, 10), fresh_tree.query(points, 10))
+
+    smooth = np.empty(len(h.gas))
+    h.gas.kdtree.set_array_ref('smooth', smooth)
+    h.gas.kdtree.populate('hsm', 32)
+    fresh_smooth = np.empty(len(h.gas))
+    fresh_tree.set_array_ref('smooth', fresh_smooth)
+    fresh_tree.populate('hsm', 32)
+    npt.assert_allclose(smooth, fresh_smooth, rtol=1e-6)
+
+def test_smooth_out_of_core():
+    import os
+    np.random.seed(1)
+    f = pynbody.new(dm=30000)
+    f['pos'] = np.mod(np.random.normal(scale=0.2, size=(len(f),3)), 1.0) - 0.5
+    f['mass'] = np.random.uniform(size=len(f))
+    f.write(fmt=pynbody.tipsy.TipsySnap, filename="testdata/test_out_of_core.tipsy")
+
+    f = pynbody.load("testdata/test_out_of_core.tipsy")
+    smooth = np.array(f['smooth'])
+    rho = np.array(pynbody.sph.rho(f))
+
+    try:
+        f_streamed = pynbody.sph.smooth_out_of_core("testdata/test_out_of_core.tipsy",
+                                                    n_slabs=5, overwrite=True)
+        npt.assert_allclose(f_streamed['smooth'], smooth, rtol=1e-5)
+        npt.assert_allclose(f_streamed['rho'], rho, rtol=1e-5)
+
+        # the results must have been written to disk
+        f = pynbody.load("testdata/test_out_of_core.tipsy")
+        assert 'smooth' in f.dm.loadable_keys()
+        npt.assert_allclose(f['smooth'], smooth, rtol=1e-5)
+    finally:
+        for ext in "", ".smooth", ".smooth.pynbody-meta", ".rho", ".rho.pynbody-meta":
+            if os.path.exists("testdata/test_out_of_core.tipsy" + ext):
+                os.remove("testdata/test_out_of_core.tipsy" + ext)
+
+def test_sph_smooth_arrays():
+    np.random.seed(1)
+    f = pynbody.new(gas=5000, dm=5000)
+    f['pos'] = np.random.normal(size=(len(f),3))
+    f['vel'] = np.random.normal(size=(len(f),3))
+    f['mass'] = np.random.uniform(size=len(f))
+    f['temp'] = np.random.uniform(size=len(f))
+
+    # smoothing several arrays at once matches smoothing them one at a time
+    temp_mean, vel_mean = f.gas.sph_smooth(['temp', 'vel'])
+    npt.assert_allclose(temp_mean, f.gas.kdtree.sph_mean(f.gas['temp']), rtol=1e-5)
+    npt.assert_allclose(vel_mean, f.gas['v_mean'], rtol=1e-5, atol=1e-6)
+    npt.assert_equal(f.gas['temp_sph_mean'], temp_mean)
+
+    temp_disp, vel_disp = f.gas.sph_smooth(['temp', 'vel'], dispersion=True)
+    npt.assert_allclose(temp_disp, f.gas.kdtree.sph_dispersion(f.gas['temp']), rtol=1e-5)
+    npt.assert_allclose(vel_disp, f.gas['v_disp'], rtol=1e-5)
+
+    # results are derived arrays, deleted when their inputs change
+    assert f.gas.is_derived_array('temp_sph_mean')
+    f.gas['temp'][0] = 2.0
+    assert 'temp_sph_mean' not in f.gas.keys()
+    assert 'vel_sph_mean' in f.gas.keys()
+    f.gas['mass'][0] = 2.0
+    assert 'vel_sph_mean' not in f.gas.keys()
+
+
+def test_neighbour_cache():
+    np.random.seed(1)
+    f = pynbody.new(gas=5000)
+    f['pos'] = np.random.normal(size=(len(f),3))
+    f['vel'] = np.random.normal(size=(len(f),3))
+    f['mass'] = np.random.uniform(size=len(f))
+    rho = f['rho'].copy()
+    v_disp = f['v_disp'].copy()
+    offsets, indices = f.kdtree.neighbour_lists()
+
+    for fmt in 'csr', 'delta':
+        f.kdtree.neighbour_cache = fmt
+        for repeat in range(2):
+            # the lists are stored on the first pass and read on the second
+            del f['rho'], f['v_disp']
+            npt.assert_allclose(f['rho'], rho, rtol=1e-6)
+            npt.assert_allclose(f['v_disp'], v_disp, rtol=1e-6)
+            assert f.kdtree._neighbours['format'] == fmt
+        cached_offsets, cached_indices = f.kdtree.neighbour_lists()
+        npt.assert_equal(cached_offsets, offsets)
+        for i in range(0, len(f), 100):
+            npt.assert_equal(np.sort(cached_indices[offsets[i]:offsets[i+1]]),
+                             np.sort(indices[offsets[i]:offsets[i+1]]))
+
+    # changing the smoothing lengths discards the stored lists
+    stored = f.kdtree._neighbours
+    f['smooth'] *= 1.1
+    del f['rho']
+    f['rho']
+    assert f.kdtree._neighbours is not stored
+
+
+def test_sph_derivatives():
+    # a jittered lattice in a periodic box, so that SPH derivative estimates
+    # are accurate everywhere including across the box boundary
+    np.random.seed(1)
+    n = 20
+    grid = (np.arange(n) + 0.5) / n - 0.5
+    f = pynbody.new(gas=n ** 3)
+    f['pos'] = np.array(np.meshgrid(grid, grid, grid)).reshape((3, -1)).T
+    f['pos'] += np.random.normal(scale=0.001, size=f['pos'].shape)
+    f['pos'].units = 'kpc'
+    f['mass'] = np.ones(len(f))
+    f['mass'].units = 'Msol'
+    f.properties['boxsize'] = pynbody.units.Unit("1 kpc")
+
+    k = 2 * np.pi
+    x, y, z = np.asarray(f['pos']).T
+    f['vel'] = np.array([np.sin(k * y), np.sin(k * z), np.sin(k * x)]).T
+    f['vel'].units = 'km s^-1'
+
+    assert f['v_div'].units == f['v_curl'].units == "km s^-1 kpc^-1"
+    assert abs(f['v_div']).max() < 0.1 * k
+    curl = -k * np.array([np.cos(k * z), np.cos(k * x), np.cos(k * y)]).T
+    npt.assert_allclose(f['v_curl'], curl, atol=0.1 * k)
+
+    f['vel'] = np.array([np.sin(k * x), np.sin(k * y), np.zeros(len(f))]).T
+    npt.assert_allclose(f['v_div'], k * (np.cos(k * x) + np.cos(k * y)), atol=0.1 * k)
+    assert abs(f['v_curl']).max() < 0.1 * k
+    assert f['rho_grad'].units == f['rho'].units / f['pos'].units
+    assert abs(f['rho_grad']).max() < 0.1 * np.asarray(f['rho']).mean() * k
+
+    # the result does not depend on the number of threads
+    nthreads = pynbody.config['number_of_threads']
+    try:
+        pynbody.config['number_of_threads'] = 3
+        npt.assert_equal(f.kdtree.sph_divergence(f['vel']), f['v_div'])
+    finally:
+        pynbody.config['number_of_threads'] = nthreads
+
 
 if __name__=="__main__":
     test_float_kd()
@@ -0,0 +1,43 @@
+import pynbody
+import numpy as np
+import numpy.testing as npt
+
+
+def setup():
+    global f
+    np.random.seed(1)
+    f = pynbody.new(gas=20000)
+    f['pos'] = np.random.uniform(-50, 50, size=(len(f), 3))
+    f['vel'] = np.random.normal(scale=50, size=(len(f), 3))
+    f['mass'] = 1.e5
+    f['temp'] = np.random.uniform(1.e4, 1.e5, size=len(f))
+    f['pos'].units = 'kpc'
+    f['vel'].units = 'km s^-1'
+    f['mass'].units = 'Msol'
+    f['temp'].units = 'K'
+
+
+def _brute_force_spectrum(x_los, y_los, vels):
+    kernel = pynbody.sph.Kernel2D()
+    samples = kernel.get_samples()
+    sm = f['smooth'].view(np.ndarray)
+    d2 = (f['x'].view(np.ndarray) - x_los) ** 2 + (f['y'].view(np.ndarray) - y_los) ** 2
+    use = d2 < (kernel.max_d * sm) ** 2
+    sm = sm[use]
+    column = samples[(len(samples) * d2[use] / (kernel.max_d * sm) ** 2).astype(int)] / sm ** 2 \
+        * f['mass'][use] * pynbody.units.Unit("Msol kpc^-2").ratio("m_p cm^-2")
+    b = np.sqrt(2 * 1.3806503e-16 * f['temp'][use] / 1.67262158e-24) / 1.e5
+    profile = np.exp(-((vels[:, np.newaxis] - f['vz'][use]) / b) ** 2) / (b * 1.e5)
+    e, mass_e, c = 4.803206e-10, 9.10938188e-28, 2.99792458e10
+    return np.asarray((profile * column).sum(axis=1)) * np.sqrt(3.14159267) * e * e / mass_e / c * 1031.9261 * 0.13250e-8
+
+
+def test_spectra_batch():
+    global f
+    sightlines = np.random.uniform(-40, 40, size=(100, 2))
+    for num_threads in 1, 3:
+        vels, tau = pynbody.sph.spectra_batch(f, sightlines, nvel=100, num_threads=num_threads)
+        assert tau.shape == (100, 100)
+        for j in 0, 50, 99:
+            npt.assert_allclose(tau[j], _brute_force_spectrum(sightlines[j, 0], sightlines[j, 1], vels),
+                                rtol=1.e-6, atol=1.e-6 * tau[j].max())
@@ -0,0 +1,60 @@
+import pynbody
+import numpy as np
+import numpy.testing as npt
+from pynbody.sph import _render
+
+
+def setup():
+    global f
+    np.random.seed(1)
+    f = pynbody.new(gas=5000)
+    f['pos'] = np.random.normal(size=(len(f), 3))
+    f['pos'].units = 'kpc'
+    f['mass'] = 1.0
+    f['mass'].units = 'Msol'
+
+
+def test_healpix_pixel_centres():
+    for nside in 1, 4, 32:
+        pix = np.arange(12 * nside ** 2, dtype=np.int64)
+        z, phi = _render.healpix_pix2ang(nside, pix)
+        npt.assert_equal(_render.healpix_ang2pix(nside, z, phi), pix)
+
+    # centres of the nside=1 base pixels
+    z, phi = _render.healpix_pix2ang(1, np.array([0, 4, 11], dtype=np.int64))
+    npt.assert_allclose(z, [2. / 3, 0, -2. / 3], atol=1e-12)
+    npt.assert_allclose(phi, [np.pi / 4, 0, 7 * np.pi / 4], atol=1e-12)
+
+
+def test_spherical_image_brute_force():
+    global f
+    nside = 16
+    kernel = pynbody.sph.Kernel2D()
+    im = pynbody.sph.render_spherical_image(f, nside=nside, distance=1.0, kernel=kernel,
+                                            denoise=False, threaded=False, approximate_fast=False)
+
+    # each particle is a series of nested discs, as set up in _render_spherical_image
+    ds = np.arange(0.5, kernel.max_d + 0.25, 0.5)
+    weights = np.array([2 * (np.array(map(kernel.get_value, np.arange(d - 0.5, d, 0.05)))
+                             * np.arange(d - 0.5, d, 0.05)).sum() * 0.05 / (d ** 2 - (d - 0.5) ** 2)
+                        for d in ds])
+    weights[:-1] -= weights[1:]
+
+    z, phi = _render.healpix_pix2ang(nside, np.arange(12 * nside ** 2, dtype=np.int64))
+    centres = np.array([np.sqrt(1 - z ** 2) * np.cos(phi), np.sqrt(1 - z ** 2) * np.sin(phi), z]).T
+    expected = np.zeros(len(z))
+    for i in np.where(f['r'] < 1.0)[0]:
+        cos_psi = np.dot(centres, f['pos'][i] / f['r'][i])
+        for d, w in zip(ds, weights):
+            inside = cos_psi > np.cos(np.arctan(f['smooth'][i] * d / f['r'][i]))
+            expected[inside] += w * f['mass'][i] / f['smooth'][i] ** 2
+
+    npt.assert_allclose(im, expected, rtol=1e-4, atol=1e-6 * expected.max())
+
+    im_threaded = pynbody.sph.render_spherical_image(f, nside=nside, distance=1.0, kernel=kernel,
+                                                     denoise=False, threaded=3, approximate_fast=False)
+    npt.assert_equal(im_threaded, im)
+
+    im_fast = pynbody.sph.render_spherical_image(f, nside=nside, distance=1.0, kernel=kernel,
+                                                 denoise=False, threaded=False, approximate_fast=True)
+    npt.assert_allclose(im_fast.sum(), im.sum(), rtol=1e-2)
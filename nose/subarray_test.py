@@ -53,4 +53,57 @@ def test_ndim_issue_399():
     assert f['blob_3d'].ndim==2
     assert f['blob_3d'].shape==(10,3)
     assert f_sub['blob_3d'].ndim==2
-    assert f_sub['blob_3d'].shape==(4,3)
\ No newline at end of file
+    assert f_sub['blob_3d'].shape==(4,3)
+
+def test_nested_views():
+    f = pynbody.new(dm=100, gas=100, star=50, order='gas,dm,star')
+    f['blob'] = np.arange(250)
+    f.gas['gblob'] = np.arange(100) * 2
+
+    index = np.arange(250)
+    for view, view_index in [(f[10:240:3][f[10:240:3]['blob'] % 2 == 0].gas[[0, 2, 3, 5]],
+                              index[10:240:3][index[10:240:3] % 2 == 0][[0, 2, 3, 5]]),
+                             (f[::2].gas[5:30][[1, 4, 9]][1:],
+                              index[::2][5:30][[1, 4, 9]][1:]),
+                             (f[[3, 150, 210, 220, 245]][1:][::2],
+                              index[[3, 150, 210, 220, 245]][1:][::2])]:
+        assert (view['blob'] == view_index).all()
+        assert (view.get_index_list(f) == view_index).all()
+        assert (view.get_index_list(view.base) == view.base.get_index_list(f).searchsorted(view_index)).all()
+
+    # family arrays and writes go straight through to the ancestor
+    view = f[::2].gas[5:30][[1, 4, 9]]
+    assert (view['gblob'] == [24, 36, 56]).all()
+    view['blob'] = -1
+    view['gblob'] = -2
+    assert (f['blob'][[12, 18, 28]] == -1).all() and (f['blob'] == -1).sum() == 3
+    assert (f.gas['gblob'][[12, 18, 28]] == -2).all() and (f.gas['gblob'] == -2).sum() == 3
+
+def test_gather_cache():
+    f = pynbody.new(dm=100, gas=100, order='gas,dm')
+    f['pos'] = np.random.uniform(size=(200, 3))
+    f.gas['temp'] = np.arange(100.)
+    h = f[[1, 5, 20, 150, 160]]
+    h.set_gather_cache(10)
+
+    # repeated reads reuse a read-only copy
+    pos = np.asarray(h['pos'])
+    assert np.asarray(h['pos']).__array_interface__['data'] == pos.__array_interface__['data']
+    assert not pos.flags['WRITEABLE']
+    assert (pos == f['pos'][[1, 5, 20, 150, 160]]).all()
+
+    # changes to the array, from either side, discard the copy
+    f['pos'] += 1
+    assert (h['pos'] == f['pos'][[1, 5, 20, 150, 160]]).all()
+    h['x'][0] = -1
+    assert h['pos'][0][0] == -1
+    assert (np.asarray(h.gas['temp']) == [1, 5, 20]).all()
+    f.gas['temp'][5] = -1
+    assert (h.gas['temp'] == [1, -1, 20]).all()
+
+    # least recently used copies are discarded to keep within the limit
+    h.set_gather_cache(5 * 3 * 8 / 2. ** 20)
+    np.asarray(h['pos'])
+    np.asarray(h['x'])
+    assert h._gather_cache.nbytes <= 5 * 3 * 8
+    assert (h['x'] == h['pos'][:, 0]).all()
@@ -357,4 +357,64 @@ def test_issue_313():
 
 
 def test_issue_315():
-    assert np.allclose(f.g['cs'][:3], [187.36890472,  210.86151107,  176.04044173])
\ No newline at end of file
+    assert np.allclose(f.g['cs'][:3], [187.36890472,  210.86151107,  176.04044173])
+
+
+def _is_memory_mapped(ar):
+    while ar is not None:
+        if isinstance(ar, np.memmap):
+            return True
+        ar = ar.base
+    return False
+
+
+def test_mmap():
+    # the test file is big-endian, so cannot be memory-mapped; make a
+    # native-endian copy of it
+    f_ref = pynbody.load("testdata/g15784.lr.01024")
+    f_native = pynbody.new(gas=len(f_ref.gas), dm=len(f_ref.dm), star=len(f_ref.star), order='gas,dm,star')
+    f_native._byteswap = False
+    f_native.properties['a'] = f_ref.properties['a']
+    for k in 'pos', 'vel', 'mass', 'eps', 'phi':
+        f_native[k] = f_ref[k]
+    for k in 'rho', 'temp', 'metals':
+        f_native.gas[k] = f_ref.gas[k]
+    for k in 'tform', 'metals':
+        f_native.star[k] = f_ref.star[k]
+
+    filename = "testdata/test_mmap.tipsy"
+    f_native.write(fmt=pynbody.tipsy.TipsySnap, filename=filename)
+
+    try:
+        with open(filename, 'rb') as f_disk:
+            on_disk = f_disk.read()
+
+        f_mmap = pynbody.load(filename, mmap=True)
+        f_copy = pynbody.load(filename)
+        assert f_mmap._mmap
+
+        for k in 'pos', 'vel', 'mass', 'eps', 'phi':
+            assert _is_memory_mapped(f_mmap.dm[k])
+            assert (f_mmap.dm[k] == f_copy.dm[k]).all()
+            assert f_mmap.dm[k].units == f_copy.dm[k].units
+
+        # (values are compared without units, since the memory-mapped arrays
+        # keep the float32 type of the file)
+        assert (np.asarray(f_mmap.gas['rho']) == np.asarray(f_copy.gas['rho'])).all()
+        assert (np.asarray(f_mmap.star['tform']) == np.asarray(f_copy.star['tform'])).all()
+        assert str(f_mmap.star['tform'].units) == str(f_copy.star['tform'].units)
+
+        # snapshot-level access must still work across all families
+        assert (f_mmap['pos'] == f_copy['pos']).all()
+        assert (f_mmap['mass'] == f_copy['mass']).all()
+
+        # changes made in memory must not reach the file
+        f_mmap.physical_units()
+        f_copy.physical_units()
+        assert np.allclose(f_mmap.gas['rho'], f_copy.gas['rho'], rtol=1e-6)
+        assert np.allclose(f_mmap.dm['vel'], f_copy.dm['vel'], rtol=1e-6)
+        assert str(f_mmap.dm['vel'].units) == str(f_copy.dm['vel'].units)
+        with open(filename, 'rb') as f_disk:
+            assert f_disk.read() == on_disk
+    finally:
+        os.remove(filename)
@@ -148,6 +148,8 @@ from .backcompat import property
 from .backcompat import fractions
 import atexit
 import functools
+import threading
+from . import backcompat
 
 
 class SimArray(np.ndarray):
@@ -837,8 +839,76 @@ def _comparison_units(*a):
     return None
 
 
+class GatherCache(object):
+
+    """Holds contiguous copies of arrays gathered through an index, so
+    that repeated reads of an :class:`IndexedSimArray` do not repeat the
+    gather. Once the copies take more than *max_megabytes*, the least
+    recently used are discarded.
+
+    A copy is reused only while the underlying array and the index are the
+    same objects as when it was made; copies of a named array are also
+    discarded by :meth:`discard`, which the snapshot calls whenever the
+    array is marked as changed. The copies are read-only."""
+
+    def __init__(self, max_megabytes):
+        self.max_bytes = int(max_megabytes * 2 ** 20)
+        self.nbytes = 0
+        self._arrays = backcompat.OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _owner(ar):
+        while isinstance(ar.base, np.ndarray):
+            ar = ar.base
+        return ar
+
+    def get(self, key, base, index):
+        """Return base[index], from the cache if possible, storing it
+        under *key* (a tuple starting with the array name) otherwise"""
+        owner = self._owner(base)
+        with self._lock:
+            entry = self._arrays.pop(key, None)
+            if entry is not None:
+                owner_ref, cached_index, layout, data = entry
+                if owner_ref() is owner and cached_index is index and \
+                   layout == (base.__array_interface__['data'][0], base.strides, base.shape, base.dtype):
+                    self._arrays[key] = entry
+                    return data
+                self.nbytes -= data.nbytes
+
+        data = base[index]
+        data.flags['WRITEABLE'] = False
+
+        if data.nbytes <= self.max_bytes:
+            with self._lock:
+                if key in self._arrays:
+                    self.nbytes -= self._arrays.pop(key)[-1].nbytes
+                layout = (base.__array_interface__['data'][0], base.strides, base.shape, base.dtype)
+                self._arrays[key] = (weakref.ref(owner), index, layout, data)
+                self.nbytes += data.nbytes
+                while self.nbytes > self.max_bytes:
+                    self.nbytes -= self._arrays.popitem(last=False)[1][-1].nbytes
+
+        return data
+
+    def discard(self, names):
+        """Discard the copies of the named arrays"""
+        with self._lock:
+            for key in [k for k in self._arrays if k[0] in names]:
+                self.nbytes -= self._arrays.pop(key)[-1].nbytes
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+
 class IndexedSimArray(object):
 
+    # set by the snapshot to (GatherCache, key) if reads should be cached
+    _gather_cache = None
+
     @property
     def derived(self):
         return self.base.derived
@@ -852,6 +922,12 @@ class IndexedSimArray(object):
         self._ptr = ptr
 
     def __array__(self, dtype=None):
+        if self._gather_cache is not None:
+            cache, key = self._gather_cache
+            data = cache.get(key, self.base, self._ptr).view()
+            if hasattr(self.base, 'units'):
+                data.units = self.base.units
+            return np.asanyarray(data, dtype=dtype)
         return np.asanyarray(self.base[self._ptr], dtype=dtype)
 
     def _reexpress_index(self, index):
@@ -77,6 +77,9 @@ def _get_basic_config_from_parser(config_parser):
     if config['number_of_threads']<0:
         config['number_of_threads']=multiprocessing.cpu_count()
 
+    config['gather-cache-megabytes'] = config_parser.getfloat('general', 'gather-cache-megabytes')
+    config['derive-block-size'] = config_parser.getint('general', 'derive-block-size')
+
     config['gravity_calculation_mode'] = config_parser.get(
         'general', 'gravity_calculation_mode')
     config['disk-fit-function'] = config_parser.get('general', 'disk-fit-function')
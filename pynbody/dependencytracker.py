@@ -54,3 +54,15 @@ class DependencyTracker(object):
 
     def get_dependents(self, name):
         return self._dependencies.get(name, set())
+
+    def get_all_dependents(self, names):
+        """Return the set of names depending on any of *names*, either
+        directly or through intermediates"""
+        result = set()
+        pending = list(names)
+        while pending:
+            for other in self.get_dependents(pending.pop()):
+                if other not in result:
+                    result.add(other)
+                    pending.append(other)
+        return result
@@ -23,49 +23,49 @@ import functools
 logger = logging.getLogger('pynbody.derived')
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def r(self):
     """Radial position"""
     return ((self['pos'] ** 2).sum(axis=1)) ** (1, 2)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def rxy(self):
     """Cylindrical radius in the x-y plane"""
     return ((self['pos'][:, 0:2] ** 2).sum(axis=1)) ** (1, 2)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def vr(self):
     """Radial velocity"""
     return (self['pos'] * self['vel']).sum(axis=1) / self['r']
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def v2(self):
     """Squared velocity"""
     return (self['vel'] ** 2).sum(axis=1)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def vt(self):
     """Tangential velocity"""
     return np.sqrt(self['v2'] - self['vr'] ** 2)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def ke(self):
     """Specific kinetic energy"""
     return 0.5 * (self['vel'] ** 2).sum(axis=1)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def te(self):
     """Specific total energy"""
     return self['ke'] + self['phi']
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def j(self):
     """Specific angular momentum"""
     angmom = np.cross(self['pos'], self['vel']).view(array.SimArray)
@@ -73,25 +73,25 @@ def j(self):
     return angmom
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def j2(self):
     """Square of the specific angular momentum"""
     return (self['j'] ** 2).sum(axis=1)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def jz(self):
     """z-component of the angular momentum"""
     return self['j'][:, 2]
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def vrxy(self):
     """Cylindrical radial velocity in the x-y plane"""
     return (self['pos'][:, 0:2] * self['vel'][:, 0:2]).sum(axis=1) / self['rxy']
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def vcxy(self):
     """Cylindrical tangential velocity in the x-y plane"""
     f = (self['x'] * self['vy'] - self['y'] * self['vx']) / self['rxy']
@@ -99,13 +99,13 @@ def vcxy(self):
     return f
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def vphi(self):
     """Azimuthal velocity (synonym for vcxy)"""
     return self['vcxy']
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def vtheta(self):
     """Velocity projected to polar direction"""
     return (np.cos(self['az']) * np.cos(self['theta']) * self['vx'] +
@@ -173,6 +173,38 @@ def v_disp(self):
     return sm
 
 
+def _sph_derivative(self, method, name):
+    import sph
+
+    sph.build_tree(self)
+    nsmooth = config['sph']['smooth-particles']
+    self['rho']
+
+    self.kdtree.set_array_ref('rho',self['rho'])
+    self.kdtree.set_array_ref('smooth',self['smooth'])
+    self.kdtree.set_array_ref('mass',self['mass'])
+
+    return getattr(self.kdtree, method)(self[name], nsmooth)
+
+
+@SimSnap.derived_quantity
+def v_div(self):
+    """SPH estimate of the velocity divergence"""
+    return _sph_derivative(self, 'sph_divergence', 'vel')
+
+
+@SimSnap.derived_quantity
+def v_curl(self):
+    """SPH estimate of the velocity curl (vorticity)"""
+    return _sph_derivative(self, 'sph_curl', 'vel')
+
+
+@SimSnap.derived_quantity
+def rho_grad(self):
+    """SPH estimate of the density gradient"""
+    return _sph_derivative(self, 'sph_gradient', 'rho')
+
+
 @SimSnap.derived_quantity
 def age(self):
     """Stellar age determined from formation time and current snapshot time"""
@@ -201,19 +233,19 @@ for band in bands_available:
     SimSnap.derived_quantity(lum_den)
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def theta(self):
     """Angle from the z axis, from [0:2pi]"""
     return np.arccos(self['z'] / self['r'])
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def alt(self):
     """Angle from the horizon, from [-pi/2:pi/2]"""
     return np.pi / 2 - self['theta']
 
 
-@SimSnap.derived_quantity
+@SimSnap.local_derived_quantity
 def az(self):
     """Angle in the xy plane from the x axis, from [-pi:pi]"""
     return np.arctan2(self['y'], self['x'])
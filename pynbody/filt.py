@@ -29,6 +29,17 @@ class Filter(object):
     def __call__(self, sim):
         return np.ones(len(sim), dtype=bool)
 
+    def intersects_boxes(self, lower, upper, pos_units=None, context={}, boxsize=None):
+        """Return a boolean array flagging which of the axis-aligned boxes with
+        corners *lower* and *upper* (each Nx3, in units *pos_units*) may contain
+        particles passing this filter. *context* is the conversion context
+        for the units and *boxsize* (if not None) the periodic box length.
+
+        The test is conservative: a box may be flagged even if no particle in
+        it passes, but never the other way round. Filters which cannot say
+        anything about positions flag every box."""
+        return np.ones(len(lower), dtype=bool)
+
     def __and__(self, f2):
         return And(self, f2)
 
@@ -86,6 +97,9 @@ class And(Filter):
     def __call__(self, sim):
         return self.f1(sim) * self.f2(sim)
 
+    def intersects_boxes(self, *args, **kwargs):
+        return self.f1.intersects_boxes(*args, **kwargs) * self.f2.intersects_boxes(*args, **kwargs)
+
     def __repr__(self):
         return "(" + repr(self.f1) + " & " + repr(self.f2) + ")"
 
@@ -100,6 +114,9 @@ class Or(Filter):
     def __call__(self, sim):
         return self.f1(sim) + self.f2(sim)
 
+    def intersects_boxes(self, *args, **kwargs):
+        return self.f1.intersects_boxes(*args, **kwargs) + self.f2.intersects_boxes(*args, **kwargs)
+
     def __repr__(self):
         return "(" + repr(self.f1) + " | " + repr(self.f2) + ")"
 
@@ -164,6 +181,25 @@ class Sphere(Filter):
             cen = cen.in_units(pos.units)
         return _util._sphere_selection(np.asarray(pos),np.asarray(cen,dtype=pos.dtype),radius,wrap)
 
+    def intersects_boxes(self, lower, upper, pos_units=None, context={}, boxsize=None):
+        radius = self.radius
+        if units.is_unit_like(radius):
+            radius = float(radius.in_units(pos_units, **context))
+
+        cen = self.cen
+        if units.has_units(cen):
+            cen = cen.in_units(pos_units, **context)
+        cen = np.asarray(cen, dtype=np.float64)
+
+        # per-axis distance from the centre to each box, taking the nearest
+        # periodic image if required
+        delta = np.maximum(np.maximum(lower - cen, cen - upper), 0)
+        if boxsize is not None:
+            for offset in -boxsize, boxsize:
+                delta = np.minimum(delta, np.maximum(np.maximum(lower - cen - offset, cen + offset - upper), 0))
+
+        return (delta ** 2).sum(axis=1) <= radius ** 2
+
 
     def __repr__(self):
         if units.is_unit(self.radius):
@@ -206,6 +242,14 @@ class Cuboid(Filter):
 
         return ((sim["x"] > x1) * (sim["x"] < x2) * (sim["y"] > y1) * (sim["y"] < y2) * (sim["z"] > z1) * (sim["z"] < z2))
 
+    def intersects_boxes(self, lower, upper, pos_units=None, context={}, boxsize=None):
+        x1, y1, z1, x2, y2, z2 = [float(x.in_units(pos_units, **context))
+                                  if units.is_unit_like(x) else x
+                                  for x in self.x1, self.y1, self.z1, self.x2, self.y2, self.z2]
+
+        return ((upper[:, 0] > x1) * (lower[:, 0] < x2) * (upper[:, 1] > y1) * (lower[:, 1] < y2) *
+                (upper[:, 2] > z1) * (lower[:, 2] < z2))
+
     def __repr__(self):
         x1, y1, z1, x2, y2, z2 = ["'%s'" % str(x)
                                   if units.is_unit_like(x) else x
@@ -25,11 +25,21 @@ from array import SimArray
 import gzip
 import logging
 import struct
+import hashlib
+import math
 from . import snapshot, util, config, config_parser, units
 from .snapshot import gadget
 
 logger = logging.getLogger("pynbody.halo")
 
+
+def _array_checksum(ar, chunk_size=2 ** 20):
+    checksum = hashlib.md5()
+    for i in xrange(0, len(ar), chunk_size):
+        checksum.update(np.ascontiguousarray(ar[i:i + chunk_size]).data)
+    return checksum.hexdigest()
+
+
 class DummyHalo(object):
 
     def __init__(self):
@@ -164,6 +174,117 @@ class HaloCatalogue(object):
         the smallest subhalo."""
         raise NotImplementedError
 
+    def _get_sorted_group_index(self):
+        """Return (halo_ids, index, offsets), such that the particles in halo
+        halo_ids[i] are index[offsets[i]:offsets[i+1]]. Only halos with at
+        least one particle are included."""
+        grp = np.asarray(self.get_group_array())
+        index = np.argsort(grp, kind='mergesort')
+        index = index[np.searchsorted(grp[index], 0):]  # negative values mean no halo
+        halo_ids, offsets = np.unique(grp[index], return_index=True)
+        return halo_ids, index, np.append(offsets, len(index))
+
+    def compute_properties(self, properties=('mass', 'com', 'com_vel', 'vel_disp'), overden=178):
+        """Calculate properties of all halos in the catalogue at once, using
+        one pass over the particles rather than a loop over the halos.
+
+        **Input**
+
+        *properties*: a list of the properties to calculate; available
+         properties are
+
+          - *n_particles*: the number of particles
+          - *mass*: the total mass
+          - *com*: the centre of mass
+          - *com_vel*: the centre of mass velocity
+          - *vel_disp*: the mass-weighted 3D velocity dispersion about *com_vel*
+          - *r_vir*: the radius of the outermost sphere around *com* which
+            contains a mean density of overden * rho_M_0 * (1+z)^3
+            (see :func:`pynbody.analysis.halo.virial_radius`)
+
+        *overden* (178): the overdensity defining *r_vir*
+
+        **Returns**
+
+        A dictionary mapping each property name, and *halo_id*, to an
+        array with one entry per halo.
+        """
+        for p in properties:
+            if p not in ('n_particles', 'mass', 'com', 'com_vel', 'vel_disp', 'r_vir'):
+                raise ValueError("Unknown halo property %r" % p)
+
+        base = self.base
+        halo_ids, index, offsets = self._get_sorted_group_index()
+        n_halos = len(halo_ids)
+        counts = np.diff(offsets)
+        label = np.repeat(np.arange(n_halos), counts)
+
+        def segment_sum(values):
+            return np.bincount(label, weights=values, minlength=n_halos)
+
+        def segment_mean(values, weights, total_weight):
+            return np.array([segment_sum(values[:, k] * weights) for k in range(values.shape[1])]).T \
+                / total_weight[:, np.newaxis]
+
+        result = {'halo_id': halo_ids}
+        if 'n_particles' in properties:
+            result['n_particles'] = counts
+
+        mass = np.asarray(base['mass'])[index]
+        total_mass = segment_sum(mass)
+        if 'mass' in properties:
+            result['mass'] = SimArray(total_mass, base['mass'].units)
+
+        if set(['com', 'r_vir']).intersection(properties):
+            pos = np.asarray(base['pos'])[index]
+            com = segment_mean(pos, mass, total_mass)
+            if 'com' in properties:
+                result['com'] = SimArray(com, base['pos'].units)
+
+        if set(['com_vel', 'vel_disp']).intersection(properties):
+            vel = np.asarray(base['vel'])[index]
+            com_vel = segment_mean(vel, mass, total_mass)
+            if 'com_vel' in properties:
+                result['com_vel'] = SimArray(com_vel, base['vel'].units)
+            if 'vel_disp' in properties:
+                dv2 = ((vel - com_vel[label]) ** 2).sum(axis=1)
+                result['vel_disp'] = SimArray(np.sqrt(segment_sum(dv2 * mass) / total_mass),
+                                              base['vel'].units)
+            del vel
+
+        if 'r_vir' in properties:
+            from .analysis import cosmology
+            target_rho = overden * base.properties["omegaM0"] * \
+                cosmology.rho_crit(base, z=0, unit=base['mass'].units / base['pos'].units ** 3) * \
+                (1.0 + base.properties["z"]) ** 3
+
+            # sort by radius within each halo, then find the last particle
+            # inside which the mean density exceeds the target
+            r = np.sqrt(((pos - com[label]) ** 2).sum(axis=1))
+            del pos
+            # (the particles are already grouped by halo, so sorting on the
+            # halo label plus the radius scaled into [0,1) is much faster than
+            # a lexsort; only radii within ~1e-10 r_max of each other may swap)
+            r_scale = np.maximum.reduceat(r, offsets[:-1]) * (1. + 1.e-6) if n_halos else r
+            r_scale[r_scale == 0] = 1.0
+            order = np.argsort(label + r / r_scale[label])
+            r = r[order]
+            enclosed_mass = np.cumsum(mass[order])
+            enclosed_mass -= np.append(0, enclosed_mass[offsets[1:-1] - 1])[label]
+            dense = np.where(enclosed_mass >= target_rho * (4. * math.pi / 3) * r ** 3)[0]
+
+            dense_label = label[dense]
+            last = np.append(np.where(np.diff(dense_label) != 0)[0], len(dense) - 1)
+            r_vir = np.zeros(n_halos)
+            # between particles the enclosed mass is constant, so the density
+            # falls to the target at a radius determined by the enclosed mass
+            if len(dense) > 0:
+                r_vir[dense_label[last]] = (3 * enclosed_mass[dense[last]] /
+                                            (4. * math.pi * target_rho)) ** (1. / 3)
+            result['r_vir'] = SimArray(r_vir, base['pos'].units)
+
+        return result
+
     @staticmethod
     def _can_load(self):
         return False
@@ -1470,13 +1591,22 @@ class GrpCatalogue(HaloCatalogue):
     """
     A generic catalogue using a .grp file to specify which particles
     belong to which group.
+
+    Halos are initially found with a scan of the group array. Once more
+    than a few halos have been retrieved, the particles are sorted by
+    group once (see :func:`precalculate`) and later halos are looked up
+    directly.
     """
     def __init__(self, sim, array='grp', ignore=None, **kwargs):
         sim[array] # trigger lazy-loading and/or kick up a fuss if unavailable
         self._halos = {}
         self._array = array
         self._sorted = None
+        self._offsets = None
         self._ignore = ignore
+        self._n_lookups = 0
+        self._precalculate_after = config_parser.getint('GrpCatalogue', 'AutoPrecalculate')
+        self._persistent_index = config_parser.getboolean('GrpCatalogue', 'PersistentIndex')
         HaloCatalogue.__init__(self,sim)
 
     def __len__(self):
@@ -1493,11 +1623,58 @@ class GrpCatalogue(HaloCatalogue):
     def precalculate(self):
         """Speed up future operations by precalculating the indices
         for all halos in one operation. This is slow compared to
-        getting a single halo, however."""
-        self._sorted = np.argsort(
-            self.base[self._array], kind='mergesort')  # mergesort for stability
-        self._boundaries = util.find_boundaries(
-            self.base[self._array][self._sorted])
+        getting a single halo, however.
+
+        This happens automatically once more than a few halos have been
+        retrieved."""
+        index_filename = self._index_filename()
+        if self._persistent_index:
+            checksum = _array_checksum(self.base[self._array])
+            if self._load_index(index_filename, checksum):
+                return
+
+        grp = self.base[self._array]
+        self._sorted = np.argsort(grp, kind='mergesort')  # mergesort for stability
+
+        # halo i consists of the particles self._sorted[self._offsets[i]:self._offsets[i+1]]
+        self._offsets = np.searchsorted(grp[self._sorted], np.arange(len(self) + 2))
+
+        if self._persistent_index:
+            self._save_index(index_filename, checksum)
+
+    def _index_filename(self):
+        """Return the name of the file in which the halo index is stored, or
+        None if the catalogue is not associated with a file on disk"""
+        base = self.base
+        if base is not base.ancestor or not os.path.exists(base.filename):
+            return None
+        return os.path.normpath(base.filename) + "." + self._array + ".index.npz"
+
+    def _load_index(self, filename, checksum):
+        if filename is None or not os.path.exists(filename):
+            return False
+        try:
+            with np.load(filename) as stored:
+                if str(stored['checksum']) != checksum or \
+                        int(stored['n_particles']) != len(self.base):
+                    logger.info("Stored halo index in %s is out of date" % filename)
+                    return False
+                self._sorted = stored['sorted']
+                self._offsets = stored['offsets']
+            return True
+        except (IOError, KeyError, ValueError):
+            logger.warn("Unable to read stored halo index from %s" % filename)
+            return False
+
+    def _save_index(self, filename, checksum):
+        if filename is None:
+            return
+        try:
+            np.savez(filename, sorted=self._sorted, offsets=self._offsets,
+                     checksum=checksum, n_particles=len(self.base))
+            logger.info("Halo index stored in %s" % filename)
+        except (IOError, OSError):
+            logger.warn("Unable to store halo index in %s" % filename)
 
     def get_group_array(self, family=None):
         if family is not None:
@@ -1505,34 +1682,40 @@ class GrpCatalogue(HaloCatalogue):
         else:
             return self.base[self._array]
 
+    def _get_sorted_group_index(self):
+        if self._sorted is None:
+            self.precalculate()
+        offsets = self._offsets
+        index = self._sorted[offsets[0]:offsets[-1]]
+        counts = np.diff(offsets)
+        if self._ignore is not None and 0 <= self._ignore < len(counts):
+            ignored = slice(offsets[self._ignore] - offsets[0], offsets[self._ignore + 1] - offsets[0])
+            index = np.concatenate((index[:ignored.start], index[ignored.stop:]))
+            counts[self._ignore] = 0
+        halo_ids = np.where(counts > 0)[0]
+        return halo_ids, index, np.append(0, np.cumsum(counts[halo_ids]))
+
     def _get_halo_indices(self, i):
         if self.base is None:
             raise RuntimeError("Parent SimSnap has been deleted")
 
         no_exist = ValueError("Halo %s does not exist" % (str(i)))
 
+        if self._sorted is None:
+            self._n_lookups += 1
+            if self._n_lookups > self._precalculate_after:
+                self.precalculate()
+
         if self._sorted is None:
             # one-off selection
             index = np.where(self.base[self._array] == i)
             return index
         else:
             # pre-calculated
-            if i >= len(self._boundaries) or i < 0:
-                raise no_exist
-            if self._boundaries[i] < 0:
+            if i >= len(self._offsets) - 1 or i < 0:
                 raise no_exist
 
-            start = self._boundaries[i]
-            if start is None:
-                raise no_exist
-
-            end = None
-            j = i + 1
-            while j < len(self._boundaries) and end is None:
-                end = self._boundaries[j]
-                j += 1
-
-            return self._sorted[start:end]
+            return self._sorted[self._offsets[i]:self._offsets[i + 1]]
 
 
     def _get_halo(self, i):
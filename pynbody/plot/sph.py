@@ -280,7 +280,7 @@ def image(sim, qty='rho', width="10 kpc", resolution=500, units=None, log=True,
           z_camera=None, clear=True, cmap=None,
           title=None, qtytitle=None, show_cbar=True, subplot=False,
           noplot=False, ret_im=False, fill_nan=True, fill_val=0.0, linthresh=None,
-          **kwargs):
+          image_cache=None, **kwargs):
     """
 
     Make an SPH image of the given simulation.
@@ -339,6 +339,11 @@ def image(sim, qty='rho', width="10 kpc", resolution=500, units=None, log=True,
     *linthresh* (None): if the image has negative and positive values
      and a log scaling is requested, the part between `-linthresh` and
      `linthresh` is shown on a linear scale to avoid divergence at 0
+
+    *image_cache* (None): a :class:`pynbody.sph.ImagePyramid` for ``sim``;
+     if set, the image is assembled from its cached tiles, so that repeated
+     calls while panning and zooming only render the parts not seen before.
+     Not used for perspective or line-of-sight averaged images.
     """
 
     if not noplot:
@@ -418,6 +423,10 @@ def image(sim, qty='rho', width="10 kpc", resolution=500, units=None, log=True,
 
             im = im / im2
 
+    elif image_cache is not None and z_camera is None:
+        im = image_cache.render_image(qty, width / 2, resolution, out_units=units,
+                                      kernel=kernel, **kwargs)
+
     else:
         im = sph.render_image(sim, qty, width / 2, resolution, out_units=units,
                               kernel=kernel,  z_camera=z_camera, **kwargs)
@@ -180,6 +180,10 @@ class SimSnap(object):
         self._dependency_tracker = dependencytracker.DependencyTracker()
         self._immediate_cache_lock = threading.RLock()
 
+        # gather caches of views of this snapshot, which must be told
+        # when arrays change
+        self._gather_caches = weakref.WeakSet()
+
         self._persistent_objects = {}
 
         self._unifamily = None
@@ -836,6 +840,15 @@ class SimSnap(object):
         from .. import bridge
         return bridge.bridge_factory(self, other)
 
+    def sph_smooth(self, names, dispersion=False):
+        """Calculate the SPH-smoothed means (or dispersions) of several
+        arrays in a single neighbour search, storing them as derived arrays
+        name+'_sph_mean' (or name+'_sph_disp').
+
+        This calls :func:`pynbody.sph.sph_smooth`; see there for details."""
+        from .. import sph
+        return sph.sph_smooth(self, names, dispersion)
+
     def load_copy(self):
         """Tries to load a copy of this snapshot, using partial loading to select
         only a subset of particles corresponding to a given SubSnap"""
@@ -1425,6 +1438,17 @@ class SimSnap(object):
             SimSnap._derived_quantity_registry[cl] = {}
         SimSnap._derived_quantity_registry[cl][fn.__name__] = fn
         fn.__stable__ = False
+        fn.__local__ = False
+        return fn
+
+    @classmethod
+    def local_derived_quantity(cl, fn):
+        """Register a derived quantity whose value for each particle depends
+        only on the values of other arrays for the same particle. Such
+        quantities can be evaluated a block of particles at a time, without
+        storing their intermediates (see :meth:`derive_arrays`)."""
+        cl.derived_quantity(fn)
+        fn.__local__ = True
         return fn
 
     @classmethod
@@ -1433,6 +1457,7 @@ class SimSnap(object):
             SimSnap._derived_quantity_registry[cl] = {}
         SimSnap._derived_quantity_registry[cl][fn.__name__] = fn
         fn.__stable__ = True
+        fn.__local__ = False
 
         return fn
 
@@ -1455,37 +1480,20 @@ class SimSnap(object):
 
         calculated = False
         fn = self._find_deriving_function(name)
-        if fn:
+        if fn and self._derive_in_blocks(fn, fam):
+            logger.info("Deriving array %s in blocks" % name)
+            leaves = self._derive_arrays_in_chunks([name], fam, config['derive-block-size'])
+            for leaf in leaves[name]:
+                self._dependency_tracker.touching(leaf)
+        elif fn:
             logger.info("Deriving array %s" % name)
             with self.auto_propagate_off:
                 if fam is None:
                     result = fn(self)
-                    ndim = result.shape[-1] if len(
-                        result.shape) > 1 else 1
-                    self._create_array(
-                        name, ndim, dtype=result.dtype, derived=not fn.__stable__)
-                    write_array = self._get_array(
-                        name, always_writable=True)
                 else:
                     result = fn(self[fam])
-                    ndim = result.shape[-1] if len(
-                        result.shape) > 1 else 1
-
-                    # check if a family array already exists with a different dtype
-                    # if so, cast the result to the existing dtype
-                    # numpy version < 1.7 does not support doing this in-place
 
-                    if self._get_preferred_dtype(name) != result.dtype \
-                       and self._get_preferred_dtype(name) is not None:
-                        if int(np.version.version.split('.')[1]) > 6 :
-                            result = result.astype(self._get_preferred_dtype(name),copy=False)
-                        else :
-                            result = result.astype(self._get_preferred_dtype(name))
-
-                    self[fam]._create_array(
-                        name, ndim, dtype=result.dtype, derived=not fn.__stable__)
-                    write_array = self[fam]._get_array(
-                        name, always_writable=True)
+                write_array = self._create_derived_array(name, fam, result, fn)
 
                 self.ancestor._autoconvert_array_unit(result)
 
@@ -1493,15 +1501,113 @@ class SimSnap(object):
                 if units.has_units(result):
                     write_array.units = result.units
 
+    def _derive_in_blocks(self, fn, fam):
+        """Return True if the quantity calculated by *fn* should be derived
+        a block of particles at a time"""
+        target = self if fam is None else self[fam]
+        return getattr(fn, '__local__', False) and config['derive-block-size'] > 0 and len(target) > 0
 
+    def _create_derived_array(self, name, fam, result, fn):
+        """Create the array to hold the derived quantity *name*, shaped like
+        *result*, and return it in writable form"""
+        ndim = result.shape[-1] if len(result.shape) > 1 else 1
+        if fam is None:
+            self._create_array(
+                name, ndim, dtype=result.dtype, derived=not fn.__stable__)
+            return self._get_array(name, always_writable=True)
+        else:
+            # if a family array already exists with a different dtype,
+            # the new family array must take the existing dtype
+            dtype = self._get_preferred_dtype(name)
+            if dtype is None:
+                dtype = result.dtype
+            self[fam]._create_array(
+                name, ndim, dtype=dtype, derived=not fn.__stable__)
+            return self[fam]._get_array(name, always_writable=True)
+
+    def derive_arrays(self, names, fam=None, chunk_size=None):
+        """Derive several arrays together, e.g. ``f.derive_arrays(['vr', 'vt', 'jz'])``.
+
+        Quantities registered with
+        :meth:`~pynbody.snapshot.SimSnap.local_derived_quantity` are evaluated
+        in a single pass over blocks of *chunk_size* particles (by default,
+        the derive-block-size option in the config file; 0 means all
+        particles in one block). Intermediate quantities (such as ``r`` or
+        ``j`` in the example) are calculated once per block, shared between
+        the requested arrays and then discarded, so that they never take up
+        memory for the whole snapshot. Other quantities are derived in the
+        usual way.
+
+        If *fam* is not None, derive only for the specified family."""
+
+        target = self if fam is None else self[fam]
+        if chunk_size is None:
+            chunk_size = config['derive-block-size']
+        if chunk_size <= 0:
+            chunk_size = len(target)
+        names = [name for name in names if name not in target.keys()]
+        local = [name for name in names if len(target) > 0
+                 and name not in target.loadable_keys()
+                 and getattr(self._find_deriving_function(name), '__local__', False)]
+
+        for name in names:
+            if name not in local:
+                target[name]
+
+        if not local:
+            return
 
-
+        leaves = self._derive_arrays_in_chunks(local, fam, chunk_size)
+
+        # record the dependencies that would have been recorded by deriving
+        # each array separately
+        tracker = self._dependency_tracker
+        for name in local:
+            with tracker.calculating(name):
+                for leaf in leaves[name]:
+                    tracker.touching(leaf)
+
+    def _derive_arrays_in_chunks(self, names, fam, chunk_size):
+        """Derive the local quantities *names*, one block of particles at a
+        time, and return a dictionary mapping each name to the set of
+        stored arrays that it depends on"""
+        target = self if fam is None else self[fam]
+        write_arrays = {}
+
+        with self.auto_propagate_off:
+            for start in xrange(0, len(target), chunk_size):
+                chunk = _DerivationChunk(self, fam, start, min(start + chunk_size, len(target)), names)
+                for name in names:
+                    result = chunk[name]
+                    self.ancestor._autoconvert_array_unit(result)
+                    if name not in write_arrays:
+                        write_arrays[name] = self._create_derived_array(
+                            name, fam, result, self._find_deriving_function(name))
+                        if units.has_units(result):
+                            write_arrays[name].units = result.units
+                    elif units.has_units(result) and result.units != write_arrays[name].units:
+                        result = result.in_units(write_arrays[name].units)
+                    write_arrays[name][chunk.slice] = result
+
+                if start == 0:
+                    logger.info("Deriving arrays %s in blocks of %d particles, via %s" %
+                                (names, chunk_size, [k for k in chunk.keys() if k not in names]))
+                    dependencies = chunk.dependencies(names)
+
+                # the block is only freed by the cyclic garbage collector, so
+                # release its arrays straight away
+                chunk._arrays.clear()
+
+        return dependencies
 
     def _dirty(self, name):
         """Declare a given array as changed, so deleting any derived
         quantities which depend on it"""
 
         name = self._array_name_1D_to_ND(name) or name
+        for cache in self.ancestor._gather_caches:
+            cache.discard([name] + list(self._array_name_ND_to_1D(name)))
+
         if name=='pos':
             for v in self.ancestor._persistent_objects.itervalues():
                 if 'kdtree' in v:
@@ -1689,12 +1795,58 @@ class SubSnap(SimSnap):
         for x in self._inherited:
             setattr(self, x, getattr(self.base, x))
 
+    @property
+    def _ancestor_index(self):
+        """The slice or index array picking out the particles of this view
+        from the arrays of its ancestor.
+
+        Nested views compose their selections into this single index when it
+        is first needed, so that an array access gathers from the ancestor
+        once rather than once per level. The result is cached, and recomputed
+        if the selection of this view or any of its bases changes."""
+        if isinstance(self.base, SubSnap):
+            base_index = self.base._ancestor_index
+        else:
+            base_index = None
+
+        cache = self.__dict__.get('_ancestor_index_cache')
+        if cache is None or cache[0] is not base_index or cache[1] is not self._slice:
+            if base_index is None:
+                index = self._slice
+            else:
+                index = util.concatenate_indexing(base_index, self._slice)
+            cache = (base_index, self._slice, index, {})
+            self._ancestor_index_cache = cache
+
+        return cache[2]
+
+    def _ancestor_family_index(self, fam):
+        """The slice or index array picking out the particles of family *fam*
+        in this view from the family-level arrays of its ancestor"""
+        index = self._ancestor_index
+        family_indices = self._ancestor_index_cache[3]
+        if fam not in family_indices:
+            ancestor_slice = self.ancestor._get_family_slice(fam)
+            sl = util.concatenate_indexing(index, self._get_family_slice(fam))
+            if isinstance(sl, slice):
+                sl = util.relative_slice(ancestor_slice, sl)
+            else:
+                sl = np.asarray(sl) - ancestor_slice.start
+            family_indices[fam] = sl
+        return family_indices[fam]
+
     def _get_array(self, name, index=None, always_writable=False):
         if _subarray_immediate_mode or self.immediate_mode:
             return self._get_from_immediate_cache(name,
                                                   lambda: self.base._get_array(
                                                       name, None, always_writable)[self._slice])
 
+        elif name in self.ancestor.keys():
+            ret = self.ancestor._get_array(name, util.concatenate_indexing(
+                self._ancestor_index, index), always_writable)
+            ret.family = self._unifamily
+            return ret
+
         else:
             ret = self.base._get_array(name, util.concatenate_indexing(
                 self._slice, index), always_writable)
@@ -1702,25 +1854,29 @@ class SubSnap(SimSnap):
             return ret
 
     def _set_array(self, name, value, index=None):
-        self.base._set_array(
-            name, value, util.concatenate_indexing(self._slice, index))
+        if name in self.ancestor.keys():
+            self.ancestor._set_array(
+                name, value, util.concatenate_indexing(self._ancestor_index, index))
+        else:
+            self.base._set_array(
+                name, value, util.concatenate_indexing(self._slice, index))
 
     def _get_family_array(self, name, fam, index=None, always_writable=False):
-        base_family_slice = self.base._get_family_slice(fam)
-        sl = util.relative_slice(base_family_slice,
-                                 util.intersect_slices(self._slice, base_family_slice, len(self.base)))
-        sl = util.concatenate_indexing(sl, index)
         if _subarray_immediate_mode or self.immediate_mode:
+            base_family_slice = self.base._get_family_slice(fam)
+            sl = util.relative_slice(base_family_slice,
+                                     util.intersect_slices(self._slice, base_family_slice, len(self.base)))
+            sl = util.concatenate_indexing(sl, index)
             return self._get_from_immediate_cache((name, fam),
                                                   lambda: self.base._get_family_array(
                 name, fam, None, always_writable)[sl])
         else:
-            return self.base._get_family_array(name, fam, sl, always_writable)
+            return self.ancestor._get_family_array(name, fam, util.concatenate_indexing(
+                self._ancestor_family_index(fam), index), always_writable)
 
     def _set_family_array(self, name, family, value, index=None):
-        fslice = self._get_family_slice(family)
-        self.base._set_family_array(
-            name, family, value, util.concatenate_indexing(fslice, index))
+        self.ancestor._set_family_array(
+            name, family, value, util.concatenate_indexing(self._ancestor_family_index(family), index))
 
     def _promote_family_array(self, *args, **kwargs):
         self.base._promote_family_array(*args, **kwargs)
@@ -1772,6 +1928,9 @@ class SubSnap(SimSnap):
     def _derive_array(self, array_name, fam=None):
         self.base._derive_array(array_name, fam)
 
+    def derive_arrays(self, names, fam=None, chunk_size=None):
+        self.base.derive_arrays(names, fam, chunk_size)
+
     def family_keys(self, fam=None):
         return self.base.family_keys(fam)
 
@@ -1797,6 +1956,9 @@ class SubSnap(SimSnap):
         if relative_to is self:
             return of_particles
 
+        if relative_to is self.ancestor:
+            return util.concatenate_indexing(self._ancestor_index, of_particles)
+
         return self.base.get_index_list(relative_to, util.concatenate_indexing(self._slice, of_particles))
 
 
@@ -1829,7 +1991,7 @@ class IndexedSubSnap(SubSnap):
         findex = base._family_index()[index_array]
         # Check the family index array is monotonically increasing
         # If not, the family slices cannot be implemented
-        if not all(np.diff(findex) >= 0):
+        if (findex[1:] < findex[:-1]).any():
             raise ValueError(
                 "Families must retain the same ordering in the SubSnap")
 
@@ -1838,15 +2000,48 @@ class IndexedSubSnap(SubSnap):
         self._family_indices = {}
         self._num_particles = len(index_array)
 
-        # Find the locations of the family slices
-        for i, fam in enumerate(self.ancestor.families()):
-            ids = np.where(findex == i)[0]
-            if len(ids) > 0:
-                new_slice = slice(ids.min(), ids.max() + 1)
+        # Find the locations of the family slices, which (since findex
+        # is monotonic) are the boundaries between runs of equal values
+        families = self.ancestor.families()
+        boundaries = np.searchsorted(findex, np.arange(len(families) + 1))
+        for i, fam in enumerate(families):
+            if boundaries[i + 1] > boundaries[i]:
+                new_slice = slice(boundaries[i], boundaries[i + 1])
                 self._family_slice[fam] = new_slice
                 self._family_indices[fam] = np.asarray(index_array[
                                                        new_slice]) - base._get_family_slice(fam).start
 
+        self._gather_cache = None
+        if config['gather-cache-megabytes'] > 0:
+            self.set_gather_cache(config['gather-cache-megabytes'])
+
+    def set_gather_cache(self, max_megabytes):
+        """Keep contiguous copies of up to *max_megabytes* of the arrays most
+        recently read through this view, so that reading them again does not
+        repeat the gather from the underlying snapshot. Pass 0 to switch
+        off. The default is set by the gather-cache-megabytes option in the
+        [general] section of the config file.
+
+        Copies are discarded when the array is changed through pynbody
+        (see :class:`~pynbody.array.GatherCache`), but not if it is
+        changed by writing directly into the underlying numpy memory."""
+        if max_megabytes > 0:
+            self._gather_cache = array.GatherCache(max_megabytes)
+            self.ancestor._gather_caches.add(self._gather_cache)
+        else:
+            self._gather_cache = None
+
+    def _attach_gather_cache(self, ar, key):
+        if self._gather_cache is not None and isinstance(ar, array.IndexedSimArray):
+            ar._gather_cache = (self._gather_cache, key)
+        return ar
+
+    def _get_array(self, name, index=None, always_writable=False):
+        ret = SubSnap._get_array(self, name, index, always_writable)
+        if index is None:
+            ret = self._attach_gather_cache(ret, (name,))
+        return ret
+
 
     def _get_family_slice(self, fam):
         # A bit messy: jump out the SubSnap inheritance chain
@@ -1854,14 +2049,14 @@ class IndexedSubSnap(SubSnap):
         return SimSnap._get_family_slice(self, fam)
 
     def _get_family_array(self, name, fam, index=None, always_writable=False):
-        sl = self._family_indices.get(fam,None)
-        sl = util.concatenate_indexing(sl, index)
+        if fam not in self._family_indices:
+            return self.base._get_family_array(name, fam, index, always_writable)
 
-        return self.base._get_family_array(name, fam, sl, always_writable)
-
-    def _set_family_array(self, name, family, value, index=None):
-        self.base._set_family_array(name, family, value,
-                                    util.concatenate_indexing(self._family_indices[family], index))
+        ret = self.ancestor._get_family_array(name, fam, util.concatenate_indexing(
+            self._ancestor_family_index(fam), index), always_writable)
+        if index is None:
+            ret = self._attach_gather_cache(ret, (name, fam))
+        return ret
 
     def _create_array(self, *args, **kwargs):
         self.base._create_array(*args, **kwargs)
@@ -1940,6 +2135,90 @@ class FamilySubSnap(SubSnap):
         if fam is self._unifamily or fam is None:
             self.base._derive_array(array_name, self._unifamily)
 
+    def derive_arrays(self, names, fam=None, chunk_size=None):
+        if fam is self._unifamily or fam is None:
+            self.base.derive_arrays(names, self._unifamily, chunk_size)
+
+
+class _DerivationChunk(SimSnap):
+
+    """Holds a block of particles of a snapshot on which the local derived
+    quantities *names* can be evaluated. Stored arrays are read from the
+    snapshot, without copying, while derived arrays are calculated for the
+    block only."""
+
+    def __init__(self, snap, fam, start, stop, names):
+        super(_DerivationChunk, self).__init__()
+        self._snap = snap
+        self._target = snap if fam is None else snap[fam]
+        self._filename = snap._filename
+        self._num_particles = stop - start
+        self.slice = slice(start, stop)
+        self.properties = snap.properties
+        self._file_units_system = snap._file_units_system
+        self._leaves = set()
+        # arrays being filled in on the snapshot, which must not be read back
+        self._deriving = set(names)
+
+        for fam_x in self._target.families():
+            fam_slice = self._target._get_family_slice(fam_x)
+            if fam_slice.start < stop and fam_slice.stop > start:
+                self._family_slice[fam_x] = slice(max(fam_slice.start, start) - start,
+                                                  min(fam_slice.stop, stop) - start)
+
+    def _find_deriving_function(self, name):
+        fn = self._snap._find_deriving_function(name)
+        if getattr(fn, '__local__', False):
+            return fn
+
+    def _load_array(self, array_name, fam=None):
+        target = self._target
+        if fam is not None or array_name in self._deriving or not (array_name in target.keys() or
+                                   array_name in target.loadable_keys() or
+                                   array_name in target.derivable_keys()):
+            raise IOError("No stored array %r" % array_name)
+
+        if array_name not in target.keys() and array_name not in target.loadable_keys() \
+           and self._find_deriving_function(array_name):
+            # calculate this block only
+            raise IOError("Array %r is to be derived" % array_name)
+
+        try:
+            source = target[array_name]
+        except KeyError:
+            raise IOError("No stored array %r" % array_name)
+
+        ar = np.asarray(source)[self.slice].view(array.SimArray)
+        ar.flags['WRITEABLE'] = False
+        ar.units = source.units
+        ar.sim = self
+        ar._name = array_name
+        self._arrays[array_name] = ar
+        self._leaves.add(array_name)
+
+        if ar.ndim == 2 and ar.shape[1] == 3:
+            for i, a in enumerate(self._array_name_ND_to_1D(array_name)):
+                self._arrays[a] = ar[:, i]
+                self._arrays[a]._name = a
+
+    def _derive_in_blocks(self, fn, fam):
+        return False
+
+    def _default_units_for(self, array_name):
+        # arrays read from the snapshot keep the units they have there
+        return self._arrays[array_name].units
+
+    def dependencies(self, names):
+        """Return a dictionary mapping each of *names* to the set of arrays
+        read from the snapshot on which it depends"""
+        result = dict([(name, set()) for name in names])
+        tracker = self._dependency_tracker
+        for leaf in self._leaves:
+            for name in tracker.get_all_dependents([leaf] + list(self._array_name_ND_to_1D(leaf))):
+                if name in result:
+                    result[name].add(leaf)
+        return result
+
 
 
 def load(filename, *args, **kwargs):
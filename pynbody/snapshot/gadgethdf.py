@@ -1,4 +1,4 @@
-`"""
+"""
 
 gadgethdf
 =========
@@ -17,22 +17,34 @@ will be available from pynbody.
 
 Spanned files are supported. To load a range of files snap.0, snap.1, ... snap.n,
 pass the filename 'snap'. If you pass snap.0, only that particular file will
-be loaded.
+be loaded. Arrays from spanned files can be read by several processes at once;
+see the config.ini section [gadgethdf].
+
+To load only the particles in a region, pass a spatial filter, e.g.
+``pynbody.load(filename, region=pynbody.filt.Sphere('1 Mpc', cen))``.
+A coarse spatial index (the bounding box of each block of consecutive
+particles) is built the first time a file is used in this way and saved
+alongside it as *filename*.pynbody-index.npz; afterwards only the blocks
+overlapping the region are read from disk. The filter must depend only on
+positions; combine it with other filters after loading instead.
 """
 
 
 from __future__ import with_statement  # for py2.5
 
 from .. import util, halo
+from .. import array
 from .. import family
 from .. import units
 from .. import config_parser
+from .. import dependencytracker
 from . import SimSnap
 
 import ConfigParser
 
 import numpy as np
 import functools, itertools
+import os
 import warnings
 
 import logging
@@ -45,6 +57,25 @@ try:
 except ImportError:
     h5py = None
 
+# the number of processes reading multi-file snapshots; this is consulted
+# each time a snapshot is opened, so it can be changed at runtime
+multiprocess_num = int(config_parser.get('gadgethdf', 'parallel-read'))
+
+try:
+    import multiprocessing
+    import posix_ipc
+    remote_exec = array.shared_array_remote
+    remote_map = array.remote_map
+    multiprocess_available = True
+except ImportError:
+    multiprocess_available = False
+
+    def remote_exec(fn):
+        return fn
+
+    def remote_map(*args, **kwargs):
+        return map(*args[1:], **kwargs)
+
 _default_type_map = {}
 for x in family.family_names():
     try:
@@ -66,6 +97,15 @@ def _append_if_array(to_list, name, obj):
         to_list.append(name)
 
 
+@remote_exec
+def _load_datasets_from_file(filename, dataset_names, targets):
+    """Read each of the named datasets in the HDF file *filename* directly
+    into the corresponding (shared memory) target array"""
+    with h5py.File(filename, "r") as f:
+        for dataset_name, target in zip(dataset_names, targets):
+            f[dataset_name].read_direct(target)
+
+
 class DummyHDFData(object):
 
     """A stupid class to allow emulation of mass arrays for particles
@@ -148,21 +188,32 @@ class GadgetHDFSnap(SimSnap):
     _readable_hdf5_test_key = "PartType0"
     _size_from_hdf5_key = "ParticleIDs"
 
-    def __init__(self, filename, ):
+    reader_pool = None
+
+    # number of consecutive particles summarised by one bounding box in the
+    # spatial index used for region loading
+    _spatial_index_block_size = 8192
+
+    def __init__(self, filename, region=None):
         super(GadgetHDFSnap, self).__init__()
 
         self._filename = filename
 
         self._init_hdf_filemanager(filename)
+        self.__setup_parallel_reading()
 
         self._translate_array_name = namemapper.AdaptiveNameMapper('gadgethdf-name-mapping')
         self.__init_unit_information()
         self.__init_family_map()
-        self.__init_file_map()
-        self.__init_loadable_keys()
 
+        # decorating sets up the units and box size, which are needed to
+        # select the particles in the region
         self._decorate()
 
+        self.__init_region(region)
+        self.__init_file_map()
+        self.__init_loadable_keys()
+
     def _get_hdf_header_attrs(self):
         return self._hdf_files.get_header_attrs()
 
@@ -172,6 +223,164 @@ class GadgetHDFSnap(SimSnap):
     def _init_hdf_filemanager(self, filename):
         self._hdf_files = self._multifile_manager_class(filename)
 
+    def __setup_parallel_reading(self):
+        # Only snapshots spanning several files can usefully be read in parallel
+        self._parallel_read = False
+        if self._hdf_files._numfiles < 2 or multiprocess_num < 2:
+            return
+
+        if multiprocess_available:
+            self._shared_arrays = True
+            self._parallel_read = True
+            if (GadgetHDFSnap.reader_pool is None):
+                GadgetHDFSnap.reader_pool = multiprocessing.Pool(multiprocess_num)
+        else:
+            warnings.warn(
+                "GadgetHDFSnap is configured to use multiple processes, but the posix_ipc module is missing. Reverting to single thread.",
+                RuntimeWarning)
+
+    def __init_region(self, region):
+        self._region = region
+        self._region_selection = {}
+        self._spatial_indices = {}
+
+        if region is None:
+            return
+
+        try:
+            region(self.__region_proxy(np.zeros((0, 3)), self._default_units_for('pos')))
+        except (KeyError, dependencytracker.DependencyError):
+            raise ValueError("The region used to load a snapshot must be a filter on positions only, "
+                             "not %r" % region)
+
+        for fam in self._families_ordered():
+            for hdf_group in self._all_hdf_groups_in_family(fam):
+                self._region_selection[hdf_group.file.filename, hdf_group.name] = \
+                    self.__select_region_in_group(fam, hdf_group)
+
+    def __select_region_in_group(self, fam, hdf_group):
+        """Return the indices of the particles in hdf_group which lie in the region,
+        reading positions only for the blocks whose bounding box overlaps it"""
+
+        translated_name = self._translate_array_name('pos')
+        pos_units = self.__get_dtype_dims_and_units(fam, translated_name)[2]
+        if not units.has_units(pos_units):
+            pos_units = self._default_units_for('pos')
+
+        context = self.conversion_context()
+        boxsize = self.properties.get('boxsize', None)
+        if boxsize is not None:
+            boxsize = float(boxsize.in_units(pos_units, **context))
+
+        lower, upper = self.__get_spatial_index(hdf_group)
+        blocks = np.where(self._region.intersects_boxes(lower, upper, pos_units, context, boxsize))[0]
+
+        coordinates = self._get_hdf_dataset(hdf_group, translated_name)
+        block_size = self._spatial_index_block_size
+        selected = [np.zeros(0, dtype=np.int64)]
+
+        for b0, b1 in util.runs(blocks):
+            i0 = b0 * block_size
+            pos = coordinates[i0:min(b1 * block_size, len(coordinates))]
+
+            proxy = self.__region_proxy(pos, pos_units)
+            selected.append(np.where(self._region(proxy))[0].astype(np.int64) + i0)
+
+        return np.concatenate(selected)
+
+    def __region_proxy(self, pos, pos_units):
+        """Return a snapshot holding only the given positions, on which the
+        region filter can be evaluated"""
+        proxy = SimSnap()
+        proxy._filename = self._filename
+        proxy._num_particles = len(pos)
+        proxy._family_slice[family.dm] = slice(0, len(pos))
+        proxy.properties.update(self.properties)
+        proxy._create_array('pos', 3)
+        proxy['pos'][:] = pos
+        proxy['pos'].units = pos_units
+        return proxy
+
+    def __get_spatial_index(self, hdf_group):
+        """Return the lower and upper corners of the bounding boxes of each block
+        of particles in hdf_group, using the index file on disk if it is up to date"""
+
+        filename = hdf_group.file.filename
+        index_filename = filename + ".pynbody-index.npz"
+        key = hdf_group.name.strip("/").replace("/", "_")
+
+        if filename not in self._spatial_indices:
+            self._spatial_indices[filename] = {}
+            try:
+                if os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+                    with np.load(index_filename) as stored:
+                        if stored['block_size'] == self._spatial_index_block_size:
+                            self._spatial_indices[filename].update(stored)
+            except (IOError, OSError, KeyError):
+                pass
+
+        index = self._spatial_indices[filename]
+
+        if key + "_lower" not in index:
+            index[key + "_lower"], index[key + "_upper"] = self.__build_spatial_index(hdf_group)
+            index['block_size'] = self._spatial_index_block_size
+            try:
+                np.savez(index_filename, **index)
+            except (IOError, OSError):
+                logger.warn("Unable to write spatial index file %s", index_filename)
+
+        return index[key + "_lower"], index[key + "_upper"]
+
+    def __build_spatial_index(self, hdf_group):
+        logger.info("Building spatial index for %s", hdf_group.name)
+
+        coordinates = self._get_hdf_dataset(hdf_group, self._translate_array_name('pos'))
+        block_size = self._spatial_index_block_size
+        nblocks = (len(coordinates) + block_size - 1) // block_size
+        lower = np.empty((nblocks, 3))
+        upper = np.empty((nblocks, 3))
+
+        # read many blocks at a time to keep the number of HDF calls down
+        # while still bounding the memory use
+        step = block_size * 64
+        for i0 in xrange(0, len(coordinates), step):
+            pos = coordinates[i0:i0 + step]
+            starts = np.arange(0, len(pos), block_size)
+            b0 = i0 // block_size
+            lower[b0:b0 + len(starts)] = np.minimum.reduceat(pos, starts)
+            upper[b0:b0 + len(starts)] = np.maximum.reduceat(pos, starts)
+
+        return lower, upper
+
+    def _hdf_group_num_particles(self, hdf_group):
+        """Return the number of particles that will be loaded from hdf_group"""
+        if self._region is not None:
+            return len(self._region_selection[hdf_group.file.filename, hdf_group.name])
+        else:
+            return hdf_group[self._size_from_hdf5_key].size
+
+    def __read_region_from_dataset(self, dataset, hdf_group, target):
+        """Read into target only the rows of dataset for particles in the region"""
+
+        if isinstance(dataset, DummyHDFData):
+            target[:] = dataset.value
+            return
+
+        selection = self._region_selection[hdf_group.file.filename, hdf_group.name]
+        target = target.reshape((len(selection), -1))
+        npart = hdf_group[self._size_from_hdf5_key].size
+        block_size = self._spatial_index_block_size
+
+        i0 = 0
+        for b0, b1 in util.runs(np.unique(selection // block_size)):
+            j0 = b0 * block_size
+            in_blocks = selection[(selection >= j0) & (selection < b1 * block_size)]
+            # rows are read as whole hyperslabs then picked out in memory
+            data = dataset[j0 * len(dataset) // npart:min(b1 * block_size, npart) * len(dataset) // npart]
+            data = data.reshape((-1, target.shape[1]))
+            target[i0:i0 + len(in_blocks)] = data[in_blocks - j0]
+            i0 += len(in_blocks)
+
     def __init_loadable_keys(self):
         self._loadable_keys = set()
 
@@ -203,7 +412,7 @@ class GadgetHDFSnap(SimSnap):
         for fam in all_families_sorted:
             family_length = 0
             for hdf_group in self._all_hdf_groups_in_family(fam):
-                family_length += hdf_group[self._size_from_hdf5_key].size
+                family_length += self._hdf_group_num_particles(hdf_group)
 
             self._family_slice[fam] = slice(family_slice_start, family_slice_start + family_length)
             family_slice_start += family_length
@@ -400,24 +609,49 @@ class GadgetHDFSnap(SimSnap):
             else:
                 target[array_name].set_default_units()
 
+            # when reading in parallel, collect the datasets to read from each
+            # file, along with the [i0:i1] slice of the target they belong in
+            remote_reads = {}
+
             for loading_fam in all_fams_to_load:
                 i0 = 0
                 for hdf in self._all_hdf_groups_in_family(loading_fam):
-                    npart = hdf['ParticleIDs'].size
+                    npart = self._hdf_group_num_particles(hdf)
                     i1 = i0+npart
 
                     dataset = self._get_hdf_dataset(hdf, translated_name)
 
                     target_array = self[loading_fam][array_name][i0:i1]
+
+                    if self._region is not None:
+                        self.__read_region_from_dataset(dataset, hdf, target_array)
+                        i0 = i1
+                        continue
+
                     assert target_array.size == dataset.size
 
-                    dataset.read_direct(target_array.reshape(dataset.shape))
+                    if self._parallel_read and not isinstance(dataset, DummyHDFData):
+                        names, targets = remote_reads.setdefault(dataset.file.filename, ([], []))
+                        names.append(dataset.name)
+                        targets.append(target_array.reshape(dataset.shape))
+                    else:
+                        dataset.read_direct(target_array.reshape(dataset.shape))
 
                     i0 = i1
 
+            if len(remote_reads) > 0:
+                filenames = remote_reads.keys()
+                remote_map(self.reader_pool,
+                           _load_datasets_from_file,
+                           filenames,
+                           [remote_reads[f][0] for f in filenames],
+                           [remote_reads[f][1] for f in filenames])
+
     def __get_dtype_dims_and_units(self, fam, translated_name):
         if fam is None:
-            fam = self.families()[0]
+            # take the first family with particles on disk, which may have
+            # none in this snapshot if a region selected none of them
+            fam = self._families_ordered()[0]
 
         units0 = units.NoUnit()
         dset0 = None
@@ -573,8 +807,8 @@ class SubFindHDFSnap(GadgetHDFSnap) :
     _multifile_manager_class = SubfindHdfMultiFileManager
     _readable_hdf5_test_key = "FOF"
 
-    def __init__(self, filename) :
-        super(SubFindHDFSnap,self).__init__(filename)
+    def __init__(self, filename, region=None) :
+        super(SubFindHDFSnap,self).__init__(filename, region)
 
     def halos(self) : 
         return halo.SubFindHDFHaloCatalogue(self)
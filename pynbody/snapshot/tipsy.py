@@ -15,6 +15,14 @@ automatically via pynbody.load.
 specified, the loader will look for a file `*.param` in the current and
 parent directories.
 
+*mmap*: if True, the main file is memory-mapped rather than read
+into memory. Arrays stored in the main file (``pos``, ``vel``,
+``mass``, ``eps``, ``phi`` and the family-specific gas/star fields)
+are then strided views over the mapped particle records, so only the
+pages actually touched are read from disk. Changes made in memory are
+never written back to the file. This is only possible for
+uncompressed, native-endian files loaded without *take*.
+
 """
 
 from __future__ import with_statement  # for py2.5
@@ -36,6 +44,7 @@ import sys
 import warnings
 import copy
 import types
+import weakref
 import math
 
 import logging
@@ -71,6 +80,9 @@ class TipsySnap(SimSnap):
 
         f = util.open_(filename, 'rb')
 
+        self._mmap = kwargs.get('mmap', False)
+        self._main_file_memmaps = {}
+
         if not only_header:
             logger.info("Loading %s", filename)
 
@@ -84,6 +96,11 @@ class TipsySnap(SimSnap):
 
         assert ndim == 3
 
+        if self._mmap and (self._byteswap or self.partial_load or isinstance(f, gzip.GzipFile)):
+            warnings.warn(
+                "Memory-mapping is only possible for uncompressed, native-endian tipsy files loaded without take; reading into memory instead", RuntimeWarning)
+            self._mmap = False
+
         self._header_t = t
 
         f.read(4)
@@ -220,6 +237,90 @@ class TipsySnap(SimSnap):
                         if name in write:
                             self_fam[name][mem_index] = buf[name][buf_index]
 
+    def _get_main_file_memmap(self, fam):
+        """Return a structured memmap over the main-file records of the
+        specified family, creating it on first use."""
+
+        if fam not in self._main_file_memmaps:
+            offset = 32
+            for fam_x, dtype in ((family.gas, self._g_dtype), (family.dm, self._d_dtype), (family.star, self._s_dtype)):
+                n = len(self[fam_x])
+                if fam_x is fam:
+                    break
+                offset += n * dtype.itemsize
+
+            self._main_file_memmaps[fam] = np.memmap(self._filename, dtype=dtype, mode='c',
+                                                     offset=offset, shape=(n,))
+
+        return self._main_file_memmaps[fam]
+
+    def _map_main_file_array(self, array_name, fam=None):
+        """Expose the named main-file array as views over the memory-mapped
+        particle records, instead of copying it into memory.
+
+        If the array is requested for the whole snapshot but the file
+        contains several families, the family-level views are promoted
+        to a simulation-level array in the usual way (which does copy)."""
+
+        if fam is None:
+            fams = self.families()
+        else:
+            fams = [fam]
+
+        if len(self.families()) == 1:
+            target = self._arrays
+        else:
+            target = None
+
+        for fam_x in fams:
+            buf = self._get_main_file_memmap(fam_x)
+
+            if array_name in ('pos', 'vel'):
+                components = self._array_name_ND_to_1D(array_name)
+                if components[0] not in buf.dtype.names:
+                    continue
+                comp_dtype, comp_offset = buf.dtype.fields[components[0]][:2]
+                ar = np.ndarray((len(buf), 3), dtype=comp_dtype, buffer=buf, offset=comp_offset,
+                                strides=(buf.dtype.itemsize, comp_dtype.itemsize))
+            else:
+                if array_name not in buf.dtype.names:
+                    continue
+                components = []
+                ar = buf[array_name]
+
+            ar = ar.view(array.SimArray)
+            ar._sim = weakref.ref(self)
+            ar._name = array_name
+
+            if target is self._arrays:
+                ar.family = None
+                views = self._arrays
+            else:
+                ar.family = fam_x
+                views = {}
+
+            views[array_name] = ar
+            for i, a in enumerate(components):
+                views[a] = ar[:, i]
+                views[a]._name = a
+
+            if views is not self._arrays:
+                for a, v in views.iteritems():
+                    self._family_arrays.setdefault(a, {})[fam_x] = v
+
+            if array_name == 'temp':
+                ar.units = 'K'
+            else:
+                ar.set_default_units(quiet=True)
+
+            # only do this for cosmo runs
+            if array_name == 'phi' and self.properties.has_key('h'):
+                ar.units = ar.units * units.a ** -3
+
+        if array_name in self._family_arrays and \
+                all([fam_x in self._family_arrays[array_name] for fam_x in self.families()]):
+            self._promote_family_array(array_name, ndim=3 if array_name in ('pos', 'vel') else 1)
+
     def _update_loadable_keys(self):
         def is_readable_array(x):
             try:
@@ -751,7 +852,10 @@ class TipsySnap(SimSnap):
                     packed_vector=None):
 
         if array_name in self._basic_loadable_keys[fam]:
-            self._load_main_file()
+            if self._mmap:
+                self._map_main_file_array(array_name, fam)
+            else:
+                self._load_main_file()
             return
 
         fams = self._get_loadable_array_metadata(
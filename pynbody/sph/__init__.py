@@ -20,18 +20,20 @@ import time
 import sys
 import threading
 import copy
+import functools
 import logging
 import time
 logger = logging.getLogger('pynbody.sph')
 
 from . import _render
-from .. import snapshot, array, config, units, util, config_parser
+from .. import snapshot, array, config, units, util, config_parser, backcompat
 
 try:
     from . import kdtree
 except ImportError:
     raise ImportError, "Pynbody cannot import the kdtree subpackage. This can be caused when you try to import pynbody directly from the installation folder. Try changing to another folder before launching python"
 import os
+import hashlib
 
 
 
@@ -41,6 +43,10 @@ def _get_threaded_image():
 
 _threaded_image = _get_threaded_image()
 _approximate_image = config_parser.getboolean('sph', 'approximate-fast-images')
+_persistent_tree = config_parser.getboolean('sph', 'persistent-tree')
+_image_cache_megabytes = config_parser.getfloat('sph', 'image-cache-megabytes')
+_neighbour_cache = config_parser.get('sph', 'neighbour-cache').lower()
+_neighbour_cache = None if _neighbour_cache == 'none' else _neighbour_cache
 
 def _exception_catcher(call_fn, exception_list, *args):
     try:
@@ -84,6 +90,74 @@ def _auto_denoise(sim, kernel):
     else:
         return False
 
+def _tree_cache_filename(sim):
+    """Return the name of the sidecar file in which the KDTree for sim is
+    stored, or None if sim is not associated with a file on disk"""
+    filename = sim.ancestor.filename
+    if getattr(sim.ancestor, 'partial_load', False) or not os.path.exists(filename):
+        # a partially loaded snapshot must not share the cache of the full file
+        return None
+    filename = os.path.normpath(filename) + ".kdtree"
+    if sim is not sim.ancestor:
+        filename += "-" + hashlib.md5(sim._inclusion_hash).hexdigest()[:16]
+    return filename + ".npz"
+
+def _pos_checksum(pos, chunk_size=2 ** 20):
+    checksum = hashlib.md5()
+    for i in xrange(0, len(pos), chunk_size):
+        checksum.update(np.ascontiguousarray(pos[i:i + chunk_size]).data)
+    return checksum.hexdigest()
+
+def _load_tree_data(filename, n_particles, checksum, leafsize):
+    """Return the (order, nodes) data stored in the specified tree cache,
+    or None if it does not exist or does not match the requested tree"""
+    if filename is None or not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as cache:
+            if int(cache['n_particles']) != n_particles or \
+                    str(cache['checksum']) != checksum or \
+                    int(cache['leafsize']) != leafsize:
+                logger.info("Stored tree in %s is out of date" % filename)
+                return None
+            return cache['order'], cache['nodes']
+    except (IOError, KeyError, ValueError):
+        logger.warn("Unable to read stored tree from %s" % filename)
+        return None
+
+def _save_tree_data(filename, tree, n_particles, checksum, leafsize):
+    if filename is None:
+        return
+    order, nodes = tree.get_tree_data()
+    try:
+        np.savez(filename, n_particles=n_particles, checksum=checksum,
+                 leafsize=leafsize, order=np.frombuffer(order, dtype=np.uint8),
+                 nodes=np.frombuffer(nodes, dtype=np.uint8))
+        logger.info("Tree stored in %s" % filename)
+    except (IOError, OSError):
+        logger.warn("Unable to store tree in %s" % filename)
+
+def _find_enclosing_tree(sim):
+    """Find a snapshot enclosing sim which already has a KDTree. Returns
+    the index of the particles of sim within that snapshot, and the tree,
+    or (None, None) if there is no such snapshot."""
+    parent = sim
+    while parent is not sim.ancestor:
+        parent = parent.base
+        if hasattr(parent, 'kdtree'):
+            return sim.get_index_list(parent), parent.kdtree
+
+    # Family-level views are not in the chain of bases of (for instance)
+    # h[1].gas, but commonly have trees
+    families = sim.families()
+    if len(families) == 1:
+        family_view = sim.ancestor[families[0]]
+        if hasattr(family_view, 'kdtree'):
+            offset = sim.ancestor._get_family_slice(families[0]).start
+            return sim.get_index_list(sim.ancestor) - offset, family_view.kdtree
+
+    return None, None
+
 def build_tree(sim):
     if hasattr(sim, 'kdtree') is False:
         # n.b. getting the following arrays through the full framework is
@@ -94,9 +168,45 @@ def build_tree(sim):
             boxsize = float(boxsize.in_units(sim['pos'].units))
         else:
             boxsize = -1.0 # represents infinite box
-        sim.kdtree = kdtree.KDTree(sim['pos'], sim['mass'],
-                        leafsize=config['sph']['tree-leafsize'],
-                        boxsize=boxsize)
+
+        leafsize = config['sph']['tree-leafsize']
+        tree_data = None
+
+        if sim is not sim.ancestor:
+            # Arrays for an IndexedSubSnap are not contiguous in memory,
+            # so the tree needs its own copy
+            pos = np.asanyarray(sim['pos'])
+            mass = np.asanyarray(sim['mass'])
+
+            index, enclosing_tree = _find_enclosing_tree(sim)
+            if enclosing_tree is not None:
+                # The particles are already spatially sorted by the enclosing
+                # tree, so a tree for the subset can be built without
+                # sorting them again
+                logger.info("Deriving tree from that of an enclosing snapshot")
+                sim.kdtree = kdtree.KDTree(pos, mass, leafsize=leafsize,
+                                           boxsize=boxsize, parent=enclosing_tree,
+                                           parent_index=index,
+                                           neighbour_cache=_neighbour_cache)
+                return
+        else:
+            pos = sim['pos']
+            mass = sim['mass']
+
+        if _persistent_tree:
+            cache_filename = _tree_cache_filename(sim)
+            checksum = _pos_checksum(sim['pos'])
+            tree_data = _load_tree_data(cache_filename, len(sim), checksum, leafsize)
+            if tree_data is not None:
+                logger.info("Restoring tree from %s" % cache_filename)
+
+        sim.kdtree = kdtree.KDTree(pos, mass,
+                        leafsize=leafsize,
+                        boxsize=boxsize, tree_data=tree_data,
+                        neighbour_cache=_neighbour_cache)
+
+        if _persistent_tree and tree_data is None:
+            _save_tree_data(cache_filename, sim.kdtree, len(sim), checksum, leafsize)
 
 
 def _tree_decomposition(obj):
@@ -166,6 +276,200 @@ def rho(self):
     return rho
 
 
+def sph_smooth(sim, names, dispersion=False):
+    """Calculate the SPH-smoothed mean of each of the named arrays of *sim*,
+    gathering each particle's neighbours only once for all of them. If
+    *dispersion* is True, calculate the SPH-smoothed local dispersion instead.
+
+    The neighbours are those within the kernel radius given by the
+    'smooth' array, exactly as for :meth:`~pynbody.sph.kdtree.KDTree.sph_mean`.
+
+    The results are stored in *sim* as derived arrays called
+    name+'_sph_mean' (or name+'_sph_disp'), which are deleted automatically
+    if the original array, or the positions, masses, densities or smoothing
+    lengths change. They are also returned as a list."""
+
+    if isinstance(names, str):
+        names = [names]
+
+    build_tree(sim)
+
+    sim.kdtree.set_array_ref('rho', sim['rho'])
+    sim.kdtree.set_array_ref('smooth', sim['smooth'])
+    sim.kdtree.set_array_ref('mass', sim['mass'])
+
+    results = sim.kdtree.sph_smooth([sim[name] for name in names], dispersion)
+
+    suffix = '_sph_disp' if dispersion else '_sph_mean'
+    tracker = sim._dependency_tracker
+    for name, result in zip(names, results):
+        out_name = name + suffix
+        if out_name not in sim.keys():
+            ndim = result.shape[-1] if len(result.shape) > 1 else 1
+            sim._create_array(out_name, ndim, dtype=result.dtype, derived=True)
+        write_array = sim._get_array(out_name, always_writable=True)
+        write_array[:] = result
+        write_array.units = result.units
+
+        with tracker.calculating(out_name):
+            for dependency in name, 'pos', 'mass', 'rho', 'smooth':
+                tracker.touching(dependency)
+
+    return results
+
+
+def _distance_to_slab(x, lo, hi, boxsize=None):
+    """Return the distance of each coordinate in x from the interval [lo, hi],
+    taking the nearest periodic image if boxsize is not None"""
+    if boxsize is None:
+        return np.maximum(np.maximum(lo - x, x - hi), 0)
+    dx = np.abs(x - 0.5 * (lo + hi))
+    dx = np.minimum(dx, boxsize - np.mod(dx, boxsize))
+    return np.maximum(dx - 0.5 * (hi - lo), 0)
+
+
+def _stream_coordinates(filename, n_particles, axis, chunk_size, **kwargs):
+    """Read the coordinate along the specified axis, together with the extent
+    of the particles along all three axes and their units, using one partial
+    load per chunk"""
+    x = None
+    lower = np.inf
+    upper = -np.inf
+    for i0 in xrange(0, n_particles, chunk_size):
+        i1 = min(i0 + chunk_size, n_particles)
+        pos = snapshot.load(filename, take=np.arange(i0, i1), **kwargs)['pos']
+        if x is None:
+            x = np.empty(n_particles, dtype=pos.dtype)
+        x[i0:i1] = pos[:, axis]
+        lower = np.minimum(lower, pos.min(axis=0))
+        upper = np.maximum(upper, pos.max(axis=0))
+    return x, lower, upper, pos.units
+
+
+def smooth_out_of_core(filename, n_slabs=8, axis=0, write=True, overwrite=False,
+                       chunk_size=2 ** 22, **kwargs):
+    """Calculate the *smooth* and *rho* arrays for a snapshot which is too
+    large to be held in memory, and return the (lazily loaded) snapshot with
+    the results attached.
+
+    The particles are divided into *n_slabs* slabs along the specified *axis*,
+    each holding approximately the same number of particles. The slabs are
+    loaded one at a time using partial loading, together with a ghost zone of
+    neighbouring particles which is made wide enough to contain the smoothing
+    kernel (of radius 2*smooth) of every particle in the slab. The results are
+    therefore identical to those obtained by loading the whole snapshot and
+    smoothing all its particles together.
+
+    Only formats supporting the *take* keyword of :func:`pynbody.load`
+    (such as tipsy) can be processed in this way. Memory use scales with the
+    size of the largest slab, plus one coordinate and the two output values per
+    particle.
+
+    **Optional Keywords**
+
+    *n_slabs* (8): the number of slabs into which the snapshot is divided
+
+    *axis* (0): the axis perpendicular to the slabs
+
+    *write* (True): if True, the *smooth* and *rho* arrays are written to disk
+     using :func:`~pynbody.snapshot.SimSnap.write_array`
+
+    *overwrite* (False): passed to write_array; needed if the format already
+     provides arrays named *smooth* or *rho*
+
+    *chunk_size*: the number of particles read at a time when scanning
+     positions to decide the slab boundaries
+
+    Other keywords are passed to :func:`pynbody.load`.
+    """
+
+    f = snapshot.load(filename, **kwargs)
+    n_particles = len(f)
+
+    if write and not overwrite:
+        for name in 'smooth', 'rho':
+            if any([name in f[fam].loadable_keys() for fam in f.families()]):
+                raise IOError("Array %r already exists on disk; pass overwrite=True to replace it" % name)
+
+    x, lower, upper, pos_units = _stream_coordinates(filename, n_particles, axis,
+                                                     chunk_size, **kwargs)
+
+    boxsize = f.properties.get('boxsize', None)
+    if boxsize:
+        boxsize = float(boxsize.in_units(pos_units))
+    else:
+        boxsize = None
+
+    edges = np.percentile(x, np.linspace(0, 100, n_slabs + 1))
+    slab = np.searchsorted(edges[1:-1], x, side='right')
+    if boxsize is None:
+        # particles at the outer faces have no neighbours beyond them
+        edges[0], edges[-1] = -np.inf, np.inf
+
+    # initial ghost zone: an estimate of the distance to the n-th neighbour
+    if boxsize is None:
+        volume = np.prod(np.maximum(upper - lower, np.finfo(x.dtype).tiny))
+    else:
+        volume = boxsize ** 3
+    n_smooth = config['sph']['smooth-particles']
+    ghost = 1.5 * (3 * n_smooth * volume / (4 * math.pi * n_particles)) ** (1. / 3)
+
+    smooth_out = rho_out = None
+
+    for i in xrange(n_slabs):
+        lo, hi = edges[i], edges[i + 1]
+        in_slab = np.where(slab == i)[0]
+        if len(in_slab) == 0:
+            continue
+
+        while True:
+            take = np.where(_distance_to_slab(x, lo, hi, boxsize) <= ghost)[0]
+            logger.info("Slab %d: loading %d particles (%d in ghost zone)" %
+                        (i, len(take), len(take) - len(in_slab)))
+
+            sub = snapshot.load(filename, take=take, **kwargs)
+            core = np.searchsorted(take, in_slab)
+            # call the deriving functions directly, so that arrays already
+            # on disk under these names are not used instead
+            sub['smooth'] = smooth(sub)
+            sub_smooth = sub['smooth'][core]
+
+            if len(take) == n_particles:
+                break
+
+            # each kernel must lie entirely within the loaded region for the
+            # result to be exact
+            x_core = x[in_slab]
+            to_edge = ghost + np.minimum(x_core - lo, hi - x_core)
+            too_big = 2 * sub_smooth > to_edge
+            if not too_big.any():
+                break
+
+            ghost = max(ghost, 2 * float(sub_smooth[too_big].max()))
+            logger.info("Slab %d: widening ghost zone to %.4g" % (i, ghost))
+
+        sub_rho = rho(sub)[core]
+
+        if smooth_out is None:
+            smooth_out = array.SimArray(np.empty(n_particles, dtype=sub_smooth.dtype),
+                                        sub_smooth.units)
+            rho_out = array.SimArray(np.empty(n_particles, dtype=sub_rho.dtype),
+                                     sub_rho.units)
+
+        smooth_out[in_slab] = sub_smooth
+        rho_out[in_slab] = sub_rho
+        del sub
+
+    f['smooth'] = smooth_out
+    f['rho'] = rho_out
+
+    if write:
+        f.write_array('smooth', overwrite=overwrite)
+        f.write_array('rho', overwrite=overwrite)
+
+    return f
+
+
 class Kernel(object):
 
     def __init__(self):
@@ -231,8 +535,11 @@ class TopHatKernel(object):
 
 
 def render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kernel(),
-                           kstep=0.5, denoise=None, out_units=None, threaded=None):
-    """Render an SPH image on a spherical surface. Requires healpy libraries.
+                           kstep=0.5, denoise=None, out_units=None, threaded=None,
+                           approximate_fast=_approximate_image):
+    """Render an SPH image on a spherical surface. The result is a healpix
+    map in the RING scheme; healpy is not required to make it but is
+    useful for displaying it.
 
     **Keyword arguments:**
 
@@ -253,8 +560,10 @@ def render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kerne
       useful to reduce noise.
 
     *threaded*: if False, render on a single core. Otherwise, the number of threads to use.
-      Defaults to a value specified in your configuration files. *Currently multi-threaded
-      rendering is slower than single-threaded because healpy does not release the gil*.
+      Defaults to a value specified in your configuration files.
+
+    *approximate_fast*: if True, render particles that cover many pixels onto
+      maps of progressively lower nside, then resample and sum them
     """
 
     if denoise is None:
@@ -263,24 +572,26 @@ def render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kerne
     if denoise and not _kernel_suitable_for_denoise(kernel):
         raise ValueError, "Denoising not supported with this kernel type. Re-run with denoise=False"
 
-    renderer = _render_spherical_image
-
     if threaded is None:
         threaded = _get_threaded_image()
 
-    if threaded:
-        im = _threaded_render_image(
-            renderer, snap, qty, nside, distance, kernel, kstep, denoise, out_units, num_threads=threaded)
-    else:
-        im = renderer(
-            snap, qty, nside, distance, kernel, kstep, denoise, out_units)
-    return im
+    return _render_spherical_image(snap, qty, nside, distance, kernel, kstep, denoise, out_units,
+                                   num_threads=threaded or 1, approximate_fast=approximate_fast)
 
 
-def _render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kernel(),
-                            kstep=0.5, denoise=None, out_units=None, __threaded=False, snap_slice=None):
+def _healpix_ring_bands(nside, num_bands):
+    """Divide the 4*nside-1 rings of a healpix map into bands containing
+    similar numbers of pixels, returning the first ring of each band followed
+    by 4*nside"""
+    rings = np.arange(1, 4 * nside)
+    n_pix = np.minimum(np.minimum(4 * rings, 4 * nside), 4 * (4 * nside - rings))
+    edges = np.searchsorted(np.cumsum(n_pix), np.linspace(0, 12 * nside ** 2, num_bands + 1)[1:-1])
+    return np.unique(np.concatenate(([1], rings[edges], [4 * nside]))).astype(np.int64)
+
 
-    import healpy as hp
+def _render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kernel(),
+                            kstep=0.5, denoise=None, out_units=None, __threaded=False, snap_slice=None,
+                            num_threads=1, approximate_fast=False):
 
     if denoise is None:
         denoise = _auto_denoise(snap, kernel)
@@ -288,15 +599,11 @@ def _render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kern
     if denoise and not _kernel_suitable_for_denoise(kernel):
         raise ValueError, "Denoising not supported with this kernel type. Re-run with denoise=False"
 
-    if out_units is not None:
-        conv_ratio = (snap[qty].units * snap['mass'].units / (snap['rho'].units * snap['smooth'].units ** kernel.h_power)).ratio(out_units,
-                                                                                                                                 **snap.conversion_context())
-
     if snap_slice is None:
         snap_slice = slice(len(snap))
     with snap.immediate_mode:
-        D, h, pos, mass, rho, qtyar = [snap[x].view(
-            np.ndarray)[snap_slice] for x in 'r', 'smooth', 'pos', 'mass', 'rho', qty]
+        D, h, pos, mass, rho, qtyar = [np.ascontiguousarray(snap[x].view(np.ndarray)[snap_slice], dtype=np.float64)
+                                       for x in 'r', 'smooth', 'pos', 'mass', 'rho', qty]
 
     ds = np.arange(kstep, kernel.max_d + kstep / 2, kstep)
     weights = np.zeros_like(ds)
@@ -315,23 +622,38 @@ def _render_spherical_image(snap, qty='rho', nside=8, distance=10.0, kernel=Kern
 
     if kernel.h_power == 3:
         ind = np.where(np.abs(D - distance) < h * kernel.max_d)[0]
-
-        # angular radius subtended by the intersection of the boundary
-        # of the SPH particle with the boundary surface of the calculation:
-        rad = np.arctan(np.sqrt(
-            h[ind, np.newaxis] ** 2 - (D[ind, np.newaxis] - distance) ** 2) / distance)
-
     elif kernel.h_power == 2:
         ind = np.where(D < distance)[0]
-
-        # angular radius taken at distance of particle:
-        rad = np.arctan(
-            h[ind, np.newaxis] * ds[np.newaxis, :] / D[ind, np.newaxis])
     else:
         raise ValueError, "render_spherical_image doesn't know how to handle this kernel"
 
-    im, im2 = _render.render_spherical_image_core(
-        rho, mass, qtyar, pos, D, h, ind, ds, weights, nside)
+    # Each particle is rendered at the lowest resolution on which its
+    # kernel is still at least four pixels in radius, coarsening by a
+    # factor of two per level
+    max_level = int(np.log2(nside))
+    if approximate_fast and len(ind) > 0:
+        pixel_angle = np.sqrt(np.pi / 3) / nside
+        angle = np.arctan(h[ind] * kernel.max_d / D[ind])
+        level = np.clip(np.floor(np.log2(angle / (4 * pixel_angle))), 0, max_level).astype(int)
+    else:
+        level = np.zeros(len(ind), dtype=int)
+
+    im = np.zeros(12 * nside ** 2, dtype=np.float32)
+    im2 = np.zeros_like(im)
+    for l in xrange(max_level + 1):
+        ind_l = ind[level == l].astype(np.int64)
+        if len(ind_l) == 0:
+            continue
+        nside_l = nside >> l
+        im_l, im2_l = _render.render_spherical_image_core(
+            rho, mass, qtyar, pos, D, h, ind_l, ds, weights, nside_l,
+            _healpix_ring_bands(nside_l, 4 * num_threads), num_threads)
+        if l == 0:
+            im += im_l
+            im2 += im2_l
+        else:
+            _render.healpix_add_upsampled(im, nside, im_l, nside_l, num_threads)
+            _render.healpix_add_upsampled(im2, nside, im2_l, nside_l, num_threads)
 
     im = im.view(array.SimArray)
     if denoise:
@@ -392,6 +714,17 @@ def _threaded_render_image(fn, s, *args, **kwargs):
     return sum([o[0] for o in outputs])
 
 
+def _image_bands(y, y1, y2, ny, num_bands):
+    """Return the row boundaries dividing an image of ny rows spanning y1 to y2
+    into num_bands bands, balancing the number of rows plus the number of
+    particles (at positions y) in each band"""
+    per_row = np.histogram(y, bins=ny, range=(y1, y2))[0].astype(np.float64)
+    per_row += per_row.mean() + 1
+    cumulative = np.cumsum(per_row)
+    targets = np.linspace(0, cumulative[-1], num_bands + 1)[1:-1]
+    return np.concatenate(([0], np.searchsorted(cumulative, targets), [ny]))
+
+
 def _interpolated_renderer(fn, levels):
     """
     Render an SPH image using interpolation to speed up rendering where smoothing
@@ -427,6 +760,134 @@ def _render_image_bridge(fn):
     return bridge
 
 
+def _cic_deposit(grid, gx1, gy1, cell_x, cell_y, x, y, weight, wrap_offsets):
+    """Add weight at positions (x, y) onto grid, whose cell (0,0) has its
+    lower-left corner at (gx1, gy1), using cloud-in-cell assignment. Each
+    particle is deposited once for every combination of wrap offsets."""
+    gny, gnx = grid.shape
+    indices = []
+    weights = []
+    for offset_x in wrap_offsets:
+        u = (x + offset_x - gx1) / cell_x - 0.5
+        for offset_y in wrap_offsets:
+            v = (y + offset_y - gy1) / cell_y - 0.5
+            near = (u > -1) & (u < gnx) & (v > -1) & (v < gny)
+            if not near.any():
+                continue
+            u_near, v_near, w_near = u[near], v[near], weight[near]
+            i0 = np.floor(u_near).astype(np.int64)
+            j0 = np.floor(v_near).astype(np.int64)
+            fu = u_near - i0
+            fv = v_near - j0
+            for di, wi in (0, 1 - fu), (1, fu):
+                for dj, wj in (0, 1 - fv), (1, fv):
+                    i = i0 + di
+                    j = j0 + dj
+                    ok = (i >= 0) & (i < gnx) & (j >= 0) & (j < gny)
+                    indices.append(j[ok] * gnx + i[ok])
+                    weights.append((w_near * wi * wj)[ok])
+    if indices:
+        grid += np.bincount(np.concatenate(indices), weights=np.concatenate(weights),
+                            minlength=gnx * gny).reshape(gny, gnx)
+
+
+def _upsample_linear(grid, offset, coarsen, n):
+    """Linearly interpolate the rows of grid onto n points spaced 1/coarsen
+    cells apart, the first lying offset cells from the centre of the first row"""
+    u = offset + (np.arange(n) + 0.5) / coarsen - 0.5
+    i0 = np.minimum(np.floor(u).astype(np.int64), len(grid) - 2)
+    fu = (u - i0).reshape((n,) + (1,) * (grid.ndim - 1))
+    return grid[i0] * (1 - fu) + grid[i0 + 1] * fu
+
+
+def _fft_render_core(nx, ny, x, y, sm, x1, x2, y1, y2, weight, kernel, wrap_offsets,
+                     band_ratio=2 ** 0.25):
+    """Approximately render a projected SPH image of particles at (x, y) with
+    smoothing lengths sm and weights qty*mass/rho.
+
+    Particles are grouped into bands of smoothing length, each a factor
+    *band_ratio* wide. Each band is deposited onto a grid by cloud-in-cell
+    assignment, then convolved once by FFT with the kernel evaluated at the
+    band's central smoothing length. Bands whose kernels span many pixels are
+    handled on grids coarsened by powers of two and interpolated back onto the
+    image. Particles whose kernels fit inside a single pixel are deposited
+    without convolution. The cost is O(N + Npix log Npix) per band, independent
+    of how many pixels each kernel covers. Each band conserves the integral of
+    its particles' kernels, which the exact renderer does not do for sub-pixel
+    particles."""
+    import scipy.signal
+
+    pixel_dx = (x2 - x1) / nx
+    pixel_dy = (y2 - y1) / ny
+    pixel_max = max(pixel_dx, pixel_dy)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    sm = np.asarray(sm, dtype=np.float64)
+    weight = np.asarray(weight, dtype=np.float64)
+
+    samples = kernel.get_samples().astype(np.float64)
+    num_samples = len(samples)
+    max_d_2 = float(kernel.max_d) ** 2
+    # integral of the tabulated kernel over the plane; samples are evenly
+    # spaced in (d/h)^2, so this is independent of h
+    kernel_integral = np.pi * max_d_2 * samples.sum() / num_samples
+
+    result = np.zeros((ny, nx))
+
+    reach = kernel.max_d * sm
+    point_like = (reach < pixel_dx) & (reach < pixel_dy)
+    _cic_deposit(result, x1, y1, pixel_dx, pixel_dy, x[point_like], y[point_like],
+                 weight[point_like] * kernel_integral / (pixel_dx * pixel_dy), wrap_offsets)
+
+    extended = ~point_like
+    x, y, sm, weight = x[extended], y[extended], sm[extended], weight[extended]
+    if len(sm) == 0:
+        return result
+
+    sm_lo = sm.min()
+    band = np.floor(np.log(sm / sm_lo) / np.log(band_ratio)).astype(np.int64)
+    h_band = sm_lo * band_ratio ** (np.unique(band) + 0.5)
+
+    # coarsen each band's grid so that its kernel spans between 8 and 16
+    # cells (or fewer, at full resolution); bands sharing a coarsening share
+    # a grid, so that only one interpolation is needed per level
+    coarsen_band = np.floor(np.log2(kernel.max_d * h_band / (8 * pixel_max)))
+    coarsen_band = 2 ** np.maximum(0, coarsen_band).astype(np.int64)
+    pad_x = int(np.ceil(16 * pixel_max / pixel_dx)) + 1
+    pad_y = int(np.ceil(16 * pixel_max / pixel_dy)) + 1
+
+    for coarsen in np.unique(coarsen_band):
+        cell_x = pixel_dx * coarsen
+        cell_y = pixel_dy * coarsen
+        gnx = (nx + coarsen - 1) // coarsen + 2 * pad_x
+        gny = (ny + coarsen - 1) // coarsen + 2 * pad_y
+        level = np.zeros((gny, gnx))
+
+        for b, h_b in zip(np.unique(band)[coarsen_band == coarsen], h_band[coarsen_band == coarsen]):
+            members = band == b
+            grid = np.zeros((gny, gnx))
+            _cic_deposit(grid, x1 - pad_x * cell_x, y1 - pad_y * cell_y, cell_x, cell_y,
+                         x[members], y[members], weight[members], wrap_offsets)
+
+            kx = np.arange(-pad_x, pad_x + 1) * cell_x
+            ky = np.arange(-pad_y, pad_y + 1) * cell_y
+            d2 = (kx[np.newaxis, :] ** 2 + ky[:, np.newaxis] ** 2) / h_b ** 2
+            index = (num_samples * d2 / max_d_2).astype(np.int64)
+            kernel_image = np.where(index < num_samples,
+                                    samples[np.minimum(index, num_samples - 1)], 0.0)
+            kernel_image *= kernel_integral / (kernel_image.sum() * cell_x * cell_y)
+
+            level += scipy.signal.fftconvolve(grid, kernel_image, mode='same')
+
+        if coarsen == 1:
+            result += level[pad_y:pad_y + ny, pad_x:pad_x + nx]
+        else:
+            level = _upsample_linear(level, pad_y, coarsen, ny)
+            result += _upsample_linear(level.T, pad_x, coarsen, nx).T
+
+    return result
+
+
 def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
                  y1=None, z_plane=0.0, out_units=None, xy_units=None,
                  kernel=Kernel(),
@@ -481,7 +942,11 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
        length in image pixels, rather than in real distance units (default False)
 
      *approximate_fast*: if True, render high smoothing length particles at
-       progressively lower resolution, resample and sum
+       progressively lower resolution, resample and sum. If 'fft', and the
+       image is a projection (2D kernel, no z_camera), instead group particles
+       by smoothing length and convolve each group with its kernel by FFT;
+       this is much faster when smoothing lengths are large compared to
+       pixels. Other images fall back to the True behaviour.
 
      *denoise*: if True, divide through by an estimate of the discreteness noise.
        The returned image is then not strictly an SPH estimate, but this option
@@ -502,7 +967,9 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
         raise ValueError, "Denoising not supported with this kernel type. Re-run with denoise=False"
 
 
-    if approximate_fast:
+    if approximate_fast == 'fft' and kernel.h_power == 2 and z_camera is None:
+        base_renderer = functools.partial(_render_image, fft=True)
+    elif approximate_fast:
         base_renderer = _interpolated_renderer(
             _render_image, int(np.floor(np.log2(nx / 20))))
     else:
@@ -512,10 +979,10 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
         threaded = _get_threaded_image()
 
     if threaded:
-        im = _threaded_render_image(base_renderer, snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
-                                    out_units, xy_units, kernel, z_camera, smooth,
-                                    smooth_in_pixels, True,
-                                    num_threads=threaded)
+        logger.info("Rendering image on %d threads..." % threaded)
+        im = base_renderer(snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
+                           out_units, xy_units, kernel, z_camera, smooth,
+                           smooth_in_pixels, True, num_threads=threaded)
     else:
         im = base_renderer(snap, qty, x2, nx, y2, ny, x1, y1, z_plane,
                            out_units, xy_units, kernel, z_camera, smooth,
@@ -536,13 +1003,313 @@ def render_image(snap, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None,
         return im
 
 
+def _snapshot_hash(snap, arrays, n_samples=1024):
+    """Return a cheap fingerprint of the named arrays of snap, made from their
+    lengths, units and a strided sample of their values. This detects arrays
+    being replaced or transformed as a whole (e.g. by recentering), but not
+    edits to a handful of particles."""
+    checksum = hashlib.md5(np.array([len(snap)]).tobytes())
+    for name in arrays:
+        ar = snap[name]
+        checksum.update((name + str(getattr(ar, 'units', ''))).encode())
+        checksum.update(np.ascontiguousarray(ar[::max(1, len(ar) // n_samples)]).data)
+    return checksum.hexdigest()
+
+
+class ImagePyramid(object):
+    """A cache of SPH images of a snapshot, stored as square tiles at a
+    series of resolutions differing by factors of two, for interactive
+    panning and zooming.
+
+    Each call to :func:`~pynbody.sph.ImagePyramid.render_image` renders
+    only the tiles that are not already held (in one pass over the
+    particles for each rectangle of missing tiles) and resamples the cached
+    tiles onto the requested pixels.
+    Tiles are discarded, least recently used first, when their total size
+    exceeds *max_megabytes* (default from the image-cache-megabytes option
+    in your configuration files).
+
+    The finest tile pixels have the size of the pixels in the first image
+    requested (or *base_pixel*, in xy_units, if given). Requests whose pixels
+    line up with the tiles -- e.g. the first image, or that image zoomed by a
+    factor of two or panned by a whole number of pixels -- reproduce
+    :func:`~pynbody.sph.render_image` with approximate_fast=False, up to
+    rounding in the pixel positions; others are linearly interpolated from
+    the next finer level.
+
+    Tiles are keyed on the rendering parameters and on a fingerprint of the
+    arrays used (see :func:`~pynbody.sph._snapshot_hash`). Call
+    :func:`~pynbody.sph.ImagePyramid.clear` after changing a few particles
+    in place, since such an edit may not alter the fingerprint.
+    """
+
+    def __init__(self, snap, tile_size=256, max_megabytes=None, base_pixel=None, **render_kwargs):
+        """Create a cache for *snap*, rendering tiles of *tile_size* pixels square.
+        Any further keyword arguments are passed to
+        :func:`~pynbody.sph.render_image` whenever tiles are rendered."""
+        if max_megabytes is None:
+            max_megabytes = _image_cache_megabytes
+        self.snap = snap
+        self.tile_size = int(tile_size)
+        self.max_bytes = int(max_megabytes * 2 ** 20)
+        self._base_pixel = base_pixel
+        self._render_kwargs = dict(approximate_fast=False)
+        self._render_kwargs.update(render_kwargs)
+        self._tiles = backcompat.OrderedDict()
+        self.nbytes = 0
+        self.n_tiles_rendered = 0
+        self.n_pixels_rendered = 0
+
+    def clear(self):
+        """Discard all cached tiles"""
+        self._tiles.clear()
+        self.nbytes = 0
+
+    def _get_tile(self, key):
+        tile = self._tiles.pop(key, None)
+        if tile is not None:
+            self._tiles[key] = tile
+        return tile
+
+    def _store_tile(self, key, tile):
+        self._tiles[key] = tile
+        self.nbytes += tile[0].nbytes
+        while self.nbytes > self.max_bytes and len(self._tiles) > 0:
+            _, (data, _) = self._tiles.popitem(last=False)
+            self.nbytes -= data.nbytes
+
+    @staticmethod
+    def _tile_rectangles(tile_indices):
+        """Split a set of (i,j) tile indices into rectangles (i0, i1, j0, j1),
+        made of runs of consecutive tiles in each row, merged with the runs
+        spanning the same columns in the rows above"""
+        rows = {}
+        for i, j in tile_indices:
+            rows.setdefault(j, []).append(i)
+
+        runs = []
+        for j in sorted(rows):
+            i_row = sorted(rows[j])
+            start = 0
+            for k in range(1, len(i_row) + 1):
+                if k == len(i_row) or i_row[k] != i_row[k - 1] + 1:
+                    runs.append((i_row[start], i_row[k - 1] + 1, j))
+                    start = k
+
+        rectangles = []
+        open_rectangles = {}
+        for i0, i1, j in runs:
+            rect = open_rectangles.get((i0, i1))
+            if rect is not None and rect[3] == j:
+                rect[3] = j + 1
+            else:
+                rect = [i0, i1, j, j + 1]
+                rectangles.append(rect)
+                open_rectangles[(i0, i1)] = rect
+        return [tuple(rect) for rect in rectangles]
+
+    def _render_tiles(self, settings, pixel, tile_indices):
+        """Render the tiles with the given (i,j) indices, one image for each
+        rectangle of tiles, returning a dictionary of (data, units) by index"""
+        tiles = {}
+        for rectangle in self._tile_rectangles(tile_indices):
+            tiles.update(self._render_rectangle(settings, pixel, *rectangle))
+        return tiles
+
+    def _render_rectangle(self, settings, pixel, i0, i1, j0, j1):
+        """Render the tiles with i0<=i<i1, j0<=j<j1 in a single image,
+        returning a dictionary of (data, units) by index"""
+        tile_width = pixel * self.tile_size
+        qty, out_units, xy_units, kernel, z_plane, smooth, render_kwargs = settings
+
+        im = render_image(self.snap, qty, x2=i1 * tile_width, nx=(i1 - i0) * self.tile_size,
+                          y2=j1 * tile_width, ny=(j1 - j0) * self.tile_size,
+                          x1=i0 * tile_width, y1=j0 * tile_width, z_plane=z_plane,
+                          out_units=out_units, xy_units=xy_units, kernel=kernel,
+                          smooth=smooth, force_quiet=True, **render_kwargs)
+        self.n_tiles_rendered += (i1 - i0) * (j1 - j0)
+        self.n_pixels_rendered += im.size
+
+        tiles = {}
+        n = self.tile_size
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                data = np.array(im[(j - j0) * n:(j - j0 + 1) * n, (i - i0) * n:(i - i0 + 1) * n].view(np.ndarray))
+                tiles[(i, j)] = (data, im.units)
+        return tiles
+
+    def render_image(self, qty='rho', x2=100, nx=500, y2=None, ny=None, x1=None, y1=None,
+                     z_plane=0.0, out_units=None, xy_units=None, kernel=Kernel(), smooth='smooth',
+                     **kwargs):
+        """Return an image of the snapshot, using cached tiles where possible.
+        The arguments are as for :func:`~pynbody.sph.render_image`, except that
+        perspective images (z_camera) are not supported."""
+
+        if kwargs.get('z_camera', None) is not None:
+            raise ValueError, "ImagePyramid cannot render perspective images"
+
+        if y2 is None:
+            if ny is not None:
+                y2 = x2 * float(ny) / nx
+            else:
+                y2 = x2
+        if ny is None:
+            ny = nx
+        if x1 is None:
+            x1 = -x2
+        if y1 is None:
+            y1 = -y2
+        x1, x2, y1, y2 = [float(q) for q in x1, x2, y1, y2]
+
+        dx = (x2 - x1) / nx
+        dy = (y2 - y1) / ny
+        if self._base_pixel is None:
+            self._base_pixel = min(dx, dy)
+
+        level = int(np.floor(np.log2(min(dx, dy) / self._base_pixel) + 1.e-6))
+        pixel = self._base_pixel * 2.0 ** level
+        tile_width = pixel * self.tile_size
+
+        render_kwargs = dict(self._render_kwargs)
+        render_kwargs.update(kwargs)
+        render_kwargs.pop('z_camera', None)
+        settings = (qty, out_units, xy_units, kernel, float(z_plane), smooth, render_kwargs)
+        key_base = (qty, str(out_units), str(xy_units), type(kernel).__name__, kernel.h_power,
+                    kernel.max_d, float(z_plane), smooth, repr(sorted(render_kwargs.items())),
+                    _snapshot_hash(self.snap, ['x', 'y', 'z', smooth, qty, 'rho', 'mass']), level)
+
+        # the tiles covering the image, plus a pixel's margin for interpolation
+        i_range = range(int(np.floor((x1 - pixel) / tile_width)), int(np.floor((x2 + pixel) / tile_width)) + 1)
+        j_range = range(int(np.floor((y1 - pixel) / tile_width)), int(np.floor((y2 + pixel) / tile_width)) + 1)
+
+        tiles = {}
+        for i in i_range:
+            for j in j_range:
+                tile = self._get_tile(key_base + (i, j))
+                if tile is not None:
+                    tiles[(i, j)] = tile
+
+        missing = [(i, j) for i in i_range for j in j_range if (i, j) not in tiles]
+        if missing:
+            new_tiles = self._render_tiles(settings, pixel, missing)
+            for index, tile in new_tiles.iteritems():
+                self._store_tile(key_base + index, tile)
+            tiles.update(new_tiles)
+
+        n = self.tile_size
+        mosaic = np.empty((len(j_range) * n, len(i_range) * n), dtype=np.float32)
+        for (i, j), (data, units_) in tiles.iteritems():
+            mosaic[(j - j_range[0]) * n:(j - j_range[0] + 1) * n,
+                   (i - i_range[0]) * n:(i - i_range[0] + 1) * n] = data
+
+        # positions of the requested pixel centres in mosaic pixel coordinates
+        u = (x1 + (np.arange(nx) + 0.5) * dx - i_range[0] * tile_width) / pixel - 0.5
+        v = (y1 + (np.arange(ny) + 0.5) * dy - j_range[0] * tile_width) / pixel - 0.5
+        u0, v0 = int(round(u[0])), int(round(v[0]))
+
+        if abs(dx / pixel - 1) < 1.e-6 and abs(dy / pixel - 1) < 1.e-6 \
+                and abs(u[0] - u0) < 1.e-4 and abs(v[0] - v0) < 1.e-4:
+            result = mosaic[v0:v0 + ny, u0:u0 + nx].copy()
+        else:
+            vv, uu = np.meshgrid(v, u, indexing='ij')
+            result = scipy.ndimage.map_coordinates(mosaic, [vv, uu], order=1, mode='nearest')
+
+        result = result.view(array.SimArray)
+        result.units = units_
+        result.sim = self.snap
+        return result
+
+
+def _select_in_view(snap, x, y, z, sm, xy_units, lower, upper, margin,
+                    smooth_limits=None, wrap_offsets=(0.0,), smooth_in_pixels=False,
+                    use_tree=True, chunk_size=2 ** 20):
+    """Return the (sorted) indices of the particles, with positions x, y, z and
+    smoothing lengths sm, whose kernels may overlap the box between the
+    corners *lower* and *upper* (given in xy_units; use infinite values for
+    unbounded axes), or None if all particles may.
+
+    A particle is selected if each coordinate lies within margin[axis]*sm
+    of the box, after adding one of the *wrap_offsets* to x and y, and its
+    smoothing length lies between the *smooth_limits*. These are the tests
+    applied by the rendering core, made slightly more generous so that no
+    particle it would render is excluded. Candidates are found with the
+    KDTree of snap if it has one; otherwise all particles are tested.
+    """
+    context = snap.conversion_context()
+    length_ratio = x.units.ratio(xy_units, **context) if x.units != xy_units else 1.0
+    if smooth_in_pixels or sm.units == xy_units:
+        sm_ratio = 1.0
+    else:
+        sm_ratio = sm.units.ratio(xy_units, **context)
+
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    margin = np.asarray(margin, dtype=np.float64)
+    slack = 1.0 + 1.e-6
+    coords = [np.asarray(q) for q in (x, y, z)]
+    sm = np.asarray(sm)
+
+    candidates = None
+    tree = getattr(snap, 'kdtree', None) if use_tree else None
+    if tree is not None and tree.s_len == len(x) and np.isfinite(lower).all() and np.isfinite(upper).all():
+        # all particles within the sphere enclosing the box plus the largest
+        # kernel are candidates
+        radius = np.sqrt((((upper - lower) / 2 + margin * float(sm.max()) * sm_ratio) ** 2).sum())
+        radius = radius * slack / length_ratio
+        period = tree.boxsize if tree.boxsize > 0 else None
+        if len(wrap_offsets) == 1 or (period is not None and radius < period / 2):
+            centre = (upper + lower) / (2 * length_ratio)
+            candidates = np.zeros(len(x), dtype=bool)
+            candidates[tree.query_ball(centre[np.newaxis, :], radius)[1]] = True
+            candidates = np.where(candidates)[0]
+
+    n = len(x) if candidates is None else len(candidates)
+    selected = []
+    for i0 in xrange(0, n, chunk_size):
+        if candidates is None:
+            index = np.arange(i0, min(i0 + chunk_size, n))
+        else:
+            index = candidates[i0:i0 + chunk_size]
+
+        sm_i = sm[index].astype(np.float64) * sm_ratio
+        if smooth_limits is not None:
+            ok = (sm_i >= smooth_limits[0] / slack) & (sm_i <= smooth_limits[1] * slack)
+            index, sm_i = index[ok], sm_i[ok]
+
+        # test the z axis first, since for a thin slice it usually rejects most
+        for axis in (2, 0, 1):
+            if not (np.isfinite(lower[axis]) or np.isfinite(upper[axis])):
+                continue
+            c = coords[axis][index].astype(np.float64) * length_ratio
+            reach = margin[axis] * sm_i * slack + np.abs(c) * 1.e-6
+            ok = np.zeros(len(c), dtype=bool)
+            for offset in (wrap_offsets if axis < 2 else (0.0,)):
+                ok |= (c + offset > lower[axis] - reach) & (c + offset < upper[axis] + reach)
+            index, sm_i = index[ok], sm_i[ok]
+
+        selected.append(index)
+
+    selected = np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64)
+    if len(selected) == len(x):
+        return None
+    return selected
+
+
 def _render_image(snap, qty, x2, nx, y2, ny, x1,
                   y1, z_plane, out_units, xy_units, kernel, z_camera,
                   smooth, smooth_in_pixels,  force_quiet,
                   smooth_range=None, res_downgrade=None, snap_slice=None,
-                  __threaded=False):
-    """The single-threaded image rendering core function. External calls
-    should be made to the render_image function."""
+                  __threaded=False, num_threads=None, fft=False):
+    """The image rendering core function. External calls should be made to
+    the render_image function.
+
+    If *num_threads* is given, the image is divided into that many bands of
+    rows, each rendered into the same output array by its own thread. The
+    result is identical to a single-threaded render.
+
+    If *fft* is True, the image is instead rendered approximately by
+    :func:`_fft_render_core`. This requires a projected (2D) kernel and
+    no perspective camera."""
 
     import os
     import os.path
@@ -553,7 +1320,7 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
     snap_proxy = {}
 
     # cache the arrays and take a slice of them if we've been asked to
-    for arname in 'x', 'y', 'z', 'pos', smooth, qty, 'rho', 'mass':
+    for arname in 'x', 'y', 'z', smooth, qty, 'rho', 'mass':
         snap_proxy[arname] = snap[arname]
         if snap_slice is not None:
             snap_proxy[arname] = snap_proxy[arname][snap_slice]
@@ -615,6 +1382,32 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
     if xy_units is None:
         xy_units = snap_proxy['x'].units
 
+    if z_camera is None:
+        z_camera = 0.0
+
+    if boxsize:
+        # work out the tile offsets required to make the image wrap
+        num_repeats = int(round(x2/boxsize))+1
+        repeat_array = np.linspace(-num_repeats*boxsize,num_repeats*boxsize,num_repeats*2+1)
+    else:
+        repeat_array = [0.0]
+
+    if z_camera == 0.0:
+        # gather only the particles whose kernels can reach the image
+        if kernel.h_power == 3:
+            z_lower, z_upper = 0.0, 0.0
+        else:
+            z_lower, z_upper = -np.inf, np.inf
+        pixel_dx = (x2 - x1) / nx
+        selection = _select_in_view(snap, snap_proxy['x'], snap_proxy['y'], snap_proxy['z'],
+                                    snap_proxy[smooth], xy_units,
+                                    [x1, y1, z_lower], [x2, y2, z_upper], [2, 2, kernel.max_d],
+                                    (pixel_dx * smooth_lo, pixel_dx * smooth_hi), repeat_array,
+                                    smooth_in_pixels, use_tree=snap_slice is None)
+        if selection is not None:
+            for arname in snap_proxy:
+                snap_proxy[arname] = snap_proxy[arname][selection]
+
     x = snap_proxy['x'].in_units(xy_units)
     y = snap_proxy['y'].in_units(xy_units)
     z = snap_proxy['z'].in_units(xy_units)
@@ -635,18 +1428,29 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
         conv_ratio = (qty.units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(out_units,
                                                                                                **snap.conversion_context())
 
-    if z_camera is None:
-        z_camera = 0.0
+    if fft:
+        assert kernel.h_power == 2 and z_camera == 0.0, "FFT rendering requires a projected image"
+        result = _fft_render_core(nx, ny, x, y, sm, x1, x2, y1, y2,
+                                  np.asarray(qty) * np.asarray(mass) / np.asarray(rho),
+                                  kernel, repeat_array).astype(np.float32)
+    elif num_threads:
+        result = np.zeros((ny, nx), dtype=np.float32)
 
-    if boxsize:
-        # work out the tile offsets required to make the image wrap
-        num_repeats = int(round(x2/boxsize))+1
-        repeat_array = np.linspace(-num_repeats*boxsize,num_repeats*boxsize,num_repeats*2+1)
-    else:
-        repeat_array = [0.0]
+        if z_camera == 0.0:
+            bands = _image_bands(y, y1, y2, ny, num_threads)
+        else:
+            # rows depend on depth in a perspective image, so just divide evenly
+            bands = np.linspace(0, ny, num_threads + 1).astype(int)
+
+        def render_band(y_pix_min, y_pix_max):
+            _render.render_image(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, 0.0, qty, mass, rho,
+                                 smooth_lo, smooth_hi, kernel, repeat_array, repeat_array,
+                                 result, (y_pix_min, y_pix_max))
 
-    result = _render.render_image(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, 0.0, qty, mass, rho,
-                                  smooth_lo, smooth_hi, kernel, repeat_array, repeat_array)
+        _thread_map(render_band, bands[:-1], bands[1:])
+    else:
+        result = _render.render_image(nx, ny, x, y, z, sm, x1, x2, y1, y2, z_camera, 0.0, qty, mass, rho,
+                                      smooth_lo, smooth_hi, kernel, repeat_array, repeat_array)
 
     result = result.view(array.SimArray)
 
@@ -672,7 +1476,8 @@ def _render_image(snap, qty, x2, nx, y2, ny, x1,
 
 def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=None,
                xy_units=None, kernel=Kernel(), smooth='smooth', approximate_fast=_approximate_image,
-               threaded=None, snap_slice=None, denoise=None):
+               threaded=None, snap_slice=None, denoise=None, filename=None, slab_megabytes=256,
+               conserve_mass=True):
     """
 
     Project SPH onto a grid using a typical (mass/rho)-weighted 'scatter'
@@ -702,6 +1507,21 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
       can be useful to reduce noise especially when rendering AMR grids which
       often introduce problematic edge effects.
 
+    *threaded*: if False, render on a single core. Otherwise, the number
+      of threads to use, each filling its own slab of the grid (default from
+      your configuration files).
+
+    *filename*: if set, the grid is written to this .npy file one slab of
+      at most *slab_megabytes* at a time, so that the whole grid never needs
+      to be held in memory, and a memory-mapped view of the file is returned.
+      Each slab is rendered exactly, i.e. approximate_fast is ignored.
+
+    *conserve_mass* (True): if True, each particle's kernel is normalised
+      over the cells it reaches, so that the grid integrates to the total
+      qty*mass/rho of the particles even when their smoothing lengths are
+      comparable to or smaller than the cells. If False, the kernel is
+      simply sampled at the cell centres.
+
     """
 
     import os
@@ -740,21 +1560,28 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
     x1, x2, y1, y2, z1, z2 = [float(q) for q in x1, x2, y1, y2, z1, z2]
     nx, ny, nz = [int(q) for q in nx, ny, nz]
 
+    if threaded is None:
+        threaded = _get_threaded_image()
+
+    if filename is not None:
+        return _to_3d_grid_file(snap, filename, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                                xy_units, kernel, smooth, threaded, denoise, slab_megabytes,
+                                conserve_mass)
+
     if approximate_fast:
         renderer = _interpolated_renderer(
             _to_3d_grid, int(np.floor(np.log2(nx / 20))))
     else:
         renderer = _to_3d_grid
 
-    if threaded is None:
-        threaded = _get_threaded_image()
-
     if threaded:
-        im = _threaded_render_image(renderer, snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
-                                    xy_units, kernel, smooth, num_threads=threaded)
+        logger.info("Rendering grid on %d threads..." % threaded)
+        im = renderer(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                      xy_units, kernel, smooth, True, num_threads=threaded,
+                      conserve_mass=conserve_mass)
     else:
         im = renderer(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
-                      xy_units, kernel, smooth, False)
+                      xy_units, kernel, smooth, False, conserve_mass=conserve_mass)
 
     logger.info("Render done at %.2f s" % (time.time() - in_time))
 
@@ -762,7 +1589,7 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
         # call self to render a 'flat field'
         snap['__one'] = 1
         im2 = to_3d_grid(snap, '__one', nx, ny, nz, x2, None, xy_units, kernel, smooth,
-                         approximate_fast, threaded, snap_slice, False)
+                         approximate_fast, threaded, snap_slice, False, conserve_mass=conserve_mass)
         del snap.ancestor['__one']
         im2 = im / im2
         im2.units = im.units
@@ -772,15 +1599,58 @@ def to_3d_grid(snap, qty='rho', nx=None, ny=None, nz=None, x2=None, out_units=No
         return im
 
 
+def _to_3d_grid_file(snap, filename, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                     xy_units, kernel, smooth, threaded, denoise, slab_megabytes, conserve_mass):
+    """Render a grid into a .npy file in slabs of x planes, returning a
+    memory-mapped view of the result. See to_3d_grid."""
+
+    grid = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(nx, ny, nz))
+    slab_size = max(int(slab_megabytes * 2 ** 20) // (4 * ny * nz), threaded or 1, 1)
+
+    if denoise:
+        snap['__one'] = 1
+
+    try:
+        for x_pix_min in xrange(0, nx, slab_size):
+            x_pix_range = (x_pix_min, min(x_pix_min + slab_size, nx))
+            slab = _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
+                               xy_units, kernel, smooth, num_threads=threaded, x_pix_range=x_pix_range,
+                               conserve_mass=conserve_mass)
+            if denoise:
+                units_ = slab.units
+                slab /= _to_3d_grid(snap, '__one', nx, ny, nz, x1, x2, y1, y2, z1, z2, None,
+                                    xy_units, kernel, smooth, num_threads=threaded, x_pix_range=x_pix_range,
+                                    conserve_mass=conserve_mass)
+                slab.units = units_
+            grid[x_pix_range[0]:x_pix_range[1]] = slab
+            logger.info("Written planes %d to %d of %d" % (x_pix_range[0], x_pix_range[1], nx))
+    finally:
+        if denoise:
+            del snap.ancestor['__one']
+
+    grid.flush()
+    grid = grid.view(array.SimArray)
+    grid.units = slab.units
+    grid.sim = snap
+    return grid
+
+
 def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
                 xy_units, kernel, smooth, __threaded=False, res_downgrade=None,
                 snap_slice=None,
-                smooth_range=None):
+                smooth_range=None, num_threads=None, x_pix_range=None, conserve_mass=True):
+    """The grid rendering core function. External calls should be made to
+    the to_3d_grid function.
+
+    If *x_pix_range* = (x_pix_min, x_pix_max) is given, only that slab of
+    x planes is rendered. If *num_threads* is given, the (slab of the) grid is
+    divided into that many slabs, each rendered by its own thread. The
+    result is identical to a single-threaded render."""
 
     snap_proxy = {}
 
     # cache the arrays and take a slice of them if we've been asked to
-    for arname in 'x', 'y', 'z', 'pos', smooth, qty, 'rho', 'mass':
+    for arname in 'x', 'y', 'z', smooth, qty, 'rho', 'mass':
         snap_proxy[arname] = snap[arname]
 
         if snap_slice is not None:
@@ -805,12 +1675,32 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
         y2 += sy
         z2 += sz
 
-    result = np.zeros((nx, ny, nz), dtype=np.float32)
-    n_part = len(snap)
+    if x_pix_range is None:
+        x_pix_range = (0, nx)
+    x_pix_min, x_pix_max = x_pix_range
 
     if xy_units is None:
         xy_units = snap_proxy['x'].units
 
+    if smooth_range is not None:
+        smooth_lo = float(smooth_range[0])
+        smooth_hi = float(smooth_range[1])
+    else:
+        smooth_lo = 0.0
+        smooth_hi = 100000.0
+
+    # gather only the particles whose kernels can reach the grid
+    pixel_dx = (x2 - x1) / nx
+    selection = _select_in_view(snap, snap_proxy['x'], snap_proxy['y'], snap_proxy['z'],
+                                snap_proxy[smooth], xy_units,
+                                [x1 + pixel_dx * x_pix_min, y1, z1], [x1 + pixel_dx * x_pix_max, y2, z2],
+                                [max(2, kernel.max_d), 2, 2],
+                                (pixel_dx * smooth_lo, pixel_dx * smooth_hi),
+                                use_tree=snap_slice is None)
+    if selection is not None:
+        for arname in snap_proxy:
+            snap_proxy[arname] = snap_proxy[arname][selection]
+
     x = snap_proxy['x'].in_units(xy_units)
     y = snap_proxy['y'].in_units(xy_units)
     z = snap_proxy['z'].in_units(xy_units)
@@ -831,17 +1721,25 @@ def _to_3d_grid(snap, qty, nx, ny, nz, x1, x2, y1, y2, z1, z2, out_units,
         conv_ratio = (qty.units * mass.units / (rho.units * sm.units ** kernel.h_power)).ratio(out_units,
                                                                                                **x.conversion_context())
 
-    if smooth_range is not None:
-        smooth_lo = float(smooth_range[0])
-        smooth_hi = float(smooth_range[1])
-    else:
-        smooth_lo = 0.0
-        smooth_hi = 100000.0
-
     logger.info("Gridding particles")
 
-    result = _render.to_3d_grid(nx,ny,nz,x,y,z,sm,x1,x2,y1,y2,z1,z2,
-                                qty,mass,rho,smooth_lo,smooth_hi,kernel)
+    result = np.zeros((x_pix_max - x_pix_min, ny, nz), dtype=np.float32)
+
+    if num_threads:
+        slabs = _image_bands(x, x1 + pixel_dx * x_pix_min, x1 + pixel_dx * x_pix_max,
+                             x_pix_max - x_pix_min, num_threads) + x_pix_min
+
+        def render_slab(slab_min, slab_max):
+            _render.to_3d_grid(nx, ny, nz, x, y, z, sm, x1, x2, y1, y2, z1, z2,
+                               qty, mass, rho, smooth_lo, smooth_hi, kernel,
+                               result[slab_min - x_pix_min:slab_max - x_pix_min], (slab_min, slab_max),
+                               conserve_mass)
+
+        _thread_map(render_slab, slabs[:-1], slabs[1:])
+    else:
+        _render.to_3d_grid(nx, ny, nz, x, y, z, sm, x1, x2, y1, y2, z1, z2,
+                           qty, mass, rho, smooth_lo, smooth_hi, kernel,
+                           result, x_pix_range, conserve_mass)
     result = result.view(array.SimArray)
 
     # The weighting works such that there is a factor of (M_u/rho_u)h_u^3
@@ -982,3 +1880,156 @@ def spectra(snap, qty='rho', x1=0.0, y1=0.0, v2=400, nvel=200, v1=None,
 
     tau.sim = snap
     return vels, tau
+
+
+def _sightline_index(x, y, reach, x_los, y_los, cell_size):
+    """Bin the lines of sight through (x_los, y_los) into square cells of
+    the given size, listing against each cell the particles whose footprint
+    (a disc of radius *reach* around (x,y)) overlaps it.
+
+    Returns (los_cell, offsets, indices), such that the particles that may
+    cross line of sight j are indices[offsets[los_cell[j]]:offsets[los_cell[j]+1]]."""
+
+    x0, y0 = x_los.min(), y_los.min()
+    ncx = int((x_los.max() - x0) / cell_size) + 1
+    ncy = int((y_los.max() - y0) / cell_size) + 1
+
+    los_cell = (((y_los - y0) / cell_size).astype(np.int64) * ncx
+                + ((x_los - x0) / cell_size).astype(np.int64))
+
+    ix0 = np.clip(np.floor((x - reach - x0) / cell_size), 0, ncx - 1).astype(np.int64)
+    ix1 = np.clip(np.floor((x + reach - x0) / cell_size), 0, ncx - 1).astype(np.int64)
+    iy0 = np.clip(np.floor((y - reach - y0) / cell_size), 0, ncy - 1).astype(np.int64)
+    iy1 = np.clip(np.floor((y + reach - y0) / cell_size), 0, ncy - 1).astype(np.int64)
+    nx_i = ix1 - ix0 + 1
+    counts = nx_i * (iy1 - iy0 + 1)
+
+    # one entry for every cell overlapped by every particle
+    particle = np.repeat(np.arange(len(x), dtype=np.int64), counts)
+    k = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell = (iy0[particle] + k // nx_i[particle]) * ncx + ix0[particle] + k % nx_i[particle]
+    del k
+
+    order = np.argsort(cell, kind='mergesort')
+    indices = particle[order]
+    offsets = np.searchsorted(cell[order], np.arange(ncx * ncy + 1)).astype(np.int64)
+    return los_cell, offsets, indices
+
+
+def spectra_batch(snap, sightlines, qty='rho', v2=400, nvel=200, v1=None,
+                  element='H', xy_units=units.Unit('kpc'), vel_units=units.Unit('km s^-1'),
+                  smooth='smooth', cell_size=None, num_threads=None):
+    """
+
+    Generate SPH absorption spectra along many lines of sight parallel to
+    the z axis at once.
+
+    The particles are first indexed on a 2D grid according to the cells
+    their kernels overlap, so that each line of sight only visits the
+    particles that may cross it, and the spectra are then accumulated in
+    compiled code, shared between OpenMP threads.
+
+    Each particle contributes its column density, Doppler broadened
+    according to its z velocity and thermal width, with the same line
+    constants as :func:`~pynbody.sph.spectra`.
+
+    **Keyword arguments:**
+
+    *sightlines*: An (n,2) array of the x and y coordinates of the lines
+     of sight, in xy_units
+
+    *qty* ('rho'): The name of the array within the simulation to render
+
+    *v1* (-v2): The minimum velocity of the spectra
+
+    *v2* (400.0): The maximum velocity of the spectra
+
+    *nvel* (200): The number of resolution elements in each spectrum
+
+    *element* ('H'): The element whose nucleon number sets the thermal
+      width and the column density units
+
+    *xy_units* ('kpc'): The units for the x and y coordinates
+
+    *vel_units* ('km s^-1'): The units for the velocities
+
+    *smooth*: The name of the array which contains the smoothing lengths
+      (default 'smooth')
+
+    *cell_size*: The size of the cells used to index the particles, in
+      xy_units (default: the larger of the median kernel radius and the
+      typical separation of the lines of sight)
+
+    *num_threads*: The number of threads to use (default from your
+      configuration files)
+
+    **Returns:** (vels, tau), the velocities of the bin centres and an
+      (n, nvel) array of optical depths
+
+    """
+
+    kernel = Kernel2D()
+
+    if v1 is None:
+        v1 = -v2
+    v1, v2, nvel = float(v1), float(v2), int(nvel)
+    dvel = (v2 - v1) / nvel
+    vels = np.arange(v1 + 0.5 * dvel, v2, dvel)[:nvel]
+
+    if num_threads is None:
+        num_threads = config['number_of_threads']
+
+    sightlines = np.asarray(sightlines, dtype=np.float64).reshape((-1, 2))
+    x_los, y_los = np.ascontiguousarray(sightlines[:, 0]), np.ascontiguousarray(sightlines[:, 1])
+
+    x = snap['x'].in_units(xy_units).view(np.ndarray)
+    y = snap['y'].in_units(xy_units).view(np.ndarray)
+    sm = snap[smooth].in_units(xy_units).view(np.ndarray)
+    reach = sm * kernel.max_d
+
+    # only the particles that can reach one of the lines of sight are needed
+    use = np.where((x + reach >= x_los.min()) & (x - reach <= x_los.max()) &
+                   (y + reach >= y_los.min()) & (y - reach <= y_los.max()))[0]
+
+    x, y, sm, reach = [np.ascontiguousarray(q[use], dtype=np.float64) for q in x, y, sm, reach]
+
+    nucleons = {'H': 1, 'He': 4, 'Li': 6, 'Ne': 10, 'C': 12, 'N': 14, 'O': 16, 'Mg': 24, 'Si': 28,
+                'S': 32, 'Ca': 40, 'Fe': 56}
+    nnucleons = nucleons[element]
+
+    vz = snap['vz'][use].in_units(vel_units).view(np.ndarray).astype(np.float64)
+    temp = snap['temp'][use].in_units('K').view(np.ndarray).astype(np.float64)
+    b = np.sqrt((2 * units.k * units.Unit('K') / (nnucleons * units.m_p)).ratio(units.Unit(vel_units) ** 2) * temp)
+    b = np.maximum(b, 1.e-3 * dvel)
+
+    qty = snap[qty]
+    mass = snap['mass']
+    rho = snap['rho']
+    conv_ratio = (qty.units * mass.units / (rho.units * units.Unit(xy_units) ** kernel.h_power)).ratio(
+        str(nnucleons) + ' m_p cm^-2', **snap.conversion_context())
+    column = (qty[use] * mass[use] / rho[use]).view(np.ndarray).astype(np.float64) * conv_ratio
+
+    if cell_size is None:
+        area = max(np.ptp(x_los) * np.ptp(y_los), 0)
+        cell_size = max(np.median(reach) if len(reach) else 0, np.sqrt(area / len(x_los)))
+        if cell_size <= 0:
+            cell_size = 1.0
+
+    los_cell, offsets, indices = _sightline_index(x, y, reach, x_los, y_los, float(cell_size))
+
+    tau = _render.render_spectra(x_los, y_los, los_cell, offsets, indices, x, y,
+                                 np.ascontiguousarray(vz), np.ascontiguousarray(b), sm,
+                                 np.ascontiguousarray(column), v1, v2, nvel, kernel, int(num_threads))
+
+    mass_e = 9.10938188e-28
+    e = 4.803206e-10
+    c = 2.99792458e10
+    pi = 3.14159267
+    tauconst = pi * e * e / mass_e / c / np.sqrt(pi)
+    oscwav0 = 1031.9261 * 0.13250 * 1e-8
+    # the profiles were normalised by b in vel_units rather than cm s^-1
+    tau *= tauconst * oscwav0 / units.Unit(vel_units).ratio('cm s^-1')
+
+    tau = tau.view(array.SimArray)
+    tau.sim = snap
+    return vels, tau
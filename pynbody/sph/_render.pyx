@@ -4,7 +4,8 @@ cimport numpy as np
 cimport cython
 cimport libc.math as cmath
 from libc.math cimport atan, pow
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, realloc, free
+from cython.parallel cimport prange
 
 # The following slightly odd repetitiveness is to force Cython to generate
 # code for different permutations of the possible integer inputs.
@@ -41,58 +42,231 @@ ctypedef np.float64_t fixed_input_type
 
 
 
+# The following healpix routines follow the RING scheme conventions of
+# Gorski et al (2005), so that the maps are interchangeable with those
+# produced by healpy. Rings are numbered from 1 (north) to 4*nside-1 (south).
+
+@cython.cdivision(True)
+cdef inline void _healpix_ring_info(long nside, long ring, long* n_pix, long* first_pix,
+                                   double* z, double* offset) nogil :
+    """Get the number of pixels, index of the first pixel, z coordinate and
+    azimuthal offset (in units of the pixel spacing) of the given ring"""
+    cdef long r
+    if ring<nside :
+        n_pix[0] = 4*ring
+        first_pix[0] = 2*ring*(ring-1)
+        z[0] = 1.0-(ring*ring)/(3.0*nside*nside)
+        offset[0] = 0.5
+    elif ring<=3*nside :
+        n_pix[0] = 4*nside
+        first_pix[0] = 2*nside*(nside-1)+(ring-nside)*4*nside
+        z[0] = 4.0/3-(2.0*ring)/(3.0*nside)
+        if (ring+nside)&1 :
+            offset[0] = 0.0
+        else :
+            offset[0] = 0.5
+    else :
+        r = 4*nside-ring
+        n_pix[0] = 4*r
+        first_pix[0] = 12*nside*nside-2*r*(r+1)
+        z[0] = -1.0+(r*r)/(3.0*nside*nside)
+        offset[0] = 0.5
+
+
+@cython.cdivision(True)
+cdef inline long _healpix_ring_above(long nside, double z) nogil :
+    """Return the number of the last ring with z coordinate >= the given z
+    (or 0 if there is none)"""
+    cdef double za = cmath.fabs(z)
+    cdef long ring
+    if za<=2.0/3 :
+        ring = <long>(nside*(2-1.5*z))
+    else :
+        ring = <long>(nside*cmath.sqrt(3*(1-za)))
+        if z<0 :
+            ring = 4*nside-ring-1
+    return ring
+
+
+@cython.cdivision(True)
+cdef inline long _healpix_ang2pix(long nside, double z, double phi) nogil :
+    """Return the index of the pixel containing the direction (z, phi)"""
+    cdef double za = cmath.fabs(z)
+    cdef double tt = cmath.fmod(phi, 2*cmath.M_PI)
+    cdef double temp1, temp2, tp, tmp
+    cdef long jp, jm, ir, ip, kshift
+    if tt<0 :
+        tt+=2*cmath.M_PI
+    tt/=cmath.M_PI/2
+
+    if za<=2.0/3 :
+        temp1 = nside*(0.5+tt)
+        temp2 = nside*z*0.75
+        jp = <long>(temp1-temp2)
+        jm = <long>(temp1+temp2)
+        ir = nside+1+jp-jm
+        kshift = 1-(ir&1)
+        ip = (jp+jm-nside+kshift+1)/2
+        ip = ((ip%(4*nside))+4*nside)%(4*nside)
+        return nside*(nside-1)*2+(ir-1)*4*nside+ip
+    else :
+        tp = tt-<long>tt
+        tmp = nside*cmath.sqrt(3*(1-za))
+        jp = <long>(tp*tmp)
+        jm = <long>((1.0-tp)*tmp)
+        ir = jp+jm+1
+        ip = <long>(tt*ir)
+        ip = ((ip%(4*ir))+4*ir)%(4*ir)
+        if z>0 :
+            return 2*ir*(ir-1)+ip
+        else :
+            return 12*nside*nside-2*ir*(ir+1)+ip
+
+
+def healpix_pix2ang(long nside, np.ndarray[np.int64_t,ndim=1] pix) :
+    """Return the (z, phi) coordinates of the centres of the given RING scheme pixels"""
+    cdef Py_ssize_t i
+    cdef long ring, n_pix, first_pix
+    cdef double z_ring, offset
+    cdef np.ndarray[np.float64_t,ndim=1] z = np.empty(len(pix))
+    cdef np.ndarray[np.float64_t,ndim=1] phi = np.empty(len(pix))
+    for i in range(len(pix)) :
+        for ring in range(1, 4*nside) :
+            _healpix_ring_info(nside, ring, &n_pix, &first_pix, &z_ring, &offset)
+            if first_pix+n_pix>pix[i] :
+                break
+        z[i] = z_ring
+        phi[i] = (pix[i]-first_pix+offset)*2*cmath.M_PI/n_pix
+    return z, phi
+
+
+def healpix_ang2pix(long nside, np.ndarray[np.float64_t,ndim=1] z, np.ndarray[np.float64_t,ndim=1] phi) :
+    """Return the RING scheme pixels containing the directions (z, phi)"""
+    cdef Py_ssize_t i
+    cdef np.ndarray[np.int64_t,ndim=1] pix = np.empty(len(z), dtype=np.int64)
+    for i in range(len(z)) :
+        pix[i] = _healpix_ang2pix(nside, z[i], phi[i])
+    return pix
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def render_spherical_image_core(np.ndarray[fused_input_type_1, ndim=1] rho, # array of particle densities
-                                np.ndarray[fused_input_type_2, ndim=1] mass, # array of particle masses
-                                np.ndarray[fused_input_type_3, ndim=1] qtyar, # array of quantity to make image of
-                                np.ndarray[fused_input_type_2, ndim=2] pos, # array of particle positions
-                                np.ndarray[fused_input_type_4, ndim=1] r, # particle radius
-                                np.ndarray[fused_input_type_4, ndim=1] h, # particle smoothing length
+def render_spherical_image_core(np.ndarray[np.float64_t, ndim=1] rho, # array of particle densities
+                                np.ndarray[np.float64_t, ndim=1] mass, # array of particle masses
+                                np.ndarray[np.float64_t, ndim=1] qtyar, # array of quantity to make image of
+                                np.ndarray[np.float64_t, ndim=2] pos, # array of particle positions
+                                np.ndarray[np.float64_t, ndim=1] r, # particle radius
+                                np.ndarray[np.float64_t, ndim=1] h, # particle smoothing length
                                 np.ndarray[np.int64_t, ndim=1] ind, # which of the above particles to use
-                                np.ndarray[fused_input_type_5, ndim=1] ds, # what distances to sample at (in units of smoothing)
-                                np.ndarray[fused_input_type_5, ndim=1] weights, # what kernel weighting to use at these samples
-                                unsigned int nside) :
-
-    cdef unsigned int i,i0,j,n=len(ind),m=len(ds),num_pix
-    cdef long k
-    cdef float angle, norm, den
-    cdef unsigned int h_power = 2 # to update
-    cdef np.ndarray[np.int64_t,ndim=1] healpix_pixels, buff
-    cdef np.ndarray[image_output_type,ndim=1] im, im_norm
-
-    import healpy as hp
-    n = len(ind)
-    im = np.zeros(hp.nside2npix(nside), dtype=np_image_output_type)
-    im_norm = np.zeros_like(im)
-    buff = np.empty(len(im), dtype=np.int64)
-
-    if not hp.isnsideok(nside):
-        raise ValueError('Wrong nside value, must be a power of 2')
-
-    # go through each particle
+                                np.ndarray[np.float64_t, ndim=1] ds, # what distances to sample at (in units of smoothing)
+                                np.ndarray[np.float64_t, ndim=1] weights, # what kernel weighting to use at these samples
+                                long nside,
+                                np.ndarray[np.int64_t, ndim=1] ring_bands, # rings at which to divide work between threads
+                                int num_threads) :
+    """Render the particles onto a RING scheme healpix map, returning the map
+    and the sum of the kernel weights in each pixel.
+
+    Each particle adds weights[j]*mass/rho/h^2 to every pixel whose centre lies
+    within the angle atan(h*ds[j]/r) of it, for each j. Only the pixels in
+    the rings crossed by the outermost disc are visited. The rings are divided
+    into the bands ring_bands[k] <= ring < ring_bands[k+1] (with ring_bands[0]=1
+    and ring_bands[-1]=4*nside), each rendered by
+    its own OpenMP thread, so that the result does not depend on the number of
+    threads."""
+
+    cdef long n = len(ind), m = len(ds), num_bands = len(ring_bands)-1
+    cdef long band, i0, i, j, ring, ring_start, ring_stop, n_pix, first_pix, k, k_start, k_stop, pix
+    cdef double x_i, y_i, z_i, s_i, phi_i, cos_max, z_ring, s_ring, offset, dphi, cos_dphi, dphi_max
+    cdef double cos_psi, phi, norm_i, den_i, w, theta_i, alpha_i
+    cdef np.ndarray[np.float64_t, ndim=1] cos_angles = np.empty(n*m)
+    cdef np.ndarray[np.float64_t, ndim=1] cumulative = np.cumsum(weights[::-1])[::-1].copy()
+    cdef np.ndarray[image_output_type, ndim=1] im = np.zeros(12*nside*nside, dtype=np_image_output_type)
+    cdef np.ndarray[image_output_type, ndim=1] im_norm = np.zeros_like(im)
+
     for i0 in range(n) :
         i = ind[i0]
-        # go through each kernel step
         for j in range(m) :
+            cos_angles[i0*m+j] = cmath.cos(cmath.atan(h[i]*ds[j]/r[i]))
+
+    for band in prange(num_bands, nogil=True, schedule='dynamic', num_threads=num_threads) :
+        for i0 in range(n) :
+            i = ind[i0]
+            cos_max = cos_angles[i0*m+m-1]
+            z_i = pos[i,2]/r[i]
+            x_i = pos[i,0]/r[i]
+            y_i = pos[i,1]/r[i]
+            s_i = cmath.sqrt(x_i*x_i+y_i*y_i)
+            phi_i = cmath.atan2(y_i, x_i)
+
+            # range of rings crossed by the outermost disc, with a ring to spare each side
+            theta_i = cmath.acos(cmath.fmin(cmath.fmax(z_i, -1.0), 1.0))
+            alpha_i = cmath.acos(cos_max)
+            ring_start = _healpix_ring_above(nside, cmath.cos(cmath.fmax(theta_i-alpha_i, 0.0)))-1
+            ring_stop = _healpix_ring_above(nside, cmath.cos(cmath.fmin(theta_i+alpha_i, cmath.M_PI)))+2
+            if ring_start<ring_bands[band] :
+                ring_start = ring_bands[band]
+            if ring_stop>ring_bands[band+1] :
+                ring_stop = ring_bands[band+1]
+            if ring_start>=ring_stop :
+                continue
 
-            angle = atan(h[i]*ds[j]/r[i])
-            norm = weights[j]*mass[i]/rho[i]/h[i]**h_power
-            den = qtyar[i]*norm
-
-            # find the pixels affected
-            healpix_pixels = hp.query_disc(nside, pos[i], angle , inclusive=False, buff=buff)
-            num_pix = len(healpix_pixels)
+            norm_i = mass[i]/rho[i]/(h[i]*h[i])
+            den_i = qtyar[i]*norm_i
+
+            for ring in range(ring_start, ring_stop) :
+                _healpix_ring_info(nside, ring, &n_pix, &first_pix, &z_ring, &offset)
+                s_ring = cmath.sqrt(1-z_ring*z_ring)
+                dphi = 2*cmath.M_PI/n_pix
+
+                # range of azimuths within the outermost disc
+                if s_ring*s_i>1e-12 :
+                    cos_dphi = (cos_max-z_ring*z_i)/(s_ring*s_i)
+                else :
+                    cos_dphi = -2.0*(z_ring*z_i>cos_max)+2.0*(z_ring*z_i<=cos_max)
+                if cos_dphi>1 :
+                    continue
+                if cos_dphi<-1 :
+                    k_start = 0
+                    k_stop = n_pix
+                else :
+                    dphi_max = cmath.acos(cos_dphi)
+                    k_start = <long>cmath.ceil((phi_i-dphi_max)/dphi-offset)
+                    k_stop = <long>cmath.floor((phi_i+dphi_max)/dphi-offset)+1
+                    if k_stop-k_start>n_pix :
+                        k_stop = k_start+n_pix
+
+                for k in range(k_start, k_stop) :
+                    phi = (k+offset)*dphi
+                    cos_psi = z_ring*z_i+s_ring*(cmath.cos(phi)*x_i+cmath.sin(phi)*y_i)
+                    if cos_psi<=cos_max :
+                        continue
+                    # the innermost disc containing the pixel gives its total weight
+                    j = 0
+                    while cos_psi<=cos_angles[i0*m+j] :
+                        j = j+1
+                    w = cumulative[j]
+                    pix = first_pix+((k%n_pix)+n_pix)%n_pix
+                    im[pix] += den_i*w
+                    im_norm[pix] += norm_i*w
 
-            with nogil :
-                # add the required amount to those particles
-                for k in range(num_pix) :
-                    im[healpix_pixels[k]]+=den
-                    im_norm[healpix_pixels[k]]+=norm
+    return im, im_norm
 
 
-    return im, im_norm
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def healpix_add_upsampled(np.ndarray[image_output_type, ndim=1] im, long nside,
+                          np.ndarray[image_output_type, ndim=1] im_coarse, long nside_coarse,
+                          int num_threads) :
+    """Add to each pixel of the RING scheme map *im* the value of the pixel of
+    the coarser map *im_coarse* that contains its centre"""
+    cdef long ring, n_pix, first_pix, k
+    cdef double z_ring, offset
+    for ring in prange(1, 4*nside, nogil=True, schedule='static', num_threads=num_threads) :
+        _healpix_ring_info(nside, ring, &n_pix, &first_pix, &z_ring, &offset)
+        for k in range(n_pix) :
+            im[first_pix+k] += im_coarse[_healpix_ang2pix(nside_coarse, z_ring, (k+offset)*2*cmath.M_PI/n_pix)]
 
 
 
@@ -134,7 +308,16 @@ def render_image(int nx, int ny,
                  np.ndarray[fused_input_type_5,ndim=1] rho,
                  fixed_input_type smooth_lo, fixed_input_type smooth_hi,
                  kernel,
-                 wrap_offsets_x=[0], wrap_offsets_y=[0]) :
+                 wrap_offsets_x=[0], wrap_offsets_y=[0],
+                 output=None, y_pix_range=None) :
+    """Render the particles into an ny x nx image.
+
+    If *output* is given, the image is accumulated into it rather than into
+    a newly allocated array. If *y_pix_range* = (y_pix_min, y_pix_max) is
+    given, only rows y_pix_min <= row < y_pix_max are rendered, so that disjoint bands of a single image can be
+    rendered by different threads. Each pixel receives its contributions in
+    the same order however the image is divided, so the results do not
+    depend on the division."""
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
@@ -146,6 +329,8 @@ def render_image(int nx, int ny,
     cdef fixed_input_type x_pixel, y_pixel, z_pixel
     cdef int x_pos, y_pos
     cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop
+    cdef fixed_input_type y_band_lo, y_band_hi
+    cdef int y_pix_min = 0, y_pix_max = ny
 
     # following are only used for "perspective" rendering
     cdef float per_z_dx = (x2-x1)/(2*z_camera)
@@ -168,7 +353,16 @@ def render_image(int nx, int ny,
 
     cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
 
-    cdef np.ndarray[image_output_type,ndim=2] result = np.zeros((ny,nx),dtype=np_image_output_type)
+    if output is None:
+        output = np.zeros((ny,nx),dtype=np_image_output_type)
+
+    cdef np.ndarray[image_output_type,ndim=2] result = output
+
+    assert result.shape[0]==ny and result.shape[1]==nx, "Output image has the wrong shape"
+
+    if y_pix_range is not None:
+        y_pix_min = max(y_pix_range[0], 0)
+        y_pix_max = min(y_pix_range[1], ny)
 
     z_pixel = z0
     cdef int total_ptcls = 0
@@ -213,6 +407,13 @@ def render_image(int nx, int ny,
                             and x_i>x1-2*sm_i and x_i<x2+2*sm_i and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
                         continue
 
+                    # check particle can touch the rows being rendered (allowing
+                    # a pixel's margin so that no particle is wrongly excluded)
+                    y_band_lo = y1+pixel_dy*y_pix_min
+                    y_band_hi = y1+pixel_dy*y_pix_max
+                    if y_i+max_d_over_h*sm_i<y_band_lo-pixel_dy or y_i-max_d_over_h*sm_i>y_band_hi+pixel_dy :
+                        continue
+
                     # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
                     if kernel_dim==2 :
                         sm_to_kdim = sm_i*sm_i
@@ -233,7 +434,7 @@ def render_image(int nx, int ny,
                         y_pixel = (pixel_dy*<fixed_input_type>(y_pos)+y_start)
 
                         # final bounds check
-                        if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny :
+                        if x_pos>=0 and x_pos<nx and y_pos>=y_pix_min and y_pos<y_pix_max :
                             result[y_pos,x_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
                     else :
                         # multi-pixel
@@ -243,8 +444,8 @@ def render_image(int nx, int ny,
                         y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
                         if x_pix_start<0 : x_pix_start = 0
                         if x_pix_stop>nx : x_pix_stop = nx
-                        if y_pix_start<0 : y_pix_start = 0
-                        if y_pix_stop>ny : y_pix_stop = ny
+                        if y_pix_start<y_pix_min : y_pix_start = y_pix_min
+                        if y_pix_stop>y_pix_max : y_pix_stop = y_pix_max
                         for x_pos in range(x_pix_start, x_pix_stop) :
                             x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
                             for y_pos in range(y_pix_start, y_pix_stop) :
@@ -285,13 +486,28 @@ def to_3d_grid(int nx, int ny, int nz,
                  np.ndarray[fused_input_type_4,ndim=1] mass,
                  np.ndarray[fused_input_type_5,ndim=1] rho,
                  fixed_input_type smooth_lo, fixed_input_type smooth_hi,
-                 kernel) :
-
-
+                 kernel, output=None, x_pix_range=None, conserve_mass=True) :
+    """Render the particles onto an nx x ny x nz grid.
+
+    If *x_pix_range* = (x_pix_min, x_pix_max) is given, only the slab of
+    planes x_pix_min <= x_pos < x_pix_max is rendered, into an array of
+    shape (x_pix_max-x_pix_min, ny, nz), so that disjoint slabs of a grid
+    can be rendered by different threads or one after another. Each cell
+    receives the same contributions in the same order however the grid is
+    divided. If *output* is given, the slab is accumulated into it rather
+    than into a newly allocated array.
+
+    If *conserve_mass* is True, the kernel values at the centres of all the
+    cells a particle reaches (whether or not they lie in the grid) are
+    normalised to sum to qty*mass/rho divided by the cell volume, so that
+    particles contribute the same total however their smoothing lengths
+    compare to the cells. A particle whose kernel reaches no cell centre is
+    deposited entirely into the cell containing it. Otherwise the kernel is
+    simply sampled at the cell centres."""
 
     cdef fixed_input_type pixel_dx = (x2-x1)/nx
     cdef fixed_input_type pixel_dy = (y2-y1)/ny
-    cdef fixed_input_type pixel_dz = (z2-z1)/ny
+    cdef fixed_input_type pixel_dz = (z2-z1)/nz
     cdef fixed_input_type x_start = x1+pixel_dx/2
     cdef fixed_input_type y_start = y1+pixel_dy/2
     cdef fixed_input_type z_start = z1+pixel_dz/2
@@ -301,6 +517,16 @@ def to_3d_grid(int nx, int ny, int nz,
     cdef fixed_input_type x_pixel, y_pixel, z_pixel
     cdef int x_pos, y_pos, z_pos
     cdef int x_pix_start, x_pix_stop, y_pix_start, y_pix_stop, z_pix_start, z_pix_stop
+    cdef int x_pix_min = 0, x_pix_max = nx
+    cdef fixed_input_type x_slab_lo, x_slab_hi
+    cdef int normalise = 1 if conserve_mass else 0
+    cdef double cell_volume = pixel_dx*pixel_dy*pixel_dz
+    cdef double kernel_sum, weight_i
+    # kernel values at the centres of the cells reached by the current
+    # particle, so that each is only evaluated once when normalising
+    cdef image_output_type* kernel_buf = NULL
+    cdef long kernel_buf_size = 0, n_cells, k
+    cdef int x_n, y_n, z_n, x_cell_start, y_cell_start, z_cell_start
 
     cdef int kernel_dim = kernel.h_power
     cdef fixed_input_type max_d_over_h = kernel.max_d
@@ -312,7 +538,20 @@ def to_3d_grid(int nx, int ny, int nz,
 
     cdef fixed_input_type kernel_max_2 # minimize casting when same type as input
 
-    cdef np.ndarray[image_output_type,ndim=3] result = np.zeros((nx,ny,nz),dtype=np_image_output_type)
+    if x_pix_range is not None:
+        x_pix_min = max(x_pix_range[0], 0)
+        x_pix_max = min(x_pix_range[1], nx)
+
+    if output is None:
+        output = np.zeros((x_pix_max-x_pix_min,ny,nz),dtype=np_image_output_type)
+
+    cdef np.ndarray[image_output_type,ndim=3] result = output
+
+    assert result.shape[0]==x_pix_max-x_pix_min and result.shape[1]==ny and result.shape[2]==nz, \
+        "Output grid has the wrong shape"
+
+    x_slab_lo = x1+pixel_dx*x_pix_min
+    x_slab_hi = x1+pixel_dx*x_pix_max
 
     cdef int total_ptcls = 0
 
@@ -343,6 +582,11 @@ def to_3d_grid(int nx, int ny, int nz,
                     and y_i>y1-2*sm_i and y_i<y2+2*sm_i) :
                 continue
 
+            # check particle can touch the slab being rendered (allowing
+            # a pixel's margin so that no particle is wrongly excluded)
+            if x_i+max_d_over_h*sm_i<x_slab_lo-pixel_dx or x_i-max_d_over_h*sm_i>x_slab_hi+pixel_dx :
+                continue
+
             # pre-cache sm^kdim and (sm*max_d_over_h)**2; tests showed massive speedups when doing this
             if kernel_dim==2 :
                 sm_to_kdim = sm_i*sm_i
@@ -352,8 +596,65 @@ def to_3d_grid(int nx, int ny, int nz,
 
             kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
 
+            if normalise :
+                # every cell whose centre the kernel may reach, unclipped so
+                # that the normalisation does not depend on the grid bounds
+                x_pix_start = <int>cmath.floor((x_i-max_d_over_h*sm_i-x1)/pixel_dx+0.5)
+                x_pix_stop = <int>cmath.floor((x_i+max_d_over_h*sm_i-x1)/pixel_dx-0.5)+1
+                y_pix_start = <int>cmath.floor((y_i-max_d_over_h*sm_i-y1)/pixel_dy+0.5)
+                y_pix_stop = <int>cmath.floor((y_i+max_d_over_h*sm_i-y1)/pixel_dy-0.5)+1
+                z_pix_start = <int>cmath.floor((z_i-max_d_over_h*sm_i-z1)/pixel_dz+0.5)
+                z_pix_stop = <int>cmath.floor((z_i+max_d_over_h*sm_i-z1)/pixel_dz-0.5)+1
+
+                x_cell_start = x_pix_start
+                y_cell_start = y_pix_start
+                z_cell_start = z_pix_start
+                x_n = x_pix_stop-x_pix_start
+                y_n = y_pix_stop-y_pix_start
+                z_n = z_pix_stop-z_pix_start
+                n_cells = <long>x_n*y_n*z_n
+                if n_cells>kernel_buf_size :
+                    kernel_buf_size = 2*n_cells
+                    kernel_buf = <image_output_type*>realloc(kernel_buf, kernel_buf_size*sizeof(image_output_type))
+
+                kernel_sum = 0
+                k = 0
+                for x_pos in range(x_pix_start, x_pix_stop) :
+                    x_pixel = pixel_dx*<fixed_input_type>(x_pos)+x_start
+                    for y_pos in range(y_pix_start, y_pix_stop) :
+                        y_pixel = pixel_dy*<fixed_input_type>(y_pos)+y_start
+                        for z_pos in range(z_pix_start,z_pix_stop) :
+                            z_pixel = pixel_dz*<fixed_input_type>(z_pos)+z_start
+                            kernel_buf[k] = get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            kernel_sum+=kernel_buf[k]
+                            k+=1
+
+                if kernel_sum==0 :
+                    x_pos = <int>cmath.floor((x_i-x1)/pixel_dx)
+                    y_pos = <int>cmath.floor((y_i-y1)/pixel_dy)
+                    z_pos = <int>cmath.floor((z_i-z1)/pixel_dz)
+                    if x_pos>=x_pix_min and x_pos<x_pix_max and y_pos>=0 and y_pos<ny \
+                       and z_pos>=0 and z_pos<nz :
+                        result[x_pos-x_pix_min,y_pos,z_pos]+=qty_i/cell_volume
+                    continue
+
+                weight_i = qty_i/(kernel_sum*cell_volume)
+
+                if x_pix_start<x_pix_min : x_pix_start = x_pix_min
+                if x_pix_stop>x_pix_max : x_pix_stop = x_pix_max
+                if y_pix_start<0 : y_pix_start = 0
+                if y_pix_stop>ny : y_pix_stop = ny
+                if z_pix_start<0 : z_pix_start = 0
+                if z_pix_stop>nz : z_pix_stop = nz
+                for x_pos in range(x_pix_start, x_pix_stop) :
+                    for y_pos in range(y_pix_start, y_pix_stop) :
+                        k = ((x_pos-x_cell_start)*y_n+(y_pos-y_cell_start))*z_n+(z_pix_start-z_cell_start)
+                        for z_pos in range(z_pix_start,z_pix_stop) :
+                            result[x_pos-x_pix_min,y_pos,z_pos]+=weight_i*kernel_buf[k]
+                            k+=1
+
             # decide whether this is a single pixel or a multi-pixel particle
-            if (max_d_over_h*sm_i/pixel_dx<1 and max_d_over_h*sm_i/pixel_dy<1) :
+            elif (max_d_over_h*sm_i/pixel_dx<1 and max_d_over_h*sm_i/pixel_dy<1) :
                 # single pixel, get pixel location
                 x_pos = int((x_i-x1)/pixel_dx)
                 y_pos = int((y_i-y1)/pixel_dy)
@@ -365,9 +666,9 @@ def to_3d_grid(int nx, int ny, int nz,
                 z_pixel = (pixel_dz*<fixed_input_type>(z_pos)+z_start)
 
                 # final bounds check
-                if x_pos>=0 and x_pos<nx and y_pos>=0 and y_pos<ny \
+                if x_pos>=x_pix_min and x_pos<x_pix_max and y_pos>=0 and y_pos<ny \
                    and z_pos>=0 and z_pos<nz :
-                    result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                    result[x_pos-x_pix_min,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel)*use_z, kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
             else :
                 # multi-pixel
                 x_pix_start = int((x_i-max_d_over_h*sm_i-x1)/pixel_dx)
@@ -376,8 +677,8 @@ def to_3d_grid(int nx, int ny, int nz,
                 y_pix_stop =  int((y_i+max_d_over_h*sm_i-y1)/pixel_dy)
                 z_pix_start = int((z_i-max_d_over_h*sm_i-z1)/pixel_dz)
                 z_pix_stop =  int((z_i+max_d_over_h*sm_i-z1)/pixel_dz)
-                if x_pix_start<0 : x_pix_start = 0
-                if x_pix_stop>nx : x_pix_stop = nx
+                if x_pix_start<x_pix_min : x_pix_start = x_pix_min
+                if x_pix_stop>x_pix_max : x_pix_stop = x_pix_max
                 if y_pix_start<0 : y_pix_start = 0
                 if y_pix_stop>ny : y_pix_stop = ny
                 if z_pix_start<0 : z_pix_start = 0
@@ -389,6 +690,78 @@ def to_3d_grid(int nx, int ny, int nz,
 
                         for z_pos in range(z_pix_start,z_pix_stop) :
                             z_pixel = pixel_dz*<fixed_input_type>(z_pos)+z_start
-                            result[x_pos,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
+                            result[x_pos-x_pix_min,y_pos,z_pos]+=qty_i*get_kernel_xyz(x_i-x_pixel, y_i-y_pixel, (z_i-z_pixel), kernel_max_2 ,sm_to_kdim,num_samples,samples_c)
 
+    free(kernel_buf)
     return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def render_spectra(np.ndarray[np.float64_t,ndim=1] x_los,
+                   np.ndarray[np.float64_t,ndim=1] y_los,
+                   np.ndarray[np.int64_t,ndim=1] los_cell,
+                   np.ndarray[np.int64_t,ndim=1] offsets,
+                   np.ndarray[np.int64_t,ndim=1] indices,
+                   np.ndarray[np.float64_t,ndim=1] x,
+                   np.ndarray[np.float64_t,ndim=1] y,
+                   np.ndarray[np.float64_t,ndim=1] vz,
+                   np.ndarray[np.float64_t,ndim=1] b,
+                   np.ndarray[np.float64_t,ndim=1] sm,
+                   np.ndarray[np.float64_t,ndim=1] column,
+                   double v1, double v2, int nvel,
+                   kernel, int num_threads) :
+    """Return an (n_los, nvel) array of the absorption profiles, up to a
+    constant factor, along the lines of sight through (x_los, y_los).
+
+    The particles that may cross line of sight j are
+    indices[offsets[los_cell[j]]:offsets[los_cell[j]+1]]. Each one adds
+    column*W(d,sm)*exp(-((v-vz)/b)^2)/b to the velocity bin centred on v,
+    where W is the kernel and d the distance of the particle from the line
+    of sight. Bins more than 6b from vz are skipped. The lines of sight are
+    shared between num_threads OpenMP threads."""
+
+    cdef Py_ssize_t n_los = len(x_los)
+    cdef np.ndarray[np.float64_t,ndim=2] tau = np.zeros((n_los, nvel))
+    cdef double max_d_over_h = kernel.max_d
+    cdef np.ndarray[image_output_type,ndim=1] samples = kernel.get_samples(dtype=np_image_output_type)
+    cdef int num_samples = len(samples)
+    cdef image_output_type* samples_c = <image_output_type*>samples.data
+    cdef double dvel = (v2-v1)/nvel
+    cdef Py_ssize_t j
+    cdef long n, i
+    cdef int k, k_start, k_stop
+    cdef double dx, dy, d2, sm_i, b_i, kernel_max_2, weight, dv, k_lo, k_hi
+
+    for j in prange(n_los, nogil=True, schedule='dynamic', num_threads=num_threads) :
+        for n in range(offsets[los_cell[j]], offsets[los_cell[j]+1]) :
+            i = indices[n]
+            sm_i = sm[i]
+            dx = x[i]-x_los[j]
+            dy = y[i]-y_los[j]
+            d2 = dx*dx+dy*dy
+            kernel_max_2 = (sm_i*sm_i)*(max_d_over_h*max_d_over_h)
+            if d2>=kernel_max_2 :
+                continue
+
+            b_i = b[i]
+            weight = column[i]*get_kernel(d2, kernel_max_2, <image_output_type>(sm_i*sm_i),
+                                          num_samples, samples_c)/b_i
+
+            k_lo = (vz[i]-6*b_i-v1)/dvel
+            k_hi = (vz[i]+6*b_i-v1)/dvel+1
+            if k_hi<=0 or k_lo>=nvel :
+                continue
+            k_start = 0
+            k_stop = nvel
+            if k_lo>0 :
+                k_start = <int>k_lo
+            if k_hi<nvel :
+                k_stop = <int>k_hi
+
+            for k in range(k_start, k_stop) :
+                dv = (v1+(k+0.5)*dvel-vz[i])/b_i
+                tau[j,k] += weight*cmath.exp(-dv*dv)
+
+    return tau
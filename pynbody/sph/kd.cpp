@@ -2,6 +2,7 @@
 #include <stdlib.h>
 #include <math.h>
 #include <assert.h>
+#include <algorithm>
 #include "kd.h"
 
 
@@ -132,12 +133,9 @@ void kdUpPass(KD kd,int iCell)
 		}
 	}
 
-template <typename T>
-void kdBuildTree(KD kd)
+void kdCountNodes(KD kd)
 {
-	int l,n,i,d,j;
-	T rj;
-	BND bnd;
+	int l,n;
 
 	n = kd->nActive;
 	kd->nLevels = 1;
@@ -149,8 +147,18 @@ void kdBuildTree(KD kd)
 		}
 	kd->nSplit = l;
 	kd->nNodes = l<<1;
+}
+
+template <typename T>
+void kdBuildTree(KD kd, int nThreads)
+{
+	int i,j;
+	T rj;
+	BND bnd;
+
+	kdCountNodes(kd);
 	if (kd->kdNodes != NULL) free(kd->kdNodes);
-	kd->kdNodes = (KDN *)malloc(kd->nNodes*sizeof(KDN));
+	kd->kdNodes = (KDN *)calloc(kd->nNodes,sizeof(KDN));
 	assert(kd->kdNodes != NULL);
 
 	// Calculate bounds
@@ -177,134 +185,262 @@ void kdBuildTree(KD kd)
 	kd->kdNodes[ROOT].pUpper = kd->nActive-1;
 	kd->kdNodes[ROOT].bnd = bnd;
 
+#ifndef KDT_THREADING
+	nThreads = 1;
+#endif
+
 	// Recursively build tree
-	kdBuildNode<T>(kd, ROOT);
+	kdBuildNodeThreaded<T>(kd, ROOT, nThreads);
 
 	// Calculate and store bounds information by passing it up the tree
+	kdUpPassThreaded<T>(kd, ROOT, nThreads);
+}
+
+template <typename T>
+void kdBuildTreeFromParent(KD kd, int *piParentRank, int nParent)
+{
+	int i,j,d,lo,hi,a,b,m,k,nCount,nMin;
+	KDN *c;
+
+	// Build a tree for particles which are a subset of those in a parent
+	// tree. On entry, kd->p must list the particles in the order they
+	// appear in the parent tree, and piParentRank gives the position of
+	// each of them in that order.
+	//
+	// As far as possible, each node is divided where the parent tree
+	// divides the same particles, so that no sorting is required and the
+	// nodes remain spatially compact.
+
+	kdCountNodes(kd);
+	if (kd->kdNodes != NULL) free(kd->kdNodes);
+	kd->kdNodes = (KDN *)calloc(kd->nNodes,sizeof(KDN));
+	assert(kd->kdNodes != NULL);
+	c = kd->kdNodes;
+
+	c[ROOT].pLower = 0;
+	c[ROOT].pUpper = kd->nActive-1;
+
+	for (i=ROOT;i<kd->nNodes;++i) {
+		if (i >= kd->nSplit) {
+			c[i].iDim = -1;
+			continue;
+		}
+		lo = c[i].pLower;
+		hi = c[i].pUpper;
+		nCount = hi-lo+1;
+
+		// Find the smallest node of the parent tree containing all
+		// these particles (the parent tree divides its particles at the
+		// same midpoints as kdBuildNode)
+		a = 0;
+		b = nParent-1;
+		while (1) {
+			m = (a+b)/2;
+			if (piParentRank[hi] <= m) b = m;
+			else if (piParentRank[lo] > m) a = m+1;
+			else break;
+		}
+		k = std::upper_bound(piParentRank+lo, piParentRank+hi+1, m) - (piParentRank+lo);
+
+		// Every node below this one must end up with at least one
+		// particle, and to keep the tree reasonably balanced neither
+		// side may have less than a quarter of the particles
+		for (d=0, j=i; j>1; j>>=1) ++d;
+		nMin = kd->nSplit >> (d+1);
+		if (nMin < nCount/4) nMin = nCount/4;
+		if (k < nMin) k = nMin;
+		if (k > nCount-nMin) k = nCount-nMin;
+
+		c[i].iDim = 0; // until kdResetSplits
+		c[LOWER(i)].pLower = lo;
+		c[LOWER(i)].pUpper = lo+k-1;
+		c[UPPER(i)].pLower = lo+k;
+		c[UPPER(i)].pUpper = hi;
+	}
+
 	kdUpPass<T>(kd,ROOT);
+	kdResetSplits(kd,ROOT);
 }
 
-struct KDargs {
-	KD kd;
-	int local_root;
-};
+void kdResetSplits(KD kd, int iCell)
+{
+	KDN *c, *l, *u;
+	int j, d;
+	float gap, best_gap;
 
-template <typename T>
-void kdBuildNodeRemote(struct KDargs *a) {
-	kdBuildNode<T>(a->kd, a->local_root);
+	c = kd->kdNodes;
+	if (c[iCell].iDim == -1) return;
+
+	// Choose the dimension along which the two children are best
+	// separated, and place the split plane between them, so that
+	// descending the tree to find the cell containing a point works
+	// as well as possible
+	l = &c[LOWER(iCell)];
+	u = &c[UPPER(iCell)];
+	d = 0;
+	best_gap = u->bnd.fMin[0] - l->bnd.fMax[0];
+	for (j=1;j<3;++j) {
+		gap = u->bnd.fMin[j] - l->bnd.fMax[j];
+		if (gap > best_gap) {
+			best_gap = gap;
+			d = j;
+		}
+	}
+	c[iCell].iDim = d;
+	c[iCell].fSplit = 0.5*(u->bnd.fMin[d] + l->bnd.fMax[d]);
+
+	kdResetSplits(kd, LOWER(iCell));
+	kdResetSplits(kd, UPPER(iCell));
 }
 
 template <typename T>
-void kdBuildNode(KD kd, int local_root) {
-
-	int i=local_root;
+bool kdSplitNode(KD kd, int i) {
 	int d,j,m,diff;
 	KDN *nodes;
 	nodes = kd->kdNodes;
 
-#ifdef KDT_THREADING
-	pthread_t remote_thread;
-	struct KDargs remote_args;
-#endif
+	assert(nodes[i].pUpper - nodes[i].pLower + 1 > 0);
+	if (i < kd->nSplit && (nodes[i].pUpper - nodes[i].pLower) > 0) {
+
+		// Select splitting dimensions on the basis of keeping things
+		// as square as possible
+		d = 0;
+		for (j=1;j<3;++j) {
+			if (nodes[i].bnd.fMax[j]-nodes[i].bnd.fMin[j] >
+				nodes[i].bnd.fMax[d]-nodes[i].bnd.fMin[d]) d = j;
+			}
+		nodes[i].iDim = d;
+
+		// Find mid-point of particle list at which splitting will
+		// ultimately take place
+		m = (nodes[i].pLower + nodes[i].pUpper)/2;
+
+		// Sort list to ensure particles between lower and m are to
+		// the 'left' of particles between m and upper
+		kdSelect<T>(kd,d,m,nodes[i].pLower,nodes[i].pUpper);
+
+		// Note split point based on median particle
+		nodes[i].fSplit = GET2<T>(kd->pNumpyPos,kd->p[m].iOrder,d);
+
+		// Set up lower cell
+		nodes[LOWER(i)].bnd = nodes[i].bnd;
+		nodes[LOWER(i)].bnd.fMax[d] = nodes[i].fSplit;
+		nodes[LOWER(i)].pLower = nodes[i].pLower;
+		nodes[LOWER(i)].pUpper = m;
+
+		// Set up upper cell
+		nodes[UPPER(i)].bnd = nodes[i].bnd;
+		nodes[UPPER(i)].bnd.fMin[d] = nodes[i].fSplit;
+		nodes[UPPER(i)].pLower = m+1;
+		nodes[UPPER(i)].pUpper = nodes[i].pUpper;
+		diff = (m-nodes[i].pLower+1)-(nodes[i].pUpper-m);
+		assert(diff == 0 || diff == 1);
+		return true;
+	} else {
+		// Cell does not need to be split. Mark as leaf
+		nodes[i].iDim = -1;
+		return false;
+	}
+}
+
+template <typename T>
+void kdBuildNode(KD kd, int local_root) {
+
+	int i=local_root;
 
 	while (1) {
-		assert(nodes[i].pUpper - nodes[i].pLower + 1 > 0);
-		if (i < kd->nSplit && (nodes[i].pUpper - nodes[i].pLower) > 0) {
-
-			// Select splitting dimensions on the basis of keeping things
-			// as square as possible
-			d = 0;
-			for (j=1;j<3;++j) {
-				if (nodes[i].bnd.fMax[j]-nodes[i].bnd.fMin[j] >
-					nodes[i].bnd.fMax[d]-nodes[i].bnd.fMin[d]) d = j;
-				}
-			nodes[i].iDim = d;
-
-			// Find mid-point of particle list at which splitting will
-			// ultimately take place
-			m = (nodes[i].pLower + nodes[i].pUpper)/2;
-
-			// Sort list to ensure particles between lower and m are to
-			// the 'left' of particles between m and upper
-			kdSelect<T>(kd,d,m,nodes[i].pLower,nodes[i].pUpper);
-
-			// Note split point based on median particle
-			nodes[i].fSplit = GET2<T>(kd->pNumpyPos,kd->p[m].iOrder,d);
-
-			// Set up lower cell
-			nodes[LOWER(i)].bnd = nodes[i].bnd;
-			nodes[LOWER(i)].bnd.fMax[d] = nodes[i].fSplit;
-			nodes[LOWER(i)].pLower = nodes[i].pLower;
-			nodes[LOWER(i)].pUpper = m;
-
-			// Set up upper cell
-			nodes[UPPER(i)].bnd = nodes[i].bnd;
-			nodes[UPPER(i)].bnd.fMin[d] = nodes[i].fSplit;
-			nodes[UPPER(i)].pLower = m+1;
-			nodes[UPPER(i)].pUpper = nodes[i].pUpper;
-			diff = (m-nodes[i].pLower+1)-(nodes[i].pUpper-m);
-			assert(diff == 0 || diff == 1);
-
-#if 0
-			// Threaded KDT build is disabled at the moment.
-			//
-			// It does work, but it turns out to be slower than working on a single
-			// thread. This is presumably because the threads are writing to widely
-			// different bits of memory and the CPU cache doesn't like it?
-
-			if(i<=2) {
-				// Launch a thread to handle the lower part of the tree,
-				// handle the upper part on the current thread.
-				printf("launch thread for id=%d...\n",LOWER(i));
-
-				remote_args.kd = kd;
-				remote_args.local_root = LOWER(i);
-
-
-				// do lower part on another thread
-				if(pthread_create(&remote_thread, NULL, kdBuildNodeRemote, &remote_args)) {
-					fprintf(stderr,"Threading error");
-					return;
-				}
+		if (kdSplitNode<T>(kd, i)) {
+			// Always switch attention to the lower branch
+			// (and upper branch gets processed on way up).
+			i = LOWER(i);
+		} else {
+			// Go back up the tree and process the UPPER cells where
+			// necessary
+			SETNEXT(i,local_root);
+		}
+		if (i == local_root) break; // We got back to the top, so we're done.
+	}
+}
 
-				// do upper part locally
-				kdBuildNode(kd,UPPER(i));
+// The threaded build works by task-parallel recursion. Each split
+// hands the lower half of the particles (and the corresponding subtree)
+// to a new thread along with half the available threads, while the
+// current thread continues with the upper half. Subtrees never share
+// particles or nodes, so the result is identical to the serial build.
 
+struct KDargs {
+	KD kd;
+	int local_root;
+	int nThreads;
+};
 
-				printf("join...");
-				if(pthread_join(remote_thread,NULL)) {
-					fprintf(stderr,"Threading error");
-					return;
-				}
+template <typename T>
+void *kdBuildNodeRemote(void *a) {
+	struct KDargs *args = (struct KDargs *)a;
+	kdBuildNodeThreaded<T>(args->kd, args->local_root, args->nThreads);
+	return NULL;
+}
 
-				// at this point, we've finished processing this node and all subnodes,
-				// so continue back up the tree
+template <typename T>
+void *kdUpPassRemote(void *a) {
+	struct KDargs *args = (struct KDargs *)a;
+	kdUpPassThreaded<T>(args->kd, args->local_root, args->nThreads);
+	return NULL;
+}
 
-				SETNEXT(i,local_root);
+template <typename T>
+void kdBuildNodeThreaded(KD kd, int local_root, int nThreads) {
+#ifdef KDT_THREADING
+	pthread_t remote_thread;
+	struct KDargs remote_args;
 
-			} else{
-				// Continue processing on these threads
-				// Next cell is the lower one. Upper one will be processed
-				// on the way up.
-				i = LOWER(i);
-			}
+	if (nThreads>1) {
+		if (!kdSplitNode<T>(kd, local_root))
+			return;
 
-#else
-	// On single thread, always switch attention to the lower branch
-			// (and upper branch gets processed on way up).
-		i = LOWER(i);
+		remote_args.kd = kd;
+		remote_args.local_root = LOWER(local_root);
+		remote_args.nThreads = nThreads/2;
+
+		if (pthread_create(&remote_thread, NULL, kdBuildNodeRemote<T>, &remote_args)) {
+			// Could not launch thread; build both halves here instead
+			kdBuildNode<T>(kd, LOWER(local_root));
+			kdBuildNodeThreaded<T>(kd, UPPER(local_root), nThreads);
+			return;
+		}
+
+		kdBuildNodeThreaded<T>(kd, UPPER(local_root), nThreads-nThreads/2);
+		pthread_join(remote_thread, NULL);
+		return;
+	}
 #endif
+	kdBuildNode<T>(kd, local_root);
+}
 
-		} else {
-			// Cell does not need to be split. Mark as leaf
-			nodes[i].iDim = -1;
+template <typename T>
+void kdUpPassThreaded(KD kd, int iCell, int nThreads) {
+#ifdef KDT_THREADING
+	pthread_t remote_thread;
+	struct KDargs remote_args;
+	KDN *c = kd->kdNodes;
 
-			// Go back up the tree and process the UPPER cells where
-			// necessary
-			SETNEXT(i,local_root);
+	if (nThreads>1 && c[iCell].iDim != -1) {
+		remote_args.kd = kd;
+		remote_args.local_root = LOWER(iCell);
+		remote_args.nThreads = nThreads/2;
+
+		if (pthread_create(&remote_thread, NULL, kdUpPassRemote<T>, &remote_args)) {
+			kdUpPass<T>(kd, iCell);
+			return;
 		}
-		if (i == local_root) break; // We got back to the top, so we're done.
+
+		kdUpPassThreaded<T>(kd, UPPER(iCell), nThreads-nThreads/2);
+		pthread_join(remote_thread, NULL);
+		kdCombine(&c[LOWER(iCell)],&c[UPPER(iCell)],&c[iCell]);
+		return;
 	}
+#endif
+	kdUpPass<T>(kd, iCell);
 }
 
 
@@ -317,10 +453,10 @@ template
 void kdUpPass<double>(KD kd,int iCell);
 
 template
-void kdBuildTree<double>(KD kd);
+void kdBuildTree<double>(KD kd, int nThreads);
 
 template
-void kdBuildNodeRemote<double>(struct KDargs *a);
+void kdBuildTreeFromParent<double>(KD kd, int *piParentRank, int nParent);
 
 template
 void kdBuildNode<double>(KD kd, int local_root);
@@ -334,10 +470,10 @@ template
 void kdUpPass<float>(KD kd,int iCell);
 
 template
-void kdBuildTree<float>(KD kd);
+void kdBuildTree<float>(KD kd, int nThreads);
 
 template
-void kdBuildNodeRemote<float>(struct KDargs *a);
+void kdBuildTreeFromParent<float>(KD kd, int *piParentRank, int nParent);
 
 template
 void kdBuildNode<float>(KD kd, int local_root);
@@ -168,13 +168,26 @@ int kdInit(KD *,int);
 int kdReadTipsy(KD,FILE *,int,int,int,int);
 void kdInMark(KD,char *);
 
+void kdCountNodes(KD);
+
+template<typename T>
+void kdBuildTree(KD, int);
 template<typename T>
-void kdBuildTree(KD);
+void kdBuildTreeFromParent(KD, int *, int);
+void kdResetSplits(KD, int);
 void kdOrder(KD);
 void kdFinish(KD);
 
+template<typename T>
+bool kdSplitNode(KD, int);
 template<typename T>
 void kdBuildNode(KD, int);
+template<typename T>
+void kdBuildNodeThreaded(KD, int, int);
+template<typename T>
+void kdUpPass(KD, int);
+template<typename T>
+void kdUpPassThreaded(KD, int, int);
 void kdCombine(KDN *p1,KDN *p2,KDN *pOut);
 
 
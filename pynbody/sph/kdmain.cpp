@@ -43,6 +43,7 @@ long total_alloc = 0;
 
 PyObject *kdinit(PyObject *self, PyObject *args);
 PyObject *kdfree(PyObject *self, PyObject *args);
+PyObject *get_tree_data(PyObject *self, PyObject *args);
 
 PyObject *nn_start(PyObject *self, PyObject *args);
 PyObject *nn_next(PyObject *self, PyObject *args);
@@ -51,6 +52,9 @@ PyObject *nn_rewind(PyObject *self, PyObject *args);
 
 PyObject *populate(PyObject *self, PyObject *args);
 
+PyObject *query_knn(PyObject *self, PyObject *args);
+PyObject *query_ball(PyObject *self, PyObject *args);
+
 PyObject *domain_decomposition(PyObject *self, PyObject *args);
 PyObject *set_arrayref(PyObject *self, PyObject *args);
 PyObject *get_arrayref(PyObject *self, PyObject *args);
@@ -68,12 +72,16 @@ int getBitDepth(PyObject *check);
 #define PROPID_QTYMEAN_ND    4
 #define PROPID_QTYDISP_1D    5
 #define PROPID_QTYDISP_ND    6
+#define PROPID_QTYGRAD_1D    7
+#define PROPID_QTYDIV_ND     8
+#define PROPID_QTYCURL_ND    9
 /*==========================================================================*/
 
 static PyMethodDef kdmain_methods[] =
 {
     {"init", kdinit, METH_VARARGS, "init"},
     {"free", kdfree, METH_VARARGS, "free"},
+    {"get_tree_data", get_tree_data, METH_VARARGS, "get_tree_data"},
 
     {"nn_start",  nn_start,  METH_VARARGS, "nn_start"},
     {"nn_next",   nn_next,   METH_VARARGS, "nn_next"},
@@ -86,6 +94,9 @@ static PyMethodDef kdmain_methods[] =
 
     {"populate",  populate,  METH_VARARGS, "populate"},
 
+    {"query_knn",  query_knn,  METH_VARARGS, "query_knn"},
+    {"query_ball",  query_ball,  METH_VARARGS, "query_ball"},
+
     {"has_threading",  has_threading,  METH_VARARGS, "populate"},
 
     {NULL, NULL, 0, NULL}
@@ -118,50 +129,134 @@ initkdmain(void)
 PyObject *has_threading(PyObject *self, PyObject *args)
 {
 #ifdef KDT_THREADING
-    return Py_True;
+    Py_RETURN_TRUE;
 #else
-    return Py_False;
+    Py_RETURN_FALSE;
 #endif
 }
 
 
+/*==========================================================================*/
+/* treeDataValid                                                            */
+/*                                                                          */
+/* Check that a supplied particle order is a permutation of the particles,  */
+/* and that any supplied nodes only refer to particles that exist, so that  */
+/* stale or corrupted tree data cannot cause out-of-bounds accesses.        */
+/*==========================================================================*/
+static bool treeDataValid(const int *iOrder, const KDN *kdNodes, int nNodes, int nbodies)
+{
+    int i;
+    bool valid = true;
+    char *seen = (char *)calloc(nbodies, sizeof(char));
+    assert(seen != NULL);
+
+    for (i=0; i < nbodies && valid; i++) {
+        if (iOrder[i] < 0 || iOrder[i] >= nbodies || seen[iOrder[i]])
+            valid = false;
+        else
+            seen[iOrder[i]] = 1;
+    }
+    free(seen);
+
+    if (kdNodes != NULL) {
+        for (i=0; i < nNodes && valid; i++) {
+            if (kdNodes[i].pLower < 0 || kdNodes[i].pUpper >= nbodies)
+                valid = false;
+        }
+    }
+
+    return valid;
+}
+
 /*==========================================================================*/
 /* kdinit                                                                   */
 /*==========================================================================*/
 PyObject *kdinit(PyObject *self, PyObject *args)
 {
-    int nBucket;
+    int nBucket, nThreads;
     int i;
 
     PyObject *pos;  // Nx3 Numpy array of positions
     PyObject *mass; // Nx1 Numpy array of masses
 
-    if (!PyArg_ParseTuple(args, "OOi", &pos, &mass, &nBucket))
+    // Optional buffers. If the particle order and nodes previously obtained
+    // from get_tree_data are supplied, the tree is restored from them rather
+    // than being built. If instead the particle order is supplied along with
+    // the rank of each particle in the order of a parent tree with nParent
+    // particles, the tree is derived from the parent (see
+    // kdBuildTreeFromParent).
+    Py_buffer order, nodes, parentRank;
+    int nParent = 0;
+    order.buf = NULL;
+    nodes.buf = NULL;
+    parentRank.buf = NULL;
+
+    if (!PyArg_ParseTuple(args, "OOii|z*z*z*i", &pos, &mass, &nBucket, &nThreads,
+                          &order, &nodes, &parentRank, &nParent))
         return NULL;
 
-    int bitdepth = getBitDepth(pos);
-    if(bitdepth==0) {
-        PyErr_SetString(PyExc_ValueError, "Unsupported array dtype for kdtree");
-        return NULL;
-    }
-    if(bitdepth!=getBitDepth(mass)) {
-        PyErr_SetString(PyExc_ValueError, "pos and mass arrays must have matching dtypes for kdtree");
+    bool presorted = (order.buf!=NULL);
+    bool restore = (nodes.buf!=NULL);
+    bool from_parent = (parentRank.buf!=NULL);
+
+#define RELEASE_BUFFERS \
+    if(presorted) PyBuffer_Release(&order); \
+    if(restore) PyBuffer_Release(&nodes); \
+    if(from_parent) PyBuffer_Release(&parentRank);
+
+    if(presorted && (restore == from_parent)) {
+        RELEASE_BUFFERS
+        PyErr_SetString(PyExc_ValueError, "A particle order must be accompanied by either node data or parent ranks");
         return NULL;
     }
 
-    if(bitdepth==64) {
-        if(checkArray<double>(pos, "pos")) return NULL;
-        if(checkArray<double>(mass, "mass")) return NULL;
+    int bitdepth = getBitDepth(pos);
+    const char *error = NULL;
+    if(bitdepth==0)
+        error = "Unsupported array dtype for kdtree";
+    else if(bitdepth!=getBitDepth(mass))
+        error = "pos and mass arrays must have matching dtypes for kdtree";
+
+    if(error!=NULL) {
+        PyErr_SetString(PyExc_ValueError, error);
+    } else if(bitdepth==64) {
+        if(checkArray<double>(pos, "pos") || checkArray<double>(mass, "mass"))
+            error = "";
     } else {
-        if(checkArray<float>(pos, "pos")) return NULL;
-        if(checkArray<float>(mass, "mass")) return NULL;
+        if(checkArray<float>(pos, "pos") || checkArray<float>(mass, "mass"))
+            error = "";
+    }
+
+    if(error!=NULL) {
+        RELEASE_BUFFERS
+        return NULL;
     }
 
-    KD kd = (KD)malloc(sizeof(*kd));
+    KD kd;
     kdInit(&kd, nBucket);
 
     int nbodies = PyArray_DIM(pos, 0);
 
+    if(presorted) {
+        kd->nActive = nbodies;
+        kdCountNodes(kd);
+        if(order.len != (Py_ssize_t)nbodies*sizeof(int) ||
+           (restore && nodes.len != (Py_ssize_t)kd->nNodes*sizeof(KDN)) ||
+           (from_parent && (parentRank.len != order.len || nParent < nbodies))) {
+            RELEASE_BUFFERS
+            free(kd);
+            PyErr_SetString(PyExc_ValueError, "Supplied kdtree data does not match the number of particles or leaf size");
+            return NULL;
+        }
+
+        if(!treeDataValid((int *)order.buf, restore ? (KDN *)nodes.buf : NULL, kd->nNodes, nbodies)) {
+            // the data cannot describe a tree for these particles, so
+            // ignore it and build the tree from scratch
+            RELEASE_BUFFERS
+            presorted = restore = from_parent = false;
+        }
+    }
+
     kd->nParticles = nbodies;
     kd->nActive = nbodies;
     kd->nBitDepth = bitdepth;
@@ -183,19 +278,41 @@ PyObject *kdinit(PyObject *self, PyObject *args)
     kd->p = (PARTICLE *)malloc(kd->nActive*sizeof(PARTICLE));
     assert(kd->p != NULL);
 
-    for (i=0; i < nbodies; i++)
-    {
-        kd->p[i].iOrder = i;
-        kd->p[i].iMark = 1;
+    if(presorted) {
+        int *iOrder = (int *)order.buf;
+        for (i=0; i < nbodies; i++)
+        {
+            kd->p[i].iOrder = iOrder[i];
+            kd->p[i].iMark = 1;
+        }
+    } else {
+        for (i=0; i < nbodies; i++)
+        {
+            kd->p[i].iOrder = i;
+            kd->p[i].iMark = 1;
+        }
     }
 
-    if(bitdepth==64)
-        kdBuildTree<double>(kd);
-    else
-        kdBuildTree<float>(kd);
+    if(restore) {
+        kd->kdNodes = (KDN *)malloc(nodes.len);
+        assert(kd->kdNodes != NULL);
+        memcpy(kd->kdNodes, nodes.buf, nodes.len);
+    } else if(from_parent) {
+        if(bitdepth==64)
+            kdBuildTreeFromParent<double>(kd, (int *)parentRank.buf, nParent);
+        else
+            kdBuildTreeFromParent<float>(kd, (int *)parentRank.buf, nParent);
+    } else if(bitdepth==64) {
+        kdBuildTree<double>(kd, nThreads);
+    } else {
+        kdBuildTree<float>(kd, nThreads);
+    }
 
     Py_END_ALLOW_THREADS
 
+    RELEASE_BUFFERS
+#undef RELEASE_BUFFERS
+
     return PyCapsule_New((void *)kd, NULL, NULL);
 }
 
@@ -218,6 +335,39 @@ PyObject *kdfree(PyObject *self, PyObject *args)
     return Py_None;
 }
 
+/*==========================================================================*/
+/* get_tree_data                                                            */
+/*==========================================================================*/
+PyObject *get_tree_data(PyObject *self, PyObject *args)
+{
+    KD kd;
+    PyObject *kdobj, *order, *nodes;
+    int i, *iOrder;
+
+    if (!PyArg_ParseTuple(args, "O", &kdobj))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    // Return raw bytes for the particle ordering and the node array, which
+    // can be passed back into init to reconstruct the tree without
+    // rebuilding it
+    order = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)kd->nActive*sizeof(int));
+    if(order==NULL) return NULL;
+    iOrder = (int *)PyBytes_AS_STRING(order);
+    for(i=0; i<kd->nActive; i++)
+        iOrder[i] = kd->p[i].iOrder;
+
+    nodes = PyBytes_FromStringAndSize((const char *)kd->kdNodes,
+                                      (Py_ssize_t)kd->nNodes*sizeof(KDN));
+    if(nodes==NULL) {
+        Py_DECREF(order);
+        return NULL;
+    }
+
+    return Py_BuildValue("NN", order, nodes);
+}
+
 #define BIGFLOAT ((float)1.0e37)
 
 /*==========================================================================*/
@@ -550,6 +700,26 @@ PyObject *domain_decomposition(PyObject *self, PyObject *args) {
     return Py_None;
 }
 
+int checkNeighbourArray(PyObject *check, const char *name, char kind, int elsize, npy_intp len) {
+  // stored neighbour lists are optional, but must be contiguous 1D arrays if present
+  if(check==NULL || check==Py_None) return 0;
+  if(PyArray_NDIM((PyArrayObject*)check)!=1 ||
+     !PyArray_ISCONTIGUOUS((PyArrayObject*)check) ||
+     PyArray_DESCR((PyArrayObject*)check)->kind!=kind ||
+     PyArray_DESCR((PyArrayObject*)check)->elsize!=elsize ||
+     (len>=0 && PyArray_DIM(check,0)!=len)) {
+    PyErr_Format(PyExc_ValueError, "Incorrect array for %s passed to populate",name);
+    return 1;
+  }
+  return 0;
+}
+
+template<typename T>
+T *neighbourArrayData(PyObject *ar) {
+  if(ar==NULL || ar==Py_None) return NULL;
+  return (T*)PyArray_DATA((PyArrayObject*)ar);
+}
+
 template<typename Tf, typename Tq>
 PyObject *typed_populate(PyObject *self, PyObject *args)
 {
@@ -567,15 +737,32 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
     PyObject *kdobj, *smxobj;
     PyObject *dest; // Nx1 Numpy array for the property
 
+    // optional stored neighbour lists (see smCachedGather)
+    PyObject *offsetsobj=NULL, *indicesobj=NULL, *deltasobj=NULL;
 
 
-    PyArg_ParseTuple(args, "OOii", &kdobj, &smxobj, &propid, &procid);
+
+    PyArg_ParseTuple(args, "OOii|OOO", &kdobj, &smxobj, &propid, &procid,
+                     &offsetsobj, &indicesobj, &deltasobj);
     kd  = (KD)PyCapsule_GetPointer(kdobj, NULL);
     smx_global = (SMX)PyCapsule_GetPointer(smxobj, NULL);
     #define BIGFLOAT ((float)1.0e37)
 
     long nbodies = PyArray_DIM(kd->pNumpyPos, 0);
 
+    if(checkNeighbourArray(offsetsobj, "offsets", 'i', 8, nbodies+1)) return NULL;
+    if(checkNeighbourArray(indicesobj, "indices", 'i', 4, -1)) return NULL;
+    if(checkNeighbourArray(deltasobj, "deltas", 'u', 1, -1)) return NULL;
+
+    npy_int64 *offsets = neighbourArrayData<npy_int64>(offsetsobj);
+    npy_int32 *indices = neighbourArrayData<npy_int32>(indicesobj);
+    unsigned char *deltas = neighbourArrayData<unsigned char>(deltasobj);
+
+    if(offsets!=NULL && indices==NULL && deltas==NULL) {
+        PyErr_SetString(PyExc_ValueError, "Stored neighbour offsets passed to populate without the neighbours themselves");
+        return NULL;
+    }
+
 
     if (checkArray<Tf>(kd->pNumpySmooth,"smooth")) return NULL;
     if(propid>PROPID_HSM) {
@@ -617,6 +804,15 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
         case PROPID_QTYDISP_1D:
             pSmFn = &smDispQty1D<Tf,Tq>;
             break;
+        case PROPID_QTYGRAD_1D:
+            pSmFn = &smGradQty1D<Tf,Tq>;
+            break;
+        case PROPID_QTYDIV_ND:
+            pSmFn = &smDivQtyND<Tf,Tq>;
+            break;
+        case PROPID_QTYCURL_ND:
+            pSmFn = &smCurlQtyND<Tf,Tq>;
+            break;
     }
 
 
@@ -644,11 +840,16 @@ PyObject *typed_populate(PyObject *self, PyObject *args)
               ri[j] = GET2<Tf>(kd->pNumpyPos,kd->p[i].iOrder,j);
             }
 
-            // retrieve the existing smoothing length
-            hsm = GETSMOOTH(Tf,i);
+            if(offsets!=NULL) {
+                // read the stored neighbour list
+                nCnt = smCachedGather<Tf>(smx_local,i,offsets,indices,deltas);
+            } else {
+                // retrieve the existing smoothing length
+                hsm = GETSMOOTH(Tf,i);
 
-            // use it to get nearest neighbours
-            nCnt = smBallGather<Tf>(smx_local,4*hsm*hsm,ri);
+                // use it to get nearest neighbours
+                nCnt = smBallGather<Tf>(smx_local,4*hsm*hsm,ri);
+            }
 
             // calculate the density
             (*pSmFn)(smx_local, i, nCnt, smx_local->pList,smx_local->fList);
@@ -684,10 +885,11 @@ PyObject *populate(PyObject *self, PyObject *args)
     // template parameters to adopt
 
     KD kd;
-    PyObject *kdobj, *smxobj;
+    PyObject *kdobj, *smxobj, *offsetsobj, *indicesobj, *deltasobj;
     int propid, procid, nF, nQ;
 
-    PyArg_ParseTuple(args, "OOii", &kdobj, &smxobj, &propid, &procid);
+    PyArg_ParseTuple(args, "OOii|OOO", &kdobj, &smxobj, &propid, &procid,
+                     &offsetsobj, &indicesobj, &deltasobj);
     kd  = (KD)PyCapsule_GetPointer(kdobj, NULL);
 
 
@@ -711,3 +913,150 @@ PyObject *populate(PyObject *self, PyObject *args)
         return NULL;
     }
 }
+
+
+/*==========================================================================*/
+/* query_knn, query_ball                                                    */
+/*                                                                          */
+/* Neighbour searches around arbitrary positions. The caller provides the   */
+/* output arrays, so that a set of positions can be split between threads.  */
+/*==========================================================================*/
+
+int checkQueryArray(PyObject *check, const char *name, char kind, int ndim, npy_intp dim0, npy_intp dim1) {
+  if(check==NULL || PyArray_NDIM((PyArrayObject*)check)!=ndim ||
+     PyArray_DIM(check,0)!=dim0 || (ndim==2 && PyArray_DIM(check,1)!=dim1)) {
+    PyErr_Format(PyExc_ValueError, "Incorrect shape for %s passed to kdtree query",name);
+    return 1;
+  }
+  PyArray_Descr *descr = PyArray_DESCR(check);
+  if(descr==NULL || descr->kind!=kind || descr->elsize!=8) {
+    PyErr_Format(PyExc_TypeError, "Incorrect numpy data type for %s passed to kdtree query - must be 64-bit",name);
+    return 1;
+  }
+  return 0;
+}
+
+PyObject *query_knn(PyObject *self, PyObject *args)
+{
+    KD kd;
+    PyObject *kdobj, *points, *idx, *dist;
+    int k, nCnt, j;
+    float period, ri[3];
+    npy_intp i, n;
+
+    if (!PyArg_ParseTuple(args, "OfiOOO", &kdobj, &period, &k, &points, &idx, &dist))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(k<1 || k>kd->nActive) {
+        PyErr_SetString(PyExc_ValueError, "Number of neighbours must be between 1 and the number of particles in the tree");
+        return NULL;
+    }
+
+    if(checkQueryArray(points, "points", 'f', 2, PyArray_DIM(points,0), 3)) return NULL;
+    n = PyArray_DIM(points,0);
+    if(checkQueryArray(idx, "indices", 'i', 2, n, k)) return NULL;
+    if(checkQueryArray(dist, "distances", 'f', 2, n, k)) return NULL;
+
+    if(period<0)
+        period = BIGFLOAT;
+    float fPeriod[3] = {period, period, period};
+
+    Py_BEGIN_ALLOW_THREADS
+
+    float *fList = (float *)malloc(k*sizeof(float));
+    int *pList = (int *)malloc(k*sizeof(int));
+    assert(fList!=NULL && pList!=NULL);
+
+    for(i=0; i<n; i++) {
+        for(j=0; j<3; j++)
+            ri[j] = GET2<double>(points,i,j);
+
+        if(kd->nBitDepth==32)
+            nCnt = smNearestNeighbours<float>(kd, fPeriod, k, ri, fList, pList);
+        else
+            nCnt = smNearestNeighbours<double>(kd, fPeriod, k, ri, fList, pList);
+
+        for(j=0; j<nCnt; j++) {
+            SET2<npy_int64>(idx, i, j, pList[j]);
+            SET2<double>(dist, i, j, sqrt(fList[j]));
+        }
+    }
+
+    free(fList);
+    free(pList);
+
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+PyObject *query_ball(PyObject *self, PyObject *args)
+{
+    KD kd;
+    PyObject *kdobj, *points, *radius, *offsets, *idx, *dist;
+    float period, ri[3], r;
+    npy_intp i, n, j, nCnt;
+    npy_int64 *pList = NULL;
+    double *fList = NULL;
+
+    if (!PyArg_ParseTuple(args, "OfOOOOO", &kdobj, &period, &idx, &dist, &points, &radius, &offsets))
+        return NULL;
+    kd = (KD)PyCapsule_GetPointer(kdobj, NULL);
+    if(!kd) return NULL;
+
+    if(checkQueryArray(points, "points", 'f', 2, PyArray_DIM(points,0), 3)) return NULL;
+    n = PyArray_DIM(points,0);
+    if(checkQueryArray(radius, "radius", 'f', 1, n, 0)) return NULL;
+    if(checkQueryArray(offsets, "offsets", 'i', 1, n, 0)) return NULL;
+
+    // If no output arrays are given, the number of neighbours of each
+    // position is written into offsets. Otherwise, offsets gives the
+    // position in the output arrays at which to start writing for each
+    // position, and the output arrays must be contiguous.
+    bool count_only = (idx==Py_None);
+
+    if(!count_only) {
+        if(checkQueryArray(idx, "indices", 'i', 1, PyArray_DIM(idx,0), 0)) return NULL;
+        if(checkQueryArray(dist, "distances", 'f', 1, PyArray_DIM(idx,0), 0)) return NULL;
+        if(!PyArray_ISCONTIGUOUS((PyArrayObject*)idx) || !PyArray_ISCONTIGUOUS((PyArrayObject*)dist)) {
+            PyErr_SetString(PyExc_ValueError, "Output arrays for kdtree query must be contiguous");
+            return NULL;
+        }
+    }
+
+    if(period<0)
+        period = BIGFLOAT;
+    float fPeriod[3] = {period, period, period};
+
+    Py_BEGIN_ALLOW_THREADS
+
+    for(i=0; i<n; i++) {
+        for(j=0; j<3; j++)
+            ri[j] = GET2<double>(points,i,j);
+        r = GET<double>(radius,i);
+
+        if(!count_only) {
+            pList = (npy_int64 *)PyArray_DATA((PyArrayObject*)idx) + GET<npy_int64>(offsets,i);
+            fList = (double *)PyArray_DATA((PyArrayObject*)dist) + GET<npy_int64>(offsets,i);
+        }
+
+        if(kd->nBitDepth==32)
+            nCnt = smBallQuery<float>(kd, fPeriod, r*r, ri, pList, fList);
+        else
+            nCnt = smBallQuery<double>(kd, fPeriod, r*r, ri, pList, fList);
+
+        if(count_only)
+            SET<npy_int64>(offsets, i, nCnt);
+        else
+            for(j=0; j<nCnt; j++)
+                fList[j] = sqrt(fList[j]);
+    }
+
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
@@ -25,13 +25,64 @@ class KDTree(object):
     PROPID_QTYMEAN_ND = 4
     PROPID_QTYDISP_1D = 5
     PROPID_QTYDISP_ND = 6
-
-    def __init__(self, pos, mass, leafsize=32, boxsize=None):
-        self.kdtree = kdmain.init(pos, mass, int(leafsize))
+    PROPID_QTYGRAD_1D = 7
+    PROPID_QTYDIV_ND = 8
+    PROPID_QTYCURL_ND = 9
+
+    def __init__(self, pos, mass, leafsize=32, boxsize=None, tree_data=None,
+                 parent=None, parent_index=None, neighbour_cache=None):
+        """Build a KDTree for the given positions and masses.
+
+        If *tree_data* is specified, it must be the (particle order, node)
+        pair returned by :meth:`get_tree_data` for a tree built from
+        identical positions and leafsize. The tree is then restored from
+        that data rather than rebuilt, unless the data turns out not to
+        describe a tree of these particles.
+
+        If *parent* is specified, it must be a KDTree for a superset of
+        the particles, and *parent_index* must give the index of each
+        particle within that superset. The tree is then derived from the
+        parent tree without sorting the particles again, which is much
+        faster than a full build. Searches in the resulting tree are still
+        exact, though its structure is not identical to a fresh tree.
+
+        Otherwise the tree is built using config['number_of_threads']
+        threads; the result is identical whatever the number of threads.
+
+        *neighbour_cache* (None, 'csr' or 'delta') specifies whether and how
+        neighbour lists are stored for reuse; see :meth:`populate`."""
+        if parent is not None:
+            rank = parent.particle_rank()[parent_index]
+            order = np.argsort(rank).astype(np.int32)
+            tree_data = (order, None, rank[order], parent.s_len)
+        elif tree_data is None:
+            tree_data = ()
+        self.kdtree = kdmain.init(pos, mass, int(leafsize),
+                                  config['number_of_threads'], *tree_data)
         self.derived = True
         self.boxsize=boxsize
         self.s_len = len(pos)
         self.flags = {'WRITEABLE': False}
+        self.neighbour_cache = neighbour_cache
+        self._neighbours = None
+        self._pos = pos
+
+    def get_tree_data(self):
+        """Return the particle order and node structure of the tree as a pair of
+        byte strings, suitable for passing back into the constructor as
+        *tree_data*"""
+        return kdmain.get_tree_data(self.kdtree)
+
+    def particle_rank(self):
+        """Return an array giving the position of each particle in the
+        ordering used by the tree"""
+        try:
+            return self._particle_rank
+        except AttributeError:
+            order = np.frombuffer(self.get_tree_data()[0], dtype=np.int32)
+            self._particle_rank = np.empty(len(order), dtype=np.int32)
+            self._particle_rank[order] = np.arange(len(order), dtype=np.int32)
+            return self._particle_rank
 
     def nn(self, nn=None):
         if nn is None:
@@ -94,20 +145,132 @@ class KDTree(object):
                 if input_array.shape[1]!=3:
                     raise ValueError, "Currently only able to smooth 3D or 1D arrays"
                 return self.PROPID_QTYDISP_ND
+        elif name=="qty_grad":
+            if len(self.get_array_ref('qty').shape)!=1:
+                raise ValueError, "Can only take the gradient of a 1D array"
+            return self.PROPID_QTYGRAD_1D
+        elif name=="qty_div" or name=="qty_curl":
+            input_array = self.get_array_ref('qty')
+            if len(input_array.shape)!=2 or input_array.shape[1]!=3:
+                raise ValueError, "Can only take the divergence or curl of a 3D array"
+            return self.PROPID_QTYDIV_ND if name=="qty_div" else self.PROPID_QTYCURL_ND
         else:
             raise ValueError, "Unknown smoothing request %s"%name
 
 
 
-    def populate(self, mode, nn):
-        from . import _thread_map
-
+    @staticmethod
+    def _get_n_proc():
         n_proc=config['number_of_threads']
 
         if kdmain.has_threading() is False and n_proc>1:
             n_proc=1
             warnings.warn("Pynbody is configured to use threading for the KDTree, but pthread support was not available during compilation. Reverting to single thread.", RuntimeWarning)
 
+        return n_proc
+
+    def _get_period(self):
+        if self.boxsize is None:
+            return -1.0
+        return float(self.boxsize)
+
+    def _map_over_points(self, fn, shared_args, point_args):
+        """Call the kdmain query function fn, dividing the arrays in
+        point_args (which all have one entry per query point) between threads"""
+        from . import _thread_map
+
+        n_points = len(point_args[0])
+        n_proc = max(1, min(self._get_n_proc(), n_points))
+        boundaries = np.linspace(0, n_points, n_proc+1).astype(int)
+
+        calls = [[self.kdtree, self._get_period()] + list(shared_args) +
+                 [a[i0:i1] for a in point_args]
+                 for i0, i1 in zip(boundaries[:-1], boundaries[1:])]
+
+        if n_proc==1:
+            fn(*calls[0])
+        else:
+            _thread_map(fn, *zip(*calls))
+
+    @staticmethod
+    def _prepare_points(points):
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        if points.ndim==1:
+            points = points.reshape((1,3))
+        if points.ndim!=2 or points.shape[1]!=3:
+            raise ValueError, "Query positions must have shape (N,3)"
+        return points
+
+    def query(self, points, k=1):
+        """Find the k nearest neighbours of each of the specified positions.
+
+        The positions need not correspond to particles in the tree; they
+        are specified as an (N,3) array in the same units as the tree.
+        If the tree has a boxsize, distances are computed periodically.
+
+        Returns a tuple (indices, distances) of (N,k) arrays, where the
+        indices refer to the position array from which the tree was built.
+        Neighbours are sorted in order of increasing distance."""
+
+        points = self._prepare_points(points)
+        k = int(k)
+        if k<1 or k>self.s_len:
+            raise ValueError, "Number of neighbours must be between 1 and the number of particles in the tree"
+
+        indices = np.empty((len(points), k), dtype=np.int64)
+        distances = np.empty((len(points), k), dtype=np.float64)
+
+        self._map_over_points(kdmain.query_knn, [k], [points, indices, distances])
+
+        return indices, distances
+
+    def query_ball(self, points, r):
+        """Find all particles within distance r of each of the specified
+        positions.
+
+        The positions are specified as an (N,3) array in the same units as
+        the tree. The radius *r* can be a single value or an array with one
+        entry per position. If the tree has a boxsize, distances are
+        computed periodically.
+
+        Returns a tuple (offsets, indices, distances) in compressed sparse
+        row format: the neighbours of position i are indices[offsets[i]:offsets[i+1]],
+        at the corresponding distances. Neighbours of each position are
+        not sorted."""
+
+        points = self._prepare_points(points)
+        radius = np.empty(len(points), dtype=np.float64)
+        radius[:] = r
+
+        # first pass finds the number of neighbours of each position,
+        # which determines where in the output arrays each one is written
+        offsets = np.zeros(len(points)+1, dtype=np.int64)
+        self._map_over_points(kdmain.query_ball, [None, None], [points, radius, offsets[1:]])
+        np.cumsum(offsets, out=offsets)
+
+        indices = np.empty(offsets[-1], dtype=np.int64)
+        distances = np.empty(offsets[-1], dtype=np.float64)
+        self._map_over_points(kdmain.query_ball, [indices, distances], [points, radius, offsets[:-1]])
+
+        return offsets, indices, distances
+
+    def populate(self, mode, nn):
+        """Calculate a smoothed quantity (see :meth:`smooth_operation_to_id`)
+        for every particle, writing it into the appropriate array reference.
+
+        Other than for 'hsm', the neighbours of each particle are all those
+        within twice its smoothing length. If the *neighbour_cache* attribute
+        is 'csr', these neighbour lists are stored as 32-bit indices in
+        compressed sparse row format the first time they are needed; if it
+        is 'delta', they are stored sorted and delta-encoded in
+        variable-length bytes (see :meth:`_encode_neighbours`), typically
+        taking under a third of the memory. Later calls then scan the stored
+        lists instead of walking the tree, until the smoothing lengths
+        change."""
+        from . import _thread_map
+
+        n_proc = self._get_n_proc()
+
         if nn is None:
             nn = 64
 
@@ -117,18 +280,24 @@ class KDTree(object):
 
         if propid==self.PROPID_HSM:
             kdmain.domain_decomposition(self.kdtree,n_proc)
+            cached = ()
+        elif self.neighbour_cache is not None:
+            cached = self._cached_neighbour_args()
+        else:
+            cached = ()
 
         if n_proc==1 :
-            kdmain.populate(self.kdtree,smx,propid,0)
+            kdmain.populate(self.kdtree,smx,propid,0,*cached)
         else :
-            _thread_map(kdmain.populate,[self.kdtree]*n_proc,[smx]*n_proc,[propid]*n_proc,range(0,n_proc))
+            _thread_map(kdmain.populate,[self.kdtree]*n_proc,[smx]*n_proc,[propid]*n_proc,range(0,n_proc),
+                        *[[a]*n_proc for a in cached])
 
         kdmain.nn_stop(self.kdtree, smx)
 
     def sph_mean(self, array, nsmooth=64):
         """Calculate the SPH mean of a simulation array.
         """
-        output=np.empty_like(array)
+        output=np.empty(array.shape, dtype=array.dtype)
 
         if hasattr(array,'units'):
             output = output.view(ar.SimArray)
@@ -147,7 +316,7 @@ class KDTree(object):
         return output
 
     def sph_dispersion(self, array, nsmooth=64):
-        output=np.empty_like(array)
+        output=np.empty(array.shape, dtype=array.dtype)
         if hasattr(array,'units'):
             output = output.view(ar.SimArray)
             output.units=array.units
@@ -164,6 +333,301 @@ class KDTree(object):
 
         return output
 
+    def _sph_derivative(self, mode, array, shape, description, nsmooth):
+        output = np.empty(shape, dtype=array.dtype)
+        if hasattr(array, 'units') and hasattr(self._pos, 'units'):
+            output = output.view(ar.SimArray)
+            output.units = array.units / self._pos.units
+
+        self.set_array_ref('qty', array)
+        self.set_array_ref('qty_sm', output)
+
+        logger.info("Getting %s of array with %d nearest neighbours" % (description, nsmooth))
+        start = time.time()
+        self.populate(mode, nsmooth)
+        end = time.time()
+
+        logger.info('SPH %s done in %5.3g s' % (description, end - start))
+
+        return output
+
+    def sph_gradient(self, array, nsmooth=64):
+        """Calculate the SPH estimate of the gradient of a 1D simulation
+        array, returning an (N,3) array.
+
+        The estimate, sum_j m_j/rho_j (A_j - A_i) grad W_ij, is taken over
+        the same neighbours as :meth:`sph_mean`, using the 'smooth', 'mass'
+        and 'rho' array references. Displacements are taken to the nearest
+        periodic image if the tree has a boxsize."""
+        return self._sph_derivative('qty_grad', array, (len(array), 3), "gradient", nsmooth)
+
+    def sph_divergence(self, array, nsmooth=64):
+        """Calculate the SPH estimate of the divergence of an (N,3)
+        simulation array; see :meth:`sph_gradient`"""
+        return self._sph_derivative('qty_div', array, (len(array),), "divergence", nsmooth)
+
+    def sph_curl(self, array, nsmooth=64):
+        """Calculate the SPH estimate of the curl of an (N,3) simulation
+        array; see :meth:`sph_gradient`"""
+        return self._sph_derivative('qty_curl', array, (len(array), 3), "curl", nsmooth)
+
+    def _tree_order(self):
+        """Return an array giving the particle at each position in the
+        ordering used by the tree"""
+        try:
+            return self._order
+        except AttributeError:
+            self._order = np.frombuffer(self.get_tree_data()[0], dtype=np.int32)
+            return self._order
+
+    @staticmethod
+    def _encode_neighbours(first, offsets, neighbours):
+        """Delta-encode the neighbour lists (in compressed sparse row format,
+        with indices in tree order) of consecutive particles first,
+        first+1, ... in the tree.
+
+        Each list is sorted; its first entry is stored as its distance below
+        the particle itself and later entries as increments over their
+        predecessor, all as variable-length integers of seven bits per byte,
+        with the top bit set on all but the last byte of each. Since nearby
+        particles are close together in the tree ordering, most entries fit
+        in a single byte.
+
+        Returns (nbytes, data) where nbytes gives the length in bytes of each
+        encoded list."""
+        n = len(offsets) - 1
+        counts = np.diff(offsets)
+        row = np.repeat(np.arange(n, dtype=np.int64), counts)
+        neighbours = np.sort((row << 32) | neighbours) & 0xffffffff
+
+        values = np.empty(len(neighbours), dtype=np.int64)
+        values[1:] = np.diff(neighbours)
+        starts = offsets[:-1][counts > 0]
+        values[starts] = first + row[starts] - neighbours[starts]
+
+        nbytes = np.ones(len(values), dtype=np.int64)
+        for b in xrange(1, 5):
+            nbytes += values >= 1 << (7 * b)
+        byte_start = np.cumsum(nbytes) - nbytes
+
+        data = np.empty(nbytes.sum(), dtype=np.uint8)
+        for b in xrange(5):
+            sel = nbytes > b
+            data[byte_start[sel] + b] = ((values[sel] >> (7 * b)) & 0x7f) | \
+                                        (0x80 * (nbytes[sel] > b + 1))
+
+        return np.bincount(row, weights=nbytes, minlength=n).astype(np.int64), data
+
+    @staticmethod
+    def _decode_neighbours(first, offsets, data):
+        """Decode neighbour lists encoded by :meth:`_encode_neighbours`, given
+        the byte offset of each list within *data*. Returns (offsets,
+        neighbours) in compressed sparse row format."""
+        end_byte = (data & 0x80) == 0
+        value_start = np.flatnonzero(np.concatenate(([True], end_byte[:-1])))
+        value_id = np.cumsum(end_byte) - end_byte
+        shift = 7 * (np.arange(len(data)) - value_start[value_id])
+        values = np.bincount(value_id, weights=(data & 0x7f) * 2.0 ** shift,
+                             minlength=len(value_start)).astype(np.int64)
+
+        offsets = np.searchsorted(value_start, offsets - offsets[0])
+        counts = np.diff(offsets)
+        row = np.repeat(np.arange(len(counts)), counts)
+        starts = offsets[:-1][counts > 0]
+        values[starts] = first + row[starts] - values[starts]
+
+        running = np.cumsum(values)
+        before_row = np.concatenate(([0], running))[offsets[:-1]]
+        return offsets, running - before_row[row]
+
+    def _get_neighbour_cache(self, smooth):
+        """Return the stored neighbour lists, gathering them first if they
+        have not been gathered with the specified smoothing lengths"""
+        from . import _pos_checksum
+
+        if self.neighbour_cache not in ('csr', 'delta'):
+            raise ValueError, "Unknown neighbour cache format %r" % self.neighbour_cache
+
+        checksum = _pos_checksum(smooth)
+        if self._neighbours is not None:
+            if self._neighbours['checksum'] == checksum and \
+               self._neighbours['format'] == self.neighbour_cache:
+                return self._neighbours
+            logger.info("Smoothing lengths have changed; discarding stored neighbour lists")
+            self._neighbours = None
+
+        logger.info("Gathering neighbour lists")
+        start = time.time()
+
+        counts = np.empty(self.s_len, dtype=np.int64)
+        lists = []
+        for t0, t1, offsets, neighbours in self._gather_neighbours(smooth):
+            if self.neighbour_cache == 'delta':
+                counts[t0:t1], neighbours = self._encode_neighbours(t0, offsets, neighbours)
+            else:
+                counts[t0:t1] = np.diff(offsets)
+                neighbours = neighbours.astype(np.int32)
+            lists.append(neighbours)
+
+        offsets = np.zeros(self.s_len + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        self._neighbours = {'checksum': checksum, 'format': self.neighbour_cache,
+                            'offsets': offsets, 'neighbours': np.concatenate(lists)}
+
+        logger.info("Stored neighbour lists in %.1f MB in %5.3g s" %
+                    ((offsets.nbytes + self._neighbours['neighbours'].nbytes) / 2. ** 20,
+                     time.time() - start))
+        return self._neighbours
+
+    def _gather_neighbours(self, smooth, chunk_size=2 ** 16):
+        """Search the tree for the neighbours of all particles, *chunk_size*
+        at a time in tree order, yielding (t0, t1, offsets, neighbours) with
+        the neighbour lists of particles t0 to t1 in the tree in compressed
+        sparse row format, as indices in tree order"""
+        order = self._tree_order()
+        rank = self.particle_rank()
+        for t0 in xrange(0, self.s_len, chunk_size):
+            t1 = min(t0 + chunk_size, self.s_len)
+            particles = order[t0:t1]
+            offsets, neighbours, _ = self.query_ball(self._pos[particles], 2 * smooth[particles])
+            yield t0, t1, offsets, rank[neighbours]
+
+    @classmethod
+    def _read_neighbours(cls, cache, chunk_size):
+        """Read the stored neighbour lists *chunk_size* particles at a time,
+        yielding tuples as for :meth:`_gather_neighbours`"""
+        n = len(cache['offsets']) - 1
+        for t0 in xrange(0, n, chunk_size):
+            t1 = min(t0 + chunk_size, n)
+            offsets = cache['offsets'][t0:t1 + 1]
+            neighbours = cache['neighbours'][offsets[0]:offsets[-1]]
+            if cache['format'] == 'delta':
+                offsets, neighbours = cls._decode_neighbours(t0, offsets, neighbours)
+            else:
+                offsets = offsets - offsets[0]
+            yield t0, t1, offsets, neighbours
+
+    def _cached_neighbour_args(self):
+        """Return the arguments passing the stored neighbour lists to
+        kdmain.populate: (offsets, indices, deltas)"""
+        cache = self._get_neighbour_cache(np.asarray(self.get_array_ref('smooth')))
+        if cache['format'] == 'delta':
+            return cache['offsets'], None, cache['neighbours']
+        else:
+            return cache['offsets'], cache['neighbours'], None
+
+    def neighbour_chunks(self, chunk_size=2 ** 16):
+        """Iterate over the neighbour lists of all particles, *chunk_size*
+        particles at a time. The neighbours of each particle are all those
+        within its kernel radius, twice the 'smooth' array reference, as for
+        :meth:`populate`.
+
+        Yields tuples (particles, row, neighbours, dx, r). The neighbours of
+        particles[j] are neighbours[row==j], at displacements dx (taking
+        account of any periodic box) and distances r. Particles are visited
+        in the order used by the tree, so that each chunk is spatially
+        compact.
+
+        If the *neighbour_cache* attribute is 'csr' or 'delta', the
+        neighbour lists are stored (see :meth:`populate`) and read back
+        rather than searching the tree again."""
+
+        smooth = np.asarray(self.get_array_ref('smooth'))
+        order = self._tree_order()
+        pos = self._pos
+
+        if self.neighbour_cache is not None:
+            chunks = self._read_neighbours(self._get_neighbour_cache(smooth), chunk_size)
+        else:
+            chunks = self._gather_neighbours(smooth, chunk_size)
+
+        for t0, t1, offsets, neighbours in chunks:
+            particles = order[t0:t1]
+            neighbours = order[neighbours]
+            row = np.repeat(np.arange(t1 - t0), np.diff(offsets))
+            dx = np.asarray(pos[neighbours], dtype=np.float64) - \
+                np.asarray(pos[particles], dtype=np.float64)[row]
+            if self.boxsize is not None and self.boxsize > 0:
+                dx -= self.boxsize * np.round(dx / self.boxsize)
+            r = np.sqrt((dx ** 2).sum(axis=1))
+
+            yield particles, row, neighbours, dx, r
+
+    def neighbour_lists(self):
+        """Return the neighbour lists of all particles as a tuple (offsets,
+        indices) in compressed sparse row format: the neighbours of particle i
+        are indices[offsets[i]:offsets[i+1]]. See :meth:`neighbour_chunks`."""
+        counts = np.empty(self.s_len, dtype=np.int64)
+        particles, indices = [], []
+        for chunk_particles, row, neighbours, dx, r in self.neighbour_chunks():
+            counts[chunk_particles] = np.bincount(row, minlength=len(chunk_particles))
+            particles.append(chunk_particles[row])
+            indices.append(neighbours)
+        offsets = np.zeros(self.s_len + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        indices = np.concatenate(indices)[np.argsort(np.concatenate(particles), kind='mergesort')]
+        return offsets, indices
+
+    @staticmethod
+    def _kernel(r, h):
+        """The cubic spline kernel, exactly as in smooth.cpp"""
+        q = r / h
+        w = np.where(q < 1, 1 - 1.5 * q ** 2 + 0.75 * q ** 3,
+                     0.25 * np.maximum(2 - q, 0) ** 3)
+        return w / (np.pi * h ** 3)
+
+    def sph_smooth(self, arrays, dispersion=False):
+        """Calculate the SPH mean (or, if *dispersion* is True, the dispersion)
+        of each of a list of simulation arrays, gathering the neighbours of
+        each particle only once however many arrays there are.
+
+        The smoothing lengths, masses and densities are taken from the
+        'smooth', 'mass' and 'rho' array references, as for :meth:`sph_mean`. The
+        arrays may be 1D or have any number of columns; as for
+        :meth:`sph_dispersion`, the dispersion of a multi-column array
+        combines all its columns. Neighbours are found as for
+        :meth:`neighbour_chunks`.
+
+        Returns a list of arrays in the same order as *arrays*."""
+
+        smooth = np.asarray(self.get_array_ref('smooth'), dtype=np.float64)
+        mass_over_rho = np.asarray(self.get_array_ref('mass'), dtype=np.float64) / \
+            np.asarray(self.get_array_ref('rho'))
+
+        outputs = []
+        for array in arrays:
+            if dispersion or len(array.shape) == 1:
+                output = np.empty(len(array), dtype=array.dtype)
+            else:
+                output = np.empty(array.shape, dtype=array.dtype)
+            if hasattr(array, 'units'):
+                output = output.view(ar.SimArray)
+                output.units = array.units
+            outputs.append(output)
+
+        logger.info("Smoothing %d arrays" % len(arrays))
+        start = time.time()
+
+        for particles, row, neighbours, dx, r in self.neighbour_chunks():
+            n = len(particles)
+            weight = self._kernel(r, smooth[particles][row]) * mass_over_rho[neighbours]
+
+            for array, output in zip(arrays, outputs):
+                values = np.asarray(array)[neighbours].reshape((len(row), -1))
+                mean = np.empty((n, values.shape[1]))
+                for k in xrange(values.shape[1]):
+                    mean[:, k] = np.bincount(row, weights=weight * values[:, k], minlength=n)
+                if dispersion:
+                    diff2 = ((values - mean[row]) ** 2).sum(axis=1)
+                    output[particles] = np.sqrt(np.bincount(row, weights=weight * diff2, minlength=n))
+                else:
+                    output[particles] = mean.reshape((n,) + output.shape[1:])
+
+        end = time.time()
+        logger.info('SPH smooth done in %5.3g s' % (end - start))
+
+        return outputs
+
 
     def __del__(self):
         if hasattr(self, 'kdtree'):
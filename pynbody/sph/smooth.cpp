@@ -363,6 +363,73 @@ int smBallGather(SMX smx,float fBall2,float *ri)
 	}
 
 
+/*
+ ** Gathers the neighbours of particle pi from stored lists rather than
+ ** by searching the tree. The neighbours of pi are given by the entries
+ ** offsets[pi] to offsets[pi+1] of either pIndices, which holds their
+ ** indices in tree order, or (if pIndices is NULL) pDeltas. The latter
+ ** holds the same indices in ascending order, as variable-length
+ ** encoded differences: first pi minus the lowest index, then the
+ ** increments from each index to the next.
+ */
+template<typename T>
+int smCachedGather(SMX smx, int pi, npy_int64 *offsets, npy_int32 *pIndices, unsigned char *pDeltas)
+{
+	PARTICLE *p;
+	KD kd=smx->kd;
+	int pj,nCnt,shift;
+	npy_int64 k,v;
+	T x,y,z,dx,dy,dz,lx,ly,lz;
+
+	p = kd->p;
+	lx = smx->fPeriod[0];
+	ly = smx->fPeriod[1];
+	lz = smx->fPeriod[2];
+	x = GET2<T>(kd->pNumpyPos,p[pi].iOrder,0);
+	y = GET2<T>(kd->pNumpyPos,p[pi].iOrder,1);
+	z = GET2<T>(kd->pNumpyPos,p[pi].iOrder,2);
+	nCnt = 0;
+	pj = pi;
+	k = offsets[pi];
+
+	while (k < offsets[pi+1]) {
+		if (pIndices!=NULL) {
+			pj = pIndices[k++];
+		} else {
+			v = 0;
+			shift = 0;
+			do {
+				v |= (npy_int64)(pDeltas[k] & 0x7f) << shift;
+				shift += 7;
+			} while (pDeltas[k++] & 0x80);
+			if (nCnt==0) pj = pi - (int)v;
+			else pj += (int)v;
+		}
+
+		if(nCnt>=smx->nListSize) {
+			if(!smx->warnings) fprintf(stderr, "Smooth - particle cache too small for local density - results will be incorrect\n");
+			smx->warnings=true;
+			break;
+		}
+
+		dx = x - GET2<T>(kd->pNumpyPos,p[pj].iOrder,0);
+		dy = y - GET2<T>(kd->pNumpyPos,p[pj].iOrder,1);
+		dz = z - GET2<T>(kd->pNumpyPos,p[pj].iOrder,2);
+		if (dx > 0.5*lx) dx -= lx;
+		else if (dx < -0.5*lx) dx += lx;
+		if (dy > 0.5*ly) dy -= ly;
+		else if (dy < -0.5*ly) dy += ly;
+		if (dz > 0.5*lz) dz -= lz;
+		else if (dz < -0.5*lz) dz += lz;
+
+		smx->fList[nCnt] = dx*dx + dy*dy + dz*dz;
+		smx->pList[nCnt++] = pj;
+	}
+
+	return(nCnt);
+}
+
+
 
 
 
@@ -848,6 +915,334 @@ void smDispQty1D(SMX smx,int pi,int nSmooth,int *pList,float *fList)
 }
 
 
+/*
+ ** The gradient of the kernel W(|r_i - r_j|, h_i) with respect to r_i,
+ ** taking the displacement between the particles to the nearest periodic
+ ** image. Used by the gradient, divergence and curl estimators below,
+ ** which all take the difference form sum_j m_j/rho_j (A_j - A_i) grad W
+ ** so that they vanish exactly for a uniform field.
+ */
+template<typename Tf>
+void smKernelGradient(SMX smx,int pi,int pj,Tf ih2,Tf fNorm,float r2,Tf *gradW)
+{
+	Tf q,dwdq_over_q,dx;
+	int k;
+	KD kd = smx->kd;
+
+	q = sqrt(r2*ih2);
+	if (q < 1.0) dwdq_over_q = -3.0 + 2.25*q;
+	else if (q < 2.0) dwdq_over_q = -0.75*(2.0-q)*(2.0-q)/q;
+	else dwdq_over_q = 0.0;
+
+	for(k=0;k<3;++k) {
+		dx = GET2<Tf>(kd->pNumpyPos,kd->p[pi].iOrder,k) -
+		     GET2<Tf>(kd->pNumpyPos,kd->p[pj].iOrder,k);
+		if (dx > 0.5*smx->fPeriod[k]) dx -= smx->fPeriod[k];
+		else if (dx < -0.5*smx->fPeriod[k]) dx += smx->fPeriod[k];
+		gradW[k] = fNorm*ih2*dwdq_over_q*dx;
+	}
+}
+
+template<typename Tf, typename Tq>
+void smGradQty1D(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	Tf fNorm,ih2,ih,mass,rho,gradW[3];
+	int j,k,pj,pi_iord ;
+	KD kd = smx->kd;
+	Tq qty_i, tdiff;
+
+	pi_iord = kd->p[pi].iOrder;
+	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
+	ih2 = ih*ih;
+	fNorm = M_1_PI*ih*ih2;
+	qty_i = GET<Tq>(kd->pNumpyQty,pi_iord);
+
+	for(k=0;k<3;++k)
+		SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,0.0);
+
+	for (j=0;j<nSmooth;++j) {
+		pj = pList[j];
+		smKernelGradient<Tf>(smx,pi,pj,ih2,fNorm,fList[j],gradW);
+		mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
+		rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
+		tdiff = GET<Tq>(kd->pNumpyQty,kd->p[pj].iOrder)-qty_i;
+		for(k=0;k<3;++k) {
+			ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,
+				mass*tdiff*gradW[k]/rho);
+		}
+	}
+
+}
+
+template<typename Tf, typename Tq>
+void smDivQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	Tf fNorm,ih2,ih,mass,rho,gradW[3];
+	int j,k,pj,pi_iord ;
+	KD kd = smx->kd;
+	Tq tdiff;
+
+	pi_iord = kd->p[pi].iOrder;
+	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
+	ih2 = ih*ih;
+	fNorm = M_1_PI*ih*ih2;
+
+	SET<Tq>(kd->pNumpyQtySmoothed,pi_iord,0.0);
+
+	for (j=0;j<nSmooth;++j) {
+		pj = pList[j];
+		smKernelGradient<Tf>(smx,pi,pj,ih2,fNorm,fList[j],gradW);
+		mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
+		rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
+		for(k=0;k<3;++k) {
+			tdiff = GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k)-GET2<Tq>(kd->pNumpyQty,pi_iord,k);
+			ACCUM<Tq>(kd->pNumpyQtySmoothed,pi_iord,mass*tdiff*gradW[k]/rho);
+		}
+	}
+
+}
+
+template<typename Tf, typename Tq>
+void smCurlQtyND(SMX smx,int pi,int nSmooth,int *pList,float *fList)
+{
+	Tf fNorm,ih2,ih,mass,rho,gradW[3];
+	int j,k,pj,pi_iord ;
+	KD kd = smx->kd;
+	Tq tdiff[3];
+
+	pi_iord = kd->p[pi].iOrder;
+	ih = 1.0/GET<Tf>(kd->pNumpySmooth, pi_iord);
+	ih2 = ih*ih;
+	fNorm = M_1_PI*ih*ih2;
+
+	for(k=0;k<3;++k)
+		SET2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,0.0);
+
+	for (j=0;j<nSmooth;++j) {
+		pj = pList[j];
+		smKernelGradient<Tf>(smx,pi,pj,ih2,fNorm,fList[j],gradW);
+		mass=GET<Tf>(kd->pNumpyMass,kd->p[pj].iOrder);
+		rho=GET<Tf>(kd->pNumpyDen,kd->p[pj].iOrder);
+		for(k=0;k<3;++k)
+			tdiff[k] = GET2<Tq>(kd->pNumpyQty,kd->p[pj].iOrder,k)-GET2<Tq>(kd->pNumpyQty,pi_iord,k);
+		// curl = sum_j m_j/rho_j grad W x (A_j - A_i)
+		for(k=0;k<3;++k) {
+			ACCUM2<Tq>(kd->pNumpyQtySmoothed,pi_iord,k,
+				mass*(gradW[(k+1)%3]*tdiff[(k+2)%3]-gradW[(k+2)%3]*tdiff[(k+1)%3])/rho);
+		}
+	}
+
+}
+
+
+
+#ifndef BIGFLOAT
+#define BIGFLOAT ((float)1.0e37)
+#endif
+
+/*
+ ** Searches around arbitrary positions, which do not need a smoothing
+ ** context. Neighbours are reported by their index in the original
+ ** arrays (i.e. iOrder) and their squared distance from ri.
+ */
+
+static void smHeapSiftDown(float *fKey, int *pKey, int n, int i)
+{
+	int c;
+	float ft;
+	int pt;
+	while ((c = 2*i+1) < n) {
+		if (c+1 < n && fKey[c+1] > fKey[c]) ++c;
+		if (fKey[c] <= fKey[i]) break;
+		ft = fKey[i]; fKey[i] = fKey[c]; fKey[c] = ft;
+		pt = pKey[i]; pKey[i] = pKey[c]; pKey[c] = pt;
+		i = c;
+	}
+}
+
+static void smHeapSiftUp(float *fKey, int *pKey, int i)
+{
+	int parent;
+	float ft;
+	int pt;
+	while (i > 0) {
+		parent = (i-1)/2;
+		if (fKey[parent] >= fKey[i]) break;
+		ft = fKey[i]; fKey[i] = fKey[parent]; fKey[parent] = ft;
+		pt = pKey[i]; pKey[i] = pKey[parent]; pKey[parent] = pt;
+		i = parent;
+	}
+}
+
+/*
+ ** Move the position ri to its periodic image lying within one period of
+ ** the lower corner of the particles' bounding box. The searches below only
+ ** consider the images of a cell one period either side of ri, which are
+ ** enough only for positions in this range.
+ */
+static void smWrapIntoBox(KD kd, float *fPeriod, float *ri)
+{
+	int j;
+	float fMin;
+	for (j=0;j<3;++j) {
+		if (fPeriod[j] >= BIGFLOAT) continue;
+		fMin = kd->kdNodes[ROOT].bnd.fMin[j];
+		ri[j] -= fPeriod[j]*floor((ri[j]-fMin)/fPeriod[j]);
+		// guard against rounding taking ri to the top of the range
+		if (ri[j] >= fMin+fPeriod[j]) ri[j] -= fPeriod[j];
+	}
+}
+
+template<typename T>
+static void smHeapAdd(KD kd, float *fPeriod, int k, int *nCnt, float *fList, int *pList, int pj, T x, T y, T z)
+{
+	T dx,dy,dz;
+	float fDist2;
+	dx = x - GET2<T>(kd->pNumpyPos,kd->p[pj].iOrder,0);
+	dy = y - GET2<T>(kd->pNumpyPos,kd->p[pj].iOrder,1);
+	dz = z - GET2<T>(kd->pNumpyPos,kd->p[pj].iOrder,2);
+	// nearest periodic image
+	if (dx > 0.5*fPeriod[0]) dx -= fPeriod[0];
+	else if (dx < -0.5*fPeriod[0]) dx += fPeriod[0];
+	if (dy > 0.5*fPeriod[1]) dy -= fPeriod[1];
+	else if (dy < -0.5*fPeriod[1]) dy += fPeriod[1];
+	if (dz > 0.5*fPeriod[2]) dz -= fPeriod[2];
+	else if (dz < -0.5*fPeriod[2]) dz += fPeriod[2];
+	fDist2 = dx*dx + dy*dy + dz*dz;
+	if (*nCnt < k) {
+		fList[*nCnt] = fDist2;
+		pList[*nCnt] = kd->p[pj].iOrder;
+		smHeapSiftUp(fList, pList, *nCnt);
+		++(*nCnt);
+	} else if (fDist2 < fList[0]) {
+		fList[0] = fDist2;
+		pList[0] = kd->p[pj].iOrder;
+		smHeapSiftDown(fList, pList, k, 0);
+	}
+}
+
+template<typename T>
+int smNearestNeighbours(KD kd, float *fPeriod, int k, float *ri, float *fList, int *pList)
+{
+	KDN *c;
+	int cell,cp,pj,nCnt,nSplit,bucket;
+	float x,y,z,lx,ly,lz,sx,sy,sz,fBall2,ft;
+	int pt;
+
+	c = kd->kdNodes;
+	nSplit = kd->nSplit;
+	lx = fPeriod[0];
+	ly = fPeriod[1];
+	lz = fPeriod[2];
+	smWrapIntoBox(kd, fPeriod, ri);
+	x = ri[0];
+	y = ri[1];
+	z = ri[2];
+	nCnt = 0;
+
+	/*
+	 ** Seed the search with the smallest cell containing ri that holds
+	 ** at least k particles, so that the search radius is small from the
+	 ** outset. fList and pList are maintained as a max-heap of the k
+	 ** closest particles found so far.
+	 */
+	bucket = ROOT;
+	while (bucket < nSplit) {
+		if (ri[c[bucket].iDim] < c[bucket].fSplit) bucket = LOWER(bucket);
+		else bucket = UPPER(bucket);
+		}
+	while (bucket != ROOT && c[bucket].pUpper-c[bucket].pLower+1 < k)
+		bucket = PARENT(bucket);
+	for (pj=c[bucket].pLower;pj<=c[bucket].pUpper;++pj)
+		smHeapAdd<T>(kd,fPeriod,k,&nCnt,fList,pList,pj,x,y,z);
+
+	cp = ROOT;
+	while (bucket != ROOT) {
+		// the seed cell has already been searched
+		if (cp == bucket) goto GetNextCell;
+		fBall2 = nCnt<k?BIGFLOAT:fList[0];
+		INTERSECT(c,cp,fBall2,lx,ly,lz,x,y,z,sx,sy,sz);
+		/*
+		 ** We have an intersection to test.
+		 */
+		if (cp < nSplit) {
+			cp = LOWER(cp);
+			continue;
+			}
+		else {
+			for (pj=c[cp].pLower;pj<=c[cp].pUpper;++pj)
+				smHeapAdd<T>(kd,fPeriod,k,&nCnt,fList,pList,pj,x,y,z);
+			}
+	GetNextCell:
+		SETNEXT(cp,ROOT);
+		if (cp == ROOT) break;
+		}
+
+	// Heap sort, leaving the neighbours in order of increasing distance
+	for (cell=nCnt-1;cell>0;--cell) {
+		ft = fList[0]; fList[0] = fList[cell]; fList[cell] = ft;
+		pt = pList[0]; pList[0] = pList[cell]; pList[cell] = pt;
+		smHeapSiftDown(fList, pList, cell, 0);
+	}
+
+	return nCnt;
+}
+
+template<typename T>
+npy_int64 smBallQuery(KD kd, float *fPeriod, float fBall2, float *ri, npy_int64 *pList, npy_float64 *fList)
+{
+	KDN *c;
+	PARTICLE *p;
+	int pj,cp,nSplit;
+	npy_int64 nCnt;
+	T dx,dy,dz,fDist2;
+	float x,y,z,lx,ly,lz,sx,sy,sz;
+
+	c = kd->kdNodes;
+	p = kd->p;
+	nSplit = kd->nSplit;
+	lx = fPeriod[0];
+	ly = fPeriod[1];
+	lz = fPeriod[2];
+	smWrapIntoBox(kd, fPeriod, ri);
+	x = ri[0];
+	y = ri[1];
+	z = ri[2];
+	nCnt = 0;
+	cp = ROOT;
+	while (1) {
+		INTERSECT(c,cp,fBall2,lx,ly,lz,x,y,z,sx,sy,sz);
+		/*
+		 ** We have an intersection to test.
+		 */
+		if (cp < nSplit) {
+			cp = LOWER(cp);
+			continue;
+			}
+		else {
+			for (pj=c[cp].pLower;pj<=c[cp].pUpper;++pj) {
+				dx = sx - GET2<T>(kd->pNumpyPos,p[pj].iOrder,0);
+				dy = sy - GET2<T>(kd->pNumpyPos,p[pj].iOrder,1);
+				dz = sz - GET2<T>(kd->pNumpyPos,p[pj].iOrder,2);
+				fDist2 = dx*dx + dy*dy + dz*dz;
+				if (fDist2 <= fBall2) {
+					// if no output lists are provided, just count
+					if (pList!=NULL) {
+						pList[nCnt] = p[pj].iOrder;
+						fList[nCnt] = fDist2;
+					}
+					++nCnt;
+				}
+			}
+			}
+	GetNextCell:
+		SETNEXT(cp,ROOT);
+		if (cp == ROOT) break;
+		}
+	return(nCnt);
+	}
+
+
 
 // instantiate the actual functions that are available:
 
@@ -857,6 +1252,9 @@ void smBallSearch<double>(SMX smx,float fBall2,float *ri);
 template
 int smBallGather<double>(SMX smx,float fBall2,float *ri);
 
+template
+int smCachedGather<double>(SMX smx, int pi, npy_int64 *offsets, npy_int32 *pIndices, unsigned char *pDeltas);
+
 template
 void smDomainDecomposition<double>(KD kd, int nprocs);
 
@@ -869,6 +1267,12 @@ void smDensitySym<double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 template
 void smDensity<double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+int smNearestNeighbours<double>(KD kd, float *fPeriod, int k, float *ri, float *fList, int *pList);
+
+template
+npy_int64 smBallQuery<double>(KD kd, float *fPeriod, float fBall2, float *ri, npy_int64 *pList, npy_float64 *fList);
+
 
 
 template
@@ -877,6 +1281,9 @@ void smBallSearch<float>(SMX smx,float fBall2,float *ri);
 template
 int smBallGather<float>(SMX smx,float fBall2,float *ri);
 
+template
+int smCachedGather<float>(SMX smx, int pi, npy_int64 *offsets, npy_int32 *pIndices, unsigned char *pDeltas);
+
 template
 void smDomainDecomposition<float>(KD kd, int nprocs);
 
@@ -889,6 +1296,12 @@ void smDensitySym<float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 template
 void smDensity<float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+int smNearestNeighbours<float>(KD kd, float *fPeriod, int k, float *ri, float *fList, int *pList);
+
+template
+npy_int64 smBallQuery<float>(KD kd, float *fPeriod, float fBall2, float *ri, npy_int64 *pList, npy_float64 *fList);
+
 
 
 
@@ -904,6 +1317,15 @@ void smDispQty1D<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fL
 template
 void smDispQtyND<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<double, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 template
 void smMeanQty1D<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
@@ -917,6 +1339,15 @@ void smDispQty1D<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fLi
 template
 void smDispQtyND<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<double, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 template
 void smMeanQty1D<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
@@ -930,6 +1361,15 @@ void smDispQty1D<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fLi
 template
 void smDispQtyND<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<float, double>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 template
 void smMeanQty1D<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
@@ -943,6 +1383,15 @@ void smDispQty1D<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fLis
 template
 void smDispQtyND<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
 
+template
+void smGradQty1D<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smDivQtyND<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
+template
+void smCurlQtyND<float, float>(SMX smx,int pi,int nSmooth,int *pList,float *fList);
+
 
 /*
 
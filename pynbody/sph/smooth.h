@@ -119,6 +119,9 @@ void smBallSearch(SMX,float,float *);
 template<typename T>
 int  smBallGather(SMX,float,float *);
 
+template<typename T>
+int smCachedGather(SMX smx, int pi, npy_int64 *offsets, npy_int32 *pIndices, unsigned char *pDeltas);
+
 template<typename T>
 int smSmoothStep(SMX smx, int procid);
 
@@ -138,9 +141,21 @@ template<typename Tf, typename Tq>
 void smMeanQty1D(SMX,int,int,int *,float *);
 template<typename Tf, typename Tq>
 void smDispQty1D(SMX,int,int,int *,float *);
+template<typename Tf, typename Tq>
+void smGradQty1D(SMX,int,int,int *,float *);
+template<typename Tf, typename Tq>
+void smDivQtyND(SMX,int,int,int *,float *);
+template<typename Tf, typename Tq>
+void smCurlQtyND(SMX,int,int,int *,float *);
 
 bool smCheckFits(KD kd, float *fPeriod);
 
+template<typename T>
+int smNearestNeighbours(KD kd, float *fPeriod, int k, float *ri, float *fList, int *pList);
+
+template<typename T>
+npy_int64 smBallQuery(KD kd, float *fPeriod, float fBall2, float *ri, npy_int64 *pList, npy_float64 *fList);
+
 /*
 void smMeanVel(SMX,int,int,int *,float *);
 void smVelDisp(SMX,int,int,int *,float *);
@@ -310,6 +310,21 @@ def index_of_first(array, find):
     return right
 
 
+def runs(indices):
+    """Given a sorted array of unique integers, return a list of (start, stop)
+    pairs describing the runs of consecutive values, such that the values
+    are exactly those in range(start, stop) for each pair."""
+
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return []
+
+    breaks = np.where(np.diff(indices) != 1)[0] + 1
+    starts = indices[np.concatenate(([0], breaks))]
+    stops = indices[np.concatenate((breaks - 1, [len(indices) - 1]))] + 1
+    return zip(starts, stops)
+
+
 def equipartition(ar, nbins, min=None, max=None):
     """
 